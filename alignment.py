@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Multiple sequence alignments held in memory as a matrix of bytes, with one row per sequence and
+one column per position of the alignment, and the ids of the sequences in a side array.
+
+An alignment is parsed once from the clustal or fasta file written by the aligner, and can be
+saved in a binary form that is memory mapped when it is loaded again, so that alignments of
+thousands of sequences are opened without parsing and only the pages that are read are loaded.
+Slicing rows and columns returns views of the same matrix.
+
+    aln = Alignment.read('protein.aln')
+    aln[:, 100:200].gaps.mean(axis=0)
+    aln.query_columns()
+"""
+
+import os
+import numpy as np
+import fasta as fa
+from biskit.errors import BiskitError
+
+class AlignmentError(BiskitError):
+    pass
+
+MATRIX = 'matrix.npy'
+IDS = 'ids.npy'
+#: The characters read as gaps
+GAPS = b'-.'
+_IS_GAP = np.zeros(256, dtype=bool)
+_IS_GAP[np.frombuffer(GAPS, dtype=np.uint8)] = True
+_UPPER = np.arange(256, dtype=np.uint8)
+_UPPER[ord('a'):ord('z') + 1] -= 32
+
+
+class Alignment:
+    """
+    An alignment of sequences. matrix is a uint8 array of the upper case letters of the sequences,
+    with one row per sequence, and ids the array of the ids of the sequences, in the same order.
+    """
+
+    def __init__(self, ids, matrix, path=None):
+        """
+        Args:
+            ids(list): The ids of the sequences
+            matrix(numpy.ndarray): The letters of the sequences, as a two dimensional uint8 array
+            path(str): The file the alignment was read from, if any
+        """
+        self.ids = np.asarray(ids, dtype=str)
+        self.matrix = matrix
+        self.path = path
+        if matrix.ndim != 2 or len(self.ids) != len(matrix):
+            raise AlignmentError('An alignment needs one row of the matrix per id, not %i ids for a matrix of shape %s'
+                                 % (len(self.ids), matrix.shape))
+        self._index = None
+
+    @classmethod
+    def from_sequences(cls, ids, sequences, path=None):
+        """
+        Args:
+            ids(list): The ids of the sequences
+            sequences(list): The aligned sequences, as bytes or str of the same length
+        """
+        sequences = [s.encode('utf-8') if isinstance(s, str) else s for s in sequences]
+        lengths = set(len(s) for s in sequences)
+        if len(lengths) > 1:
+            raise AlignmentError('The aligned sequences have different lengths: %s' % sorted(lengths))
+        matrix = np.frombuffer(b''.join(sequences), dtype=np.uint8).reshape((len(sequences), lengths.pop() if lengths else 0))
+        return cls(ids, _UPPER[matrix], path=path)
+
+    @classmethod
+    def read(cls, path):
+        """
+        Reads an alignment in clustal or fasta format
+        Args:
+            path(str): The file path to the alignment
+        """
+        with open(path, 'rb') as file:
+            data = file.read()
+        if data.lstrip()[:1] == b'>':
+            return cls.parse_fasta(data, path=path)
+        return cls.parse_clustal(data, path=path)
+
+    @classmethod
+    def parse_fasta(cls, data, path=None):
+        """
+        Args:
+            data(bytes): The alignment in fasta format. The ids are the first word of the headers
+        """
+        ids, sequences = [], []
+        for header, sequence in fa.iter_records(data):
+            ids.append((header.split() or [b''])[0].decode('utf-8'))
+            sequences.append(sequence)
+        return cls.from_sequences(ids, sequences, path=path)
+
+    @classmethod
+    def parse_clustal(cls, data, path=None):
+        """
+        Args:
+            data(bytes): The alignment in clustal format, as written by T-Coffee, Clustal Omega or MUSCLE:
+            a header line, then blocks of lines starting with the id of a sequence followed by a part of
+            it, and lines of conservation marks starting with whitespace
+        """
+        parts = {}
+        for line in data.splitlines()[1:]:
+            if not line.strip() or line[:1] in b' \t':
+                continue
+            words = line.split()
+            if len(words) < 2:
+                raise AlignmentError('Line %r of the clustal alignment has no sequence' % line[:40])
+            parts.setdefault(words[0], []).append(words[1])
+        return cls.from_sequences([i.decode('utf-8') for i in parts], [b''.join(p) for p in parts.values()], path=path)
+
+    @classmethod
+    def load(cls, folder, mmap=True):
+        """
+        Opens an alignment saved with save
+        Args:
+            folder(str): The folder of the saved alignment
+            mmap(boolean): If true, the matrix is memory mapped read only instead of read into memory
+        """
+        try:
+            ids = np.load(folder + os.sep + IDS)
+            matrix = np.load(folder + os.sep + MATRIX, mmap_mode='r' if mmap else None)
+        except FileNotFoundError:
+            raise AlignmentError('%s is not a saved alignment' % folder)
+        return cls(ids, matrix, path=folder)
+
+    def save(self, folder):
+        """
+        Saves the alignment in binary form, to be opened with load
+        Args:
+            folder(str): The folder the alignment is saved in. Created if it does not exist
+        Returns:
+            The folder
+        """
+        os.makedirs(folder, exist_ok=True)
+        for name, array in [(IDS, self.ids), (MATRIX, np.ascontiguousarray(self.matrix))]:
+            temp = folder + os.sep + '.%s.tmp' % name
+            with open(temp, 'wb') as file:
+                np.save(file, array)
+            os.replace(temp, folder + os.sep + name)
+        return folder
+
+    def write(self, path):
+        """
+        Writes the alignment in fasta format, one line per sequence
+        """
+        with open(path, 'wb') as file:
+            for seq_id, row in zip(self.ids, self.matrix):
+                file.write(b'>' + seq_id.encode('utf-8') + b'\n' + row.tobytes() + b'\n')
+        return path
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def shape(self):
+        """
+        The number of sequences and of columns
+        """
+        return self.matrix.shape
+
+    def __getitem__(self, key):
+        """
+        Selects rows, or rows and columns, like a two dimensional numpy array. Integers keep their
+        dimension, so the result is always an Alignment. Slices return views of the matrix
+        """
+        rows, columns = key if isinstance(key, tuple) else (key, slice(None))
+        rows = slice(rows, rows + 1 or None) if isinstance(rows, (int, np.integer)) else rows
+        columns = slice(columns, columns + 1 or None) if isinstance(columns, (int, np.integer)) else columns
+        if isinstance(rows, slice):
+            matrix = self.matrix[rows][:, columns]
+        else:
+            matrix = self.matrix[np.asarray(rows)][:, columns]
+        return Alignment(self.ids[rows], matrix)
+
+    def index(self, id):
+        """
+        Returns:
+            The row of the sequence with the id
+        """
+        if self._index is None:
+            self._index = {seq_id: i for i, seq_id in reversed(list(enumerate(self.ids.tolist())))}
+        try:
+            return self._index[id]
+        except KeyError:
+            raise AlignmentError('%s is not in the alignment' % id)
+
+    def sequence(self, row=0, gapped=False):
+        """
+        Returns:
+            The sequence of a row, without the gaps unless gapped is true
+        """
+        letters = self.matrix[row]
+        if not gapped:
+            letters = letters[~_IS_GAP[letters]]
+        return letters.tobytes().decode('utf-8')
+
+    @property
+    def gaps(self):
+        """
+        The boolean mask of the gaps of the matrix
+        """
+        return _IS_GAP[self.matrix]
+
+    def gap_fraction(self):
+        """
+        Returns:
+            The fraction of the sequences with a gap in every column
+        """
+        return self.gaps.mean(axis=0) if len(self) else np.zeros(self.shape[1])
+
+    def chars(self):
+        """
+        Returns:
+            The matrix as an array of single characters, as returned by aminoCons.read_msa
+        """
+        return np.ascontiguousarray(self.matrix).view('S1').astype('U1')
+
+    def query_columns(self, row=0):
+        """
+        Maps the residues of a sequence onto the alignment
+        Args:
+            row(int): The row of the sequence. Defaults to the first sequence, the query of the pipeline
+        Returns:
+            The column of every residue of the sequence
+        """
+        return np.flatnonzero(~_IS_GAP[self.matrix[row]])
+
+    def column_residues(self, row=0):
+        """
+        Maps the columns of the alignment onto the residues of a sequence
+        Args:
+            row(int): The row of the sequence
+        Returns:
+            The index of the residue of the sequence in every column, starting at 0, or -1 where the
+            sequence has a gap
+        """
+        residues = ~_IS_GAP[self.matrix[row]]
+        return np.where(residues, np.cumsum(residues) - 1, -1)
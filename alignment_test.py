@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Test file for the in memory alignments
+"""
+import biskit.test
+import os
+import shutil
+import tempfile
+import numpy as np
+import alignment
+
+
+class TestAlignment(biskit.test.BiskitTest):
+    """
+    Test suite testing the parsing, saving and slicing of alignments
+    """
+
+    TAGS = [biskit.test.NORMAL]
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.clustal = self.directory + os.sep + 'family.aln'
+        with open(self.clustal, 'w') as file:
+            file.write('CLUSTAL W (1.83) multiple sequence alignment\n\n'
+                       'query      MK-WL\northolog1  MKAWI\northolog2  mr-w-\n           ** * \n\n'
+                       'query      AG 7\northolog1  -G 9\northolog2  AG 6\n           .*\n')
+        self.fasta = self.directory + os.sep + 'family.fasta'
+        with open(self.fasta, 'w') as file:
+            file.write('>query first\nMK-W\nLAG\n>ortholog1\nMKAWI-G\n>ortholog2\nmr-w-AG\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_read(self):
+        """tests that clustal and fasta alignments give the same upper case matrix"""
+        aln = alignment.Alignment.read(self.clustal)
+        self.assertEqual(aln.ids.tolist(), ['query', 'ortholog1', 'ortholog2'])
+        self.assertEqual(aln.matrix.dtype, np.uint8)
+        self.assertEqual(aln.shape, (3, 7))
+        self.assertEqual(aln.sequence(2, gapped=True), 'MR-W-AG')
+        fasta = alignment.Alignment.read(self.fasta)
+        self.assertEqual(fasta.ids.tolist(), aln.ids.tolist())
+        np.testing.assert_array_equal(fasta.matrix, aln.matrix)
+        self.assertRaises(alignment.AlignmentError, alignment.Alignment.from_sequences, ['a', 'b'], ['MK', 'M'])
+
+    def test_save_load(self):
+        """tests that a saved alignment is memory mapped when it is loaded"""
+        aln = alignment.Alignment.read(self.clustal)
+        folder = aln.save(self.directory + os.sep + 'family.alignment')
+        loaded = alignment.Alignment.load(folder)
+        self.assertIsInstance(loaded.matrix, np.memmap)
+        self.assertEqual(loaded.ids.tolist(), aln.ids.tolist())
+        np.testing.assert_array_equal(loaded.matrix, aln.matrix)
+        self.assertEqual(loaded.index('ortholog2'), 2)
+        self.assertRaises(alignment.AlignmentError, alignment.Alignment.load, self.directory)
+
+    def test_slicing(self):
+        """tests that rows and columns are selected as views, integers keeping their dimension"""
+        aln = alignment.Alignment.read(self.clustal)
+        block = aln[1:, 2:5]
+        self.assertEqual(block.ids.tolist(), ['ortholog1', 'ortholog2'])
+        self.assertEqual(block.sequence(0, gapped=True), 'AWI')
+        self.assertTrue(np.shares_memory(block.matrix, aln.matrix))
+        self.assertEqual(aln[-1].shape, (1, 7))
+        self.assertEqual(aln[[2, 0], 3].chars().tolist(), [['W'], ['W']])
+
+    def test_gaps_and_query(self):
+        """tests the gap masks and the mapping between columns and the residues of the query"""
+        aln = alignment.Alignment.read(self.clustal)
+        np.testing.assert_array_equal(aln.gaps.sum(axis=0), [0, 0, 2, 0, 1, 1, 0])
+        np.testing.assert_allclose(aln.gap_fraction()[2], 2 / 3)
+        np.testing.assert_array_equal(aln.query_columns(), [0, 1, 3, 4, 5, 6])
+        np.testing.assert_array_equal(aln.column_residues(), [0, 1, -1, 2, 3, 4, 5])
+        np.testing.assert_array_equal(aln.column_residues(1), [0, 1, 2, 3, 4, -1, 5])
+        self.assertEqual(aln.sequence(), 'MKWLAG')
+
+
+if __name__ == '__main__':
+    biskit.test.localTest()
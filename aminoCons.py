@@ -6,13 +6,23 @@ Created on Tue Jun 26 09:45:57 2018
 @author: suliat16
 """
 
+import io
 import os
 import re
+import shutil
+import subprocess
 import warnings
+import numpy as np
 import biskit.tools as t
-from Bio.Align.Applications import TCoffeeCommandline
+from concurrent.futures import ThreadPoolExecutor
+from alignment import Alignment
 from biskit.exe import Executor
 from biskit.errors import BiskitError
+from lazyimport import lazy_import
+
+# Biopython is only needed to reorder MUSCLE alignments
+AlignIO = lazy_import('Bio.AlignIO')
+Align = lazy_import('Bio.Align')
 
 class SequenceError(BiskitError):
     pass
@@ -20,39 +30,447 @@ class SequenceError(BiskitError):
 class Rate4SiteError(BiskitError):
     pass
 
-def build_alignment(file):
+#: The fields of a row of the Rate4Site residue table, see Rate4Site.read_table
+R4S_COLUMNS = ['pos', 'aa', 'score', 'qq_low', 'qq_high', 'std', 'msa_count', 'msa_total']
+R4S_DTYPE = np.dtype([('pos', np.int32), ('aa', 'U1'), ('score', np.float64), ('qq_low', np.float64),
+                      ('qq_high', np.float64), ('std', np.float64), ('msa_count', np.int32), ('msa_total', np.int32)])
+#: The characters separating the fields of the table besides whitespace
+R4S_SEPARATORS = str.maketrans('[],/', '    ')
+
+class AlignerError(BiskitError):
+    pass
+
+#: The options T-Coffee is run with by build_alignment. Part of the key of cached alignments
+TCOFFEE_OPTIONS = {'output': 'clustalw'}
+
+#: Above this number of sequences, build_alignment with aligner='auto' uses a faster aligner than T-Coffee
+AUTO_TCOFFEE_MAX = 50
+
+class Aligner:
+
+    """
+    A multiple sequence alignment program. Every aligner writes its alignment in clustal format,
+    with the sequences in the order of the input, so that the first sequence stays the reference
+    of Rate4Site. Subclasses give the command line of their program.
+    """
+
+    #: The name the aligner is selected by
+    name = None
+    #: The executable of the program
+    exe = None
+    #: The options the program is run with. Part of the key of cached alignments
+    options = {}
+
+    @classmethod
+    def available(cls):
+        """
+        Returns:
+            True if the executable of the program is found in the PATH
+        """
+        return shutil.which(cls.exe) is not None
+
+    @classmethod
+    def command(cls, infile, outfile, threads=None):
+        """
+        Returns:
+            The command line running the program, as a list of arguments
+        """
+        raise NotImplementedError
+
+    @classmethod
+    def align(cls, infile, outfile, workdir, threads=None):
+        """
+        Aligns the sequences of a fasta file
+        Args:
+            infile(str): The file path to the sequences
+            outfile(str): The file path the alignment is written to
+            workdir(str): The folder the program runs in
+            threads(int): The number of threads the program may use, if it supports threads
+        Returns:
+            The file path to the alignment
+        """
+        try:
+            process = subprocess.run(cls.command(infile, outfile, threads), cwd=workdir,
+                                     stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except OSError as e:
+            raise AlignerError('%s could not be run: %s' % (cls.exe, e))
+        if process.returncode != 0:
+            raise AlignerError('%s failed with exit code %i: %s' % (cls.exe, process.returncode,
+                                                                    process.stderr.decode('utf-8', 'replace')))
+        return outfile
+
+class TCoffee(Aligner):
+
+    """
+    T-Coffee: A novel method for multiple sequence alignments.
+    Notredame,Higgins,Heringa,JMB,302(205-217)2000
+    """
+
+    name = 't_coffee'
+    exe = 't_coffee'
+    options = TCOFFEE_OPTIONS
+
+    @classmethod
+    def command(cls, infile, outfile, threads=None):
+        args = [cls.exe]
+        for option, value in cls.options.items():
+            args += ['-' + option, value]
+        args += ['-infile', infile, '-outfile', outfile]
+        if threads:
+            args.append('-n_core=%i' % threads)
+        return args
+
+class Mafft(Aligner):
+
+    """
+    MAFFT, which writes the alignment to its standard output.
+    Katoh K, Standley DM. MAFFT multiple sequence alignment software version 7: improvements in
+    performance and usability. Mol Biol Evol 2013, 30 (4): 772-780.
+    """
+
+    name = 'mafft'
+    exe = 'mafft'
+    options = {'auto': True, 'clustalout': True, 'amino': True, 'quiet': True}
+
+    @classmethod
+    def command(cls, infile, outfile, threads=None):
+        args = [cls.exe] + ['--' + option for option in cls.options]
+        if threads:
+            args += ['--thread', str(threads)]
+        return args + [infile]
+
+    @classmethod
+    def align(cls, infile, outfile, workdir, threads=None):
+        with open(outfile, 'wb') as file:
+            try:
+                process = subprocess.run(cls.command(infile, outfile, threads), cwd=workdir,
+                                         stdout=file, stderr=subprocess.PIPE)
+            except OSError as e:
+                raise AlignerError('%s could not be run: %s' % (cls.exe, e))
+        if process.returncode != 0:
+            raise AlignerError('%s failed with exit code %i: %s' % (cls.exe, process.returncode,
+                                                                    process.stderr.decode('utf-8', 'replace')))
+        return outfile
+
+class ClustalOmega(Aligner):
+
+    """
+    Clustal Omega.
+    Sievers F et al., Fast, scalable generation of high-quality protein multiple sequence alignments
+    using Clustal Omega. Mol Syst Biol 2011, 7: 539.
+    """
+
+    name = 'clustalo'
+    exe = 'clustalo'
+    options = {'outfmt': 'clustal', 'output-order': 'input-order'}
+
+    @classmethod
+    def command(cls, infile, outfile, threads=None):
+        args = [cls.exe, '-i', infile, '-o', outfile, '--force']
+        args += ['--%s=%s' % item for item in cls.options.items()]
+        if threads:
+            args.append('--threads=%i' % threads)
+        return args
+
+class Muscle(Aligner):
+
+    """
+    MUSCLE 3, which has no threads and orders its output by similarity, so the sequences are put
+    back in the order of the input after the alignment.
+    Edgar RC. MUSCLE: multiple sequence alignment with high accuracy and high throughput.
+    Nucleic Acids Res 2004, 32 (5): 1792-1797.
+    """
+
+    name = 'muscle'
+    exe = 'muscle'
+    options = {'clw': True}
+
+    @classmethod
+    def command(cls, infile, outfile, threads=None):
+        return [cls.exe, '-in', infile, '-out', outfile, '-quiet'] + ['-' + option for option in cls.options]
+
+    @classmethod
+    def align(cls, infile, outfile, workdir, threads=None):
+        super().align(infile, outfile, workdir, threads=threads)
+        with open(infile, 'r') as file:
+            order = [line[1:].split()[0] for line in file if line.startswith('>') and line[1:].split()]
+        alignment = AlignIO.read(outfile, 'clustal')
+        records = {r.id: r for r in alignment}
+        alignment = Align.MultipleSeqAlignment([records[i] for i in order if i in records])
+        AlignIO.write(alignment, outfile, 'clustal')
+        return outfile
+
+#: The aligners build_alignment can use, by name
+ALIGNERS = {aligner.name: aligner for aligner in [TCoffee, Mafft, ClustalOmega, Muscle]}
+
+def get_aligner(name='auto', count=None):
+    """
+    Args:
+        name(str): The name of an aligner in ALIGNERS, or auto. Auto chooses T-Coffee for up to
+        AUTO_TCOFFEE_MAX sequences, and otherwise the first installed of MAFFT, Clustal Omega and
+        Muscle, falling back to T-Coffee if none is installed
+        count(int): The number of sequences to align, used by auto
+    Returns:
+        The Aligner class
+    """
+    if name != 'auto':
+        try:
+            return ALIGNERS[name]
+        except KeyError:
+            raise AlignerError('Unknown aligner %r, choose one of auto, %s' % (name, ', '.join(ALIGNERS)))
+    if count is None or count > AUTO_TCOFFEE_MAX:
+        for aligner in [Mafft, ClustalOmega, Muscle]:
+            if aligner.available():
+                return aligner
+    return TCoffee
+
+def available_cpus():
+    """
+    Returns:
+        The number of CPUs the process may run on, which can be fewer than the CPUs of the machine
     """
-    Calls the TCoffee program to build an alignment of protein sequences
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def count_sequences(file):
+    """
+    Returns:
+        The number of sequences in a fasta file
+    """
+    count = 0
+    # The start of the file is the start of a line
+    previous = b'\n'
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            count += (previous + chunk[:1] == b'\n>') + chunk.count(b'\n>')
+            previous = chunk[-1:]
+    return count
+
+def build_alignment(file, workdir=None, aligner='t_coffee', threads=None):
+    """
+    Builds an alignment of protein sequences, by default with the T-Coffee program
     Args:
         file: The absolute file path to the collection of protein sequences
+        workdir(str): The folder in which the aligner is run and the alignment is written. Defaults
+        to the current working directory
+        aligner(str): The name of the aligner, see get_aligner
+        threads(int): The number of threads the aligner may use. Defaults to the default of the aligner
     Returns:
-        A string detailing the path to the folder containing the alignment file. The
-        alignment is output in the current working directory.
+        A string detailing the path to the alignment file, in clustal format.
 
     """
+    workdir = workdir or os.getcwd()
     filename = os.path.basename(file)
     filename = filename.split('.')[0]
-    tcoffee_cline = TCoffeeCommandline(infile=file,
-                                       output='clustalw',
-                                       outfile='%s.aln' %(filename))
-    directory = os.getcwd() + os.sep + '%s.aln'%(filename)
-    tcoffee_cline()
-    return directory
+    directory = workdir + os.sep + '%s.aln'%(filename)
+    if aligner == 'auto':
+        aligner = get_aligner(aligner, count_sequences(file))
+    else:
+        aligner = get_aligner(aligner)
+    return aligner.align(file, directory, workdir, threads=threads)
 
-def clean_alignment(path, cache):
+def clean_alignment(path, cache, workdir=None):
     """
     Deletes the files generated by T-Coffee when called using build_alignment
     Args:
         file (str): The file path to the alignment file
         cache (Boolean): If true, the alignment file is kept. If false, the alignment
         file is also deleted
+        workdir (str): The folder T-Coffee was run in. Defaults to the current working directory
     """
+    workdir = workdir or os.getcwd()
     filename = os.path.basename(path)
     filename = str(filename.split('.')[0])
 
     if not cache:
-        t.tryRemove(os.getcwd() + os.sep + '%s.aln' %(filename))
-    t.tryRemove(os.getcwd() + os.sep + '%s.dnd' %(filename))
+        t.tryRemove(workdir + os.sep + '%s.aln' %(filename))
+    t.tryRemove(workdir + os.sep + '%s.dnd' %(filename))
+
+def read_msa(msa):
+    """
+    Reads an alignment in clustal or fasta format
+    Args:
+        msa (str): The file path to the alignment
+    Returns:
+        A list of the sequence ids, and a numpy array of single characters with one row per sequence
+    """
+    aln = Alignment.read(msa)
+    return aln.ids.tolist(), aln.chars()
+
+#: The distance given to sequences that are too different, or share no position, to be compared
+MAX_DISTANCE = 3.0
+
+def pairwise_distances(aln):
+    """
+    Computes the Poisson corrected distance between every pair of aligned sequences, -log(1 - p), p being
+    the fraction of differing residues at the positions where neither sequence has a gap. The matches
+    are counted with one matrix product per letter, so that alignments of thousands of sequences are
+    compared at once
+    Args:
+        aln (alignment.Alignment): The alignment
+    Returns:
+        A symmetric array of the distances, MAX_DISTANCE for pairs that share no position
+    """
+    gaps = aln.gaps
+    residues = (~gaps).astype(np.float32)
+    compared = residues @ residues.T
+    same = np.zeros_like(compared)
+    for letter in np.unique(aln.matrix[~gaps]):
+        present = (aln.matrix == letter).astype(np.float32)
+        same += present @ present.T
+    differ = np.where(compared > 0, 1 - same / np.maximum(compared, 1), 1.0)
+    distances = np.minimum(-np.log(np.maximum(1 - differ, 1e-12)), MAX_DISTANCE).astype(float)
+    np.fill_diagonal(distances, 0)
+    return distances
+
+def neighbour_joining(ids, distances):
+    """
+    Builds an unrooted tree from a distance matrix with the neighbour joining algorithm of Saitou and
+    Nei. Every join is found and applied with whole array operations, so that a tree of n sequences
+    takes n steps of O(n^2) vectorized work
+    Args:
+        ids (list): The names of the leaves
+        distances (numpy.ndarray): The symmetric matrix of the distances between the leaves
+    Returns:
+        The tree in newick format, with a trifurcation at the root and negative branch lengths set to 0
+    """
+    nodes = list(ids)
+    d = np.array(distances, dtype=float)
+    if len(nodes) == 1:
+        return '(%s:0.00000);' % nodes[0]
+    while len(nodes) > 3:
+        n = len(nodes)
+        sums = d.sum(axis=1)
+        q = (n - 2) * d - sums[:, None] - sums[None, :]
+        np.fill_diagonal(q, np.inf)
+        i, j = sorted(np.unravel_index(np.argmin(q), q.shape))
+        length_i = 0.5 * d[i, j] + (sums[i] - sums[j]) / (2 * (n - 2))
+        length_j = d[i, j] - length_i
+        joined = 0.5 * (d[i] + d[j] - d[i, j])
+        nodes[i] = '(%s:%.5f,%s:%.5f)' % (nodes[i], max(length_i, 0), nodes[j], max(length_j, 0))
+        d[i, :] = joined
+        d[:, i] = joined
+        d[i, i] = 0
+        # The last node takes the place of j, and the matrix shrinks by a row and a column without a copy
+        d[j, :] = d[n - 1, :]
+        d[:, j] = d[:, n - 1]
+        d[j, j] = 0
+        nodes[j] = nodes[n - 1]
+        del nodes[n - 1]
+        d = d[:n - 1, :n - 1]
+    if len(nodes) == 2:
+        return '(%s:%.5f,%s:%.5f);' % (nodes[0], d[0, 1] / 2, nodes[1], d[0, 1] / 2)
+    lengths = [0.5 * (d[0, 1] + d[0, 2] - d[1, 2]), 0.5 * (d[0, 1] + d[1, 2] - d[0, 2]),
+               0.5 * (d[0, 2] + d[1, 2] - d[0, 1])]
+    return '(%s);' % ','.join('%s:%.5f' % (node, max(length, 0)) for node, length in zip(nodes, lengths))
+
+def build_tree(msa, outfile):
+    """
+    Builds a neighbour joining tree of the aligned sequences from their pairwise_distances. The branch
+    lengths estimate the substitutions per site, so the tree can be used by rate4site without optimizing
+    them
+    Args:
+        msa (str or alignment.Alignment): The alignment, or the file path to it
+        outfile (str): The file path the tree is written to, in newick format
+    Returns:
+        The file path to the tree
+    """
+    aln = msa if isinstance(msa, Alignment) else Alignment.read(msa)
+    with open(outfile, 'w') as file:
+        file.write(neighbour_joining(aln.ids.tolist(), pairwise_distances(aln)) + '\n')
+    return outfile
+
+def split_columns(rows, blocks):
+    """
+    Splits the columns of an alignment into contiguous blocks holding about the same number of
+    residues of the reference (first) sequence, so that every block has at least one
+    Args:
+        rows (numpy.ndarray): The alignment, as returned by read_msa
+        blocks (int): The maximum number of blocks
+    Returns:
+        A list of (start, end) column ranges covering the whole alignment
+    """
+    residues = np.flatnonzero(rows[0] != '-')
+    chunks = [c for c in np.array_split(residues, min(blocks, len(residues))) if len(c)]
+    starts = [0] + [int(c[0]) for c in chunks[1:]]
+    ends = starts[1:] + [rows.shape[1]]
+    return list(zip(starts, ends))
+
+def run_rate4site_blocks(msa, blocks, workdir=None, jobs=None, **kw):
+    """
+    Runs rate4site on column blocks of the alignment in parallel, against a single tree built once
+    from the whole alignment, and merges the results into a single rate4site output file.
+
+    Every block is scored with the branch lengths of the shared tree kept fixed (-bn), so that the
+    rates of all the blocks are relative to the same tree. They are taken unnormalized from every
+    block and normalized together afterwards, to a mean of 0 and a standard deviation of 1 like
+    rate4site does. The merged scores are still an approximation of the scores of the whole
+    alignment: rate4site estimates the gamma parameter alpha of every block on its own columns, and
+    the prior of the rates of each block follows its own alpha. The merged file reports the mean of
+    the alphas of the blocks, weighted by their residues, and should not be read as the alpha of the
+    whole alignment.
+    Args:
+        msa (str or alignment.Alignment): The alignment, or the file path to it. The blocks are named after
+        the file of the alignment
+        blocks (int): The number of column blocks
+        workdir (str): The folder the blocks are run in and the merged output is written to. Defaults
+        to the current working directory
+        jobs (int): The number of rate4site processes run at the same time. Defaults to blocks
+        kw: Passed on to Rate4Site
+    Returns:
+        The file path to the merged output, which has the layout of a rate4site output file
+    """
+    workdir = os.path.abspath(workdir or os.getcwd())
+    aln = msa if isinstance(msa, Alignment) else Alignment.read(msa)
+    name = os.path.basename(aln.path or 'alignment').split('.')[0]
+    ids, rows = aln.ids.tolist(), aln.chars()
+    tree = build_tree(aln, workdir + os.sep + '%s.tree' % name)
+    ranges = split_columns(rows, blocks)
+
+    def score_block(i):
+        start, end = ranges[i]
+        folder = workdir + os.sep + '%s_block%i' % (name, i)
+        os.makedirs(folder, exist_ok=True)
+        block = folder + os.sep + '%s_block%i.fasta' % (name, i)
+        with open(block, 'w') as file:
+            for seq_id, row in zip(ids, rows[:, start:end]):
+                file.write('>%s\n%s\n' % (seq_id, ''.join(row)))
+        r4s = Rate4Site(block, workdir=folder, tree=tree, optimize_branches=False,
+                        unnormalized='%s_block%i.orig' % (name, i), cache=False, **kw)
+        r4s.run()
+        orig = folder + os.sep + '%s_block%i.orig' % (name, i)
+        return Rate4Site.read_table(orig), r4s.alpha
+
+    with ThreadPoolExecutor(max_workers=jobs or len(ranges)) as executor:
+        results = list(executor.map(score_block, range(len(ranges))))
+
+    offset = 0
+    for table, alpha in results:
+        table['pos'] += offset
+        offset += len(table)
+    table = np.concatenate([table for table, alpha in results])
+    mean = table['score'].mean()
+    sd = table['score'].std() or 1.0
+    for column in ['score', 'qq_low', 'qq_high']:
+        table[column] = (table[column] - mean) / sd
+    table['std'] = table['std'] / sd
+    alpha = np.average([alpha for _, alpha in results], weights=[len(block) for block, _ in results])
+
+    merged = workdir + os.sep + '%s.res' % name
+    with open(merged, 'w') as file:
+        file.write('#Rates were calculated using the expectation of the posterior rate distribution\n'
+                   '#Merged from %i column blocks scored against the same tree with fixed branch lengths\n'
+                   '#Alpha below is the mean of the alphas of the blocks, and the scores are approximate\n\n'
+                   '#POS SEQ  SCORE    QQ-INTERVAL     STD      MSA DATA\n'
+                   '#The alpha parameter %g\n' % (len(ranges), alpha))
+        for r in table:
+            file.write('%5i     %s  %.4g   [%.4g, %.4g]   %.4g    %i/%i\n' % tuple(r))
+        file.write('\n#Average = 0\n#Standard Deviation = 1\n')
+    for i in range(len(ranges)):
+        t.tryRemove(workdir + os.sep + '%s_block%i' % (name, i), tree=True)
+    return merged
 
 class Rate4Site(Executor):
 
@@ -69,14 +487,33 @@ class Rate4Site(Executor):
     """
 
     def __init__(self, msa, cache=True, identity=True, score=True, qqint=False, std=False,
-                    gapped=False, **kw):
-
+                    gapped=False, workdir=None, tree=None, unnormalized=None, optimize_branches=True, **kw):
+        """
+        Args:
+            msa (str): The file path to the alignment
+            workdir (str): The folder in which rate4site is run and writes its output. Defaults
+            to the current working directory
+            tree (str): The file path to a tree of the sequences in newick format. If given, rate4site
+            uses it instead of building its own tree
+            optimize_branches (boolean): If false, rate4site keeps the branch lengths of the given tree
+            instead of optimizing them (-bn). Only used with a tree
+            unnormalized (str): The file name the unnormalized rates are written to. Defaults to
+            r4sOrig.res, which is deleted after the run
+        """
+        self.msa = os.path.abspath(msa)
         aln_file = os.path.basename(msa)
         self.dir_name = aln_file.split('.')[0]
-        super().__init__(name='rate4site', args='-s %s -o %s.res'% (msa, self.dir_name),
-                         catch_out=1, **kw)
+        workdir = os.path.abspath(workdir or os.getcwd())
+        args = '-s %s -o %s.res'% (os.path.abspath(msa), self.dir_name)
+        if tree:
+            args += ' -t %s' % os.path.abspath(tree)
+            if not optimize_branches:
+                args += ' -bn'
+        if unnormalized:
+            args += ' -y %s' % unnormalized
+        super().__init__(name='rate4site', args=args, catch_out=1, cwd=workdir, **kw)
         self.alpha = 0
-        self.cwd = os.getcwd()
+        self.cwd = workdir
         self.score_output = self.cwd + os.sep + '%s.res'% self.dir_name
         self.has_run = False
         self.cache = cache
@@ -85,6 +522,7 @@ class Rate4Site(Executor):
         self.qqint = qqint
         self.std = std
         self.gapped = gapped
+        self.parsed = None
 
     def run(self):
         """
@@ -95,19 +533,39 @@ the post execution methods on the cached files
             self.finish()
             return self.result
         else:
+            self.parsed = None
             return super().run()
 
 
     def finish(self):
         """
-        Overwrites Executor method. Called when the program is done executing.
+        Overwrites Executor method. Called when the program is done executing. The output is parsed
+        once into the Rate4SiteResult kept in the parsed field, and the result is its projection on
+        the information selected by the flags. Other information can be projected from parsed later.
         """
         super().finish()
-        self.alpha = self.get_alpha(self.score_output)
-        self.result = self.rate2dict(self.score_output, identity=self.identity, score=self.score,
-                                     qqint=self.qqint, std= self.std, gapped = self.gapped)
+        if self.parsed is None:
+            self.parsed = Rate4SiteResult.read(self.score_output, tree=self.cwd + os.sep + 'TheTree.txt',
+                                               msa=self.msa, args=self.args, run_time=self.runTime)
+        self.alpha = self.parsed.alpha
+        self.result = self.project()
         self.has_run = True
 
+    def project(self, identity=None, score=None, qqint=None, std=None, gapped=None):
+        """
+        Projects the parsed output on the selected information, without reading it again
+        Args:
+            The flags of rate2dict. Those not given default to the flags the instance was created with
+        Returns:
+            A dictionary in the layout of rate2dict
+        """
+        if self.parsed is None:
+            raise Rate4SiteError('Rate4Site has not been run')
+        flags = dict(identity=self.identity, score=self.score, qqint=self.qqint, std=self.std, gapped=self.gapped)
+        given = dict(identity=identity, score=score, qqint=qqint, std=std, gapped=gapped)
+        flags.update({name: value for name, value in given.items() if value is not None})
+        return self.parsed.to_dict(**flags)
+
     def isfailed(self):
         """
         Overwrites Executor method. Return True if the external program has finished
@@ -190,6 +648,52 @@ the post execution methods on the cached files
         parameter = re.findall(digits, string)
         return list(map(float, parameter))
 
+    @classmethod
+    def read_table(cls, r4s, columns=None):
+        """
+        Reads the residue table of a rate4site output file into a numpy structured array
+        Args:
+            r4s (str): The absolute filepath to the output file from the Rate4Site program, version 2.01
+            columns (list): The names of the fields to read, out of R4S_COLUMNS. Defaults to all of them:
+                pos: the position of the residue in the reference sequence, starting at 1
+                aa: the amino acid in the reference sequence, in one letter code
+                score: the conservation score. lower value = higher conservation
+                qq_low, qq_high: the bounds of the confidence interval of the score
+                std: the standard deviation of the posterior rate distribution
+                msa_count, msa_total: the number of aligned sequences having an amino acid (non-gapped) at the
+                    position, out of the overall number of sequences
+        Returns:
+            A structured array with one entry per residue of the reference sequence
+        """
+        if not os.path.isfile(r4s):
+            raise FileNotFoundError(r4s)
+        with open(r4s, 'r') as file:
+            return cls.parse_table(file.read(), columns=columns)
+
+    @classmethod
+    def parse_table(cls, contents, columns=None):
+        """
+        Reads the residue table of the contents of a rate4site output file, see read_table
+        Args:
+            contents (str or bytes): The contents of the output file
+            columns (list): The names of the fields to read, out of R4S_COLUMNS. Defaults to all of them
+        Returns:
+            A structured array with one entry per residue of the reference sequence
+        """
+        columns = columns or R4S_COLUMNS
+        if isinstance(contents, bytes):
+            contents = contents.decode('utf-8')
+        contents = contents.translate(R4S_SEPARATORS)
+        try:
+            with warnings.catch_warnings():
+                # An empty table is not an error
+                warnings.simplefilter('ignore', UserWarning)
+                return np.loadtxt(io.StringIO(contents), comments='#', ndmin=1,
+                                  dtype=[(c, R4S_DTYPE[c]) for c in columns],
+                                  usecols=[R4S_COLUMNS.index(c) for c in columns])
+        except ValueError:
+            raise Rate4SiteError('File format is not supported')
+
     @classmethod
     def rate2dict(cls, r4s, identity=True, score=True, qqint=False, std=False,
                   gapped=False):
@@ -211,47 +715,41 @@ the post execution methods on the cached files
             An array, where the entry at each index contains information about
             the amino acid at that position.
         """
-        # The document is parsed by pulling splitting the text from the output file
-        # using newlines as delimiters, and grabbing only the lines that do not start
-        # with a # symbol. Whats left are the rows of the table, where each row contains
-        # information about an amino acid. The rows are then split up depending on
-        # what information it carries.
-
+        # The table is read once by read_table, with only the requested columns converted,
+        # and the dictionary entries are zipped together from its columns.
         try:
-            if os.path.isfile(r4s):
-                with open(r4s, 'r') as file:
-                    contents = file.read()
-                residues = Rate4Site.extract_resi(contents)
-                r2dict = {}
-                i=0
-                for r in residues:
-                    r2mat = []
-                    aa_data = re.split(r'[\]\[\s,]', r)
-                    aa_data = list(filter(lambda x: x is not '', aa_data))
-                    if identity:
-                        amino = aa_data[1]
-                        r2mat.append(amino)
-                    if score:
-                        conse = float(aa_data[2])
-                        r2mat.append(conse)
-                    if qqint:
-                        intqq = (float(aa_data[3]), float(aa_data[4]))
-                        r2mat.append(intqq)
-                    if std:
-                        stdev = float(aa_data[5])
-                        r2mat.append(stdev)
-                    if gapped:
-                        align = aa_data[6]
-                        r2mat.append(align)
-                    r2mat = tuple(r2mat)
-                    r2dict[i] = r2mat
-                    i+=1
-                return r2dict
-            else:
-                raise FileNotFoundError
+            flags = [(identity, ['aa']), (score, ['score']), (qqint, ['qq_low', 'qq_high']), (std, ['std']),
+                     (gapped, ['msa_count', 'msa_total'])]
+            table = Rate4Site.read_table(r4s, columns=[c for flag, names in flags if flag for c in names])
+            return Rate4Site.table2dict(table, identity=identity, score=score, qqint=qqint, std=std, gapped=gapped)
         finally:
             warnings.warn("This method is especially susceptible to changes in the format of the output file", Warning)
 
+    @classmethod
+    def table2dict(cls, table, identity=True, score=True, qqint=False, std=False, gapped=False):
+        """
+        Maps the fields of a residue table onto each amino acid, in the layout of rate2dict
+        Args:
+            table (numpy.ndarray): The residue table, as returned by read_table. Only the fields of the
+            selected information are needed
+        Returns:
+            A dictionary mapping the index of every residue to a tuple of the selected information
+        """
+        fields = []
+        if identity:
+            fields.append(table['aa'].tolist())
+        if score:
+            fields.append(table['score'].tolist())
+        if qqint:
+            fields.append(zip(table['qq_low'].tolist(), table['qq_high'].tolist()))
+        if std:
+            fields.append(table['std'].tolist())
+        if gapped:
+            fields.append(['%i/%i' % n for n in zip(table['msa_count'].tolist(), table['msa_total'].tolist())])
+        if not fields:
+            return {i: () for i in range(len(table))}
+        return dict(enumerate(zip(*fields)))
+
     @classmethod
     def read2matrix(cls, r4s, identity=True, score=True, qqint=False, std=False,
                     gapped=False):
@@ -270,48 +768,31 @@ the post execution methods on the cached files
                 gapped(boolean): MSA DATA, the number of aligned sequences having an amino acid (non-gapped) from the overall
                     number of sequences at each position
         Returns:
-            An array, where the entry at each index contains information about
+            An array of strings, where the row at each index contains information about
             the amino acid at that position.
 
-        The document is parsed by pulling splitting the text from the output file
-        using newlines as delimiters, and grabbing only the lines that do not start
-        with a # symbol. Whats left are the rows of the table, where each row contains
-        information about an amino acid. The rows are then split up depending on
-        what information it carries.
+        The columns are views of the table of Rate4SiteResult, so the file is parsed once, by the same
+        parser as the other readers, and the numbers are written back as strings.
         """
         try:
-            if os.path.isfile(r4s):
-                with open(r4s, 'r') as file:
-                    contents = file.read()
-                residues = Rate4Site.extract_resi(contents)
-                func_args = [identity, score, qqint, std, gapped]
-                dimension = func_args.count(True)
-                r2mat = np.empty([1, dimension])
-                for r in residues:
-                    aa_data = re.split(r'[\]\[\s,]', r)
-                    aa_data = list(filter(lambda x: x is not '', aa_data))
-                    np_residues = np.array([])
-                    if identity:
-                        amino = aa_data[1]
-                        np_residues = np.append(np_residues, amino)
-                    if score:
-                        conse = aa_data[2]
-                        np_residues = np.append(np_residues, conse)
-                    if qqint:
-                        intqq = '[{0}, {1}]'.format(aa_data[3] , aa_data[4])
-                        np_residues = np.append(np_residues, intqq)
-                    if std:
-                        stdev = aa_data[5]
-                        np_residues = np.append(np_residues, stdev)
-                    if gapped:
-                        align = aa_data[6]
-                        np_residues = np.append(np_residues, align)
-                    np_residues = np_residues.reshape((1, dimension))
-                    r2mat = np.concatenate((r2mat, np_residues), axis=0)
-                r2mat = np.delete(r2mat, 0, axis=0)
-                return r2mat
-            else:
-                raise FileNotFoundError
+            table = Rate4SiteResult.read(r4s).table
+            text = lambda name: np.array([str(v) for v in table[name].tolist()], dtype=str)
+            fields = []
+            if identity:
+                fields.append(table['aa'])
+            if score:
+                fields.append(text('score'))
+            if qqint:
+                fields.append(np.array(['[%r, %r]' % q for q in zip(table['qq_low'].tolist(),
+                                                                    table['qq_high'].tolist())], dtype=str))
+            if std:
+                fields.append(text('std'))
+            if gapped:
+                fields.append(np.array(['%i/%i' % n for n in zip(table['msa_count'].tolist(),
+                                                                 table['msa_total'].tolist())], dtype=str))
+            if not fields:
+                return np.empty((len(table), 0), dtype=str)
+            return np.column_stack(fields)
         finally:
             warnings.warn("This method is especially susceptible to changes in the format of the output file", Warning)
 
@@ -329,7 +810,99 @@ the post execution methods on the cached files
         residues = []
         for s in splitted:
             #Remove comments and empty lines
-            if s is not '' and not s.startswith('#'):
+            if s != '' and not s.startswith('#'):
                 #Remove comments
                 residues.append(s)
         return residues
+
+
+#: The figures read from the comment lines of a rate4site output file into Rate4SiteResult.metadata
+R4S_METADATA = [('alpha', re.compile(r'^#The alpha parameter\s+(\S+)')),
+                ('log_likelihood', re.compile(r'^#LL=\s*(\S+)')),
+                ('average', re.compile(r'^#Average\s*=\s*(\S+)')),
+                ('standard_deviation', re.compile(r'^#Standard Deviation\s*=\s*(\S+)'))]
+
+class Rate4SiteResult:
+    """
+    The output of a Rate4Site run, parsed once: the full residue table, the alpha parameter, the
+    tree and the figures and settings of the run. Any information of the table can then be projected
+    onto the residues without reading the output again, see to_dict and columns.
+    """
+
+    def __init__(self, table, alpha=None, tree=None, metadata=None, comments=None):
+        """
+        Args:
+            table (numpy.ndarray): The residue table, with the fields of R4S_DTYPE
+            alpha (float): The alpha parameter of the gamma distribution of the rates. None if the output has none
+            tree (str): The tree the rates were computed on, in newick format, if it was kept
+            metadata (dict): The figures of the output, such as the log likelihood, and of the run
+            comments (list): The comment lines of the output, without the leading #
+        """
+        self.table = table
+        self.alpha = alpha
+        self.tree = tree
+        self.metadata = metadata or {}
+        self.comments = comments or []
+
+    @classmethod
+    def parse(cls, contents, tree=None, **metadata):
+        """
+        Args:
+            contents (str or bytes): The contents of a rate4site output file, or of a file with its layout
+            tree (str): The tree, in newick format
+            metadata: Added to the metadata read from the output
+        """
+        if isinstance(contents, bytes):
+            contents = contents.decode('utf-8')
+        comments = []
+        figures = {}
+        for line in contents.splitlines():
+            if not line.startswith('#'):
+                continue
+            comments.append(line[1:].strip())
+            for name, pattern in R4S_METADATA:
+                match = pattern.match(line)
+                if match:
+                    try:
+                        figures[name] = float(match.group(1))
+                    except ValueError:
+                        raise Rate4SiteError('File format is not supported')
+        figures.update(metadata)
+        return cls(Rate4Site.parse_table(contents), alpha=figures.get('alpha'), tree=tree, metadata=figures,
+                   comments=comments)
+
+    @classmethod
+    def read(cls, r4s, tree=None, **metadata):
+        """
+        Args:
+            r4s (str): The file path to the rate4site output
+            tree (str): The file path to the tree, in newick format. Ignored if it does not exist
+            metadata: Added to the metadata read from the output
+        """
+        with open(r4s, 'r') as file:
+            contents = file.read()
+        newick = None
+        if tree is not None and os.path.isfile(tree):
+            with open(tree, 'r') as file:
+                newick = file.read().strip()
+        return cls.parse(contents, tree=newick, **metadata)
+
+    def __len__(self):
+        return len(self.table)
+
+    def columns(self, *names):
+        """
+        Args:
+            names (str): Fields of the table, out of R4S_COLUMNS. Defaults to all of them
+        Returns:
+            A view of the table with only the given fields
+        """
+        return self.table[list(names)] if names else self.table
+
+    def to_dict(self, identity=True, score=True, qqint=False, std=False, gapped=False):
+        """
+        Returns:
+            A dictionary mapping the index of every residue to the selected information, in the layout
+            of Rate4Site.rate2dict
+        """
+        return Rate4Site.table2dict(self.table, identity=identity, score=score, qqint=qqint, std=std, gapped=gapped)
@@ -5,9 +5,14 @@ Created on Sun Jul  1 16:58:25 2018
 
 @author: suliat16
 """
+import io
 import os
+import shutil
+import tempfile
 import aminoCons as am
 import biskit.test
+import numpy as np
+from unittest.mock import patch, MagicMock
 
 class test_amino_conservation(biskit.test.BiskitTest):
 
@@ -53,6 +58,44 @@ class test_amino_conservation(biskit.test.BiskitTest):
         digit = am.Rate4Site.get_alpha(self.filepath + os.sep + 'multiFasta.res')
         self.assertEqual(digit, 2.83688)
     
+    def test_rate4site_result(self):
+        """Tests that the output is parsed once into the table, alpha, tree and figures of the run"""
+        directory = tempfile.mkdtemp()
+        try:
+            tree = directory + os.sep + 'TheTree.txt'
+            with open(tree, 'w') as file:
+                file.write('(AT1G01140.1:0.1,AT1G01140.2:0.2);\n')
+            result = am.Rate4SiteResult.read(self.filepath + os.sep + 'multiFasta.res', tree=tree, run_time=1.5)
+            self.assertEqual(result.alpha, 2.83688)
+            self.assertEqual(result.tree, '(AT1G01140.1:0.1,AT1G01140.2:0.2);')
+            self.assertEqual(result.metadata, {'alpha': 2.83688, 'log_likelihood': -46.7933, 'average': 0,
+                                               'standard_deviation': 1, 'run_time': 1.5})
+            self.assertTrue(result.comments[1].startswith('Prior distribution is Gamma'))
+            self.assertEqual(len(result), 8)
+            self.assertEqual(result.columns('aa', 'std').dtype.names, ('aa', 'std'))
+            self.assertEqual(result.to_dict(qqint=True, std=True),
+                             am.Rate4Site.rate2dict(self.filepath + os.sep + 'multiFasta.res', qqint=True, std=True))
+        finally:
+            shutil.rmtree(directory)
+
+    @patch('aminoCons.Executor.finish')
+    @patch('aminoCons.Executor.__init__', return_value=None)
+    def test_rate4site_project(self, mock_init, mock_finish):
+        """Tests that other information is projected from the parsed output without reading it again"""
+        directory = tempfile.mkdtemp()
+        try:
+            shutil.copy(self.filepath + os.sep + 'multiFasta.res', directory + os.sep + 'multiFasta.res')
+            r4s = am.Rate4Site(self.filepath + os.sep + 'multiFasta.aln', workdir=directory)
+            r4s.args, r4s.runTime = '-s multiFasta.aln', 0.5
+            r4s.finish()
+            self.assertEqual(r4s.result[7], ('T', -1.577))
+            self.assertEqual(r4s.alpha, 2.83688)
+            os.remove(directory + os.sep + 'multiFasta.res')
+            self.assertEqual(r4s.project(identity=False, gapped=True)[7], (-1.577, '3/3'))
+            self.assertEqual(r4s.parsed.metadata['msa'], self.filepath + os.sep + 'multiFasta.aln')
+        finally:
+            shutil.rmtree(directory)
+
     def test_get_alpha_nofile(self):
         """Test that an error is raised if a non-existent file is given to get_alpha"""
         with self.assertRaises(FileNotFoundError):
@@ -103,6 +146,167 @@ class test_amino_conservation(biskit.test.BiskitTest):
                            7:('T', (-3.889, -0.7852), 2.309, '3/3')}
         self.assertDictEqual(output, dictionary)
 
+    def test_read_table(self):
+        """Tests that read_table reads the residue table into a typed structured array"""
+        table = am.Rate4Site.read_table(self.filepath + os.sep + 'multiFasta.res')
+        self.assertEqual(list(table.dtype.names), am.R4S_COLUMNS)
+        self.assertEqual(len(table), 8)
+        self.assertEqual(table['pos'].tolist(), list(range(1, 9)))
+        self.assertEqual(table['aa'][6], 'T')
+        self.assertEqual(table['qq_high'][6], -0.7852)
+        self.assertEqual(table['msa_total'].dtype.kind, 'i')
+
+    def test_read_table_columns(self):
+        """Tests that read_table only returns the selected columns"""
+        table = am.Rate4Site.read_table(self.filepath + os.sep + 'multiFasta.res', columns=['score', 'std'])
+        self.assertEqual(table.dtype.names, ('score', 'std'))
+        self.assertEqual(table['std'].tolist()[4], 2.725)
+
+    def test_read_table_badfile(self):
+        """Tests that read_table raises an error on a file that is not a rate4site output"""
+        with self.assertRaises(am.Rate4SiteError):
+            am.Rate4Site.read_table(self.filepath + os.sep + 'Fak2Human.fasta')
+
+    def test_read2matrix(self):
+        """Tests that read2matrix returns a matrix of the selected fields as strings"""
+        output = am.Rate4Site.read2matrix(self.filepath + os.sep + 'multiFasta.res', qqint=True, gapped=True)
+        self.assertEqual(output.shape, (8, 4))
+        self.assertEqual(output[6].tolist(), ['T', '-1.577', '[-3.889, -0.7852]', '3/3'])
+        table = am.Rate4SiteResult.read(self.filepath + os.sep + 'multiFasta.res').table
+        self.assertEqual(output[:, 1].astype(float).tolist(), table['score'].tolist())
+
+    def test_split_columns(self):
+        """Tests that split_columns gives every block residues of the reference sequence"""
+        ids, rows = am.read_msa(self.filepath + os.sep + 'multiFasta.aln')
+        rows[0, 2:5] = '-'
+        self.assertEqual(am.split_columns(rows, 3), [(0, 5), (5, 7), (7, 8)])
+        self.assertEqual(am.split_columns(rows, 10), [(0, 1), (1, 5), (5, 6), (6, 7), (7, 8)])
+
+    def test_build_tree(self):
+        """Tests that build_tree writes a newick tree of all the sequences"""
+        directory = tempfile.mkdtemp()
+        try:
+            tree = am.build_tree(self.filepath + os.sep + 'multiFasta.aln', directory + os.sep + 'multiFasta.tree')
+            with open(tree) as file:
+                newick = file.read()
+            self.assertTrue(newick.strip().endswith(';'))
+            for seq_id in ['AT1G01140.1', 'AT1G01140.1_1', 'AT1G01140.2']:
+                self.assertTrue(seq_id + ':' in newick)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_neighbour_joining(self):
+        """Tests that neighbour joining recovers the branch lengths of a tree from its additive distances"""
+        from Bio import Phylo
+        # The distances between the leaves of ((s0:0.1,s1:0.2):0.3,(s2:0.1,s3:0.4):0.2,s4:0.5)
+        distances = np.array([[0.0, 0.3, 0.7, 1.0, 0.9], [0.3, 0.0, 0.8, 1.1, 1.0], [0.7, 0.8, 0.0, 0.5, 0.8],
+                              [1.0, 1.1, 0.5, 0.0, 1.1], [0.9, 1.0, 0.8, 1.1, 0.0]])
+        ids = ['s%i' % i for i in range(len(distances))]
+        tree = Phylo.read(io.StringIO(am.neighbour_joining(ids, distances)), 'newick')
+        for i in range(len(ids)):
+            for j in range(i):
+                self.assertAlmostEqual(tree.distance(ids[i], ids[j]), distances[i, j], places=4)
+        self.assertEqual(am.neighbour_joining(['a', 'b'], [[0, 0.4], [0.4, 0]]), '(a:0.20000,b:0.20000);')
+
+    def test_rate4site_blocks(self):
+        """Tests that the tables of the column blocks are merged and normalized in reference coordinates"""
+        def fake_init(r4s, msa, workdir=None, tree=None, unnormalized=None, optimize_branches=True, **kw):
+            r4s.msa, r4s.cwd, r4s.orig, r4s.alpha = msa, workdir, unnormalized, 2.0
+            self.assertTrue(os.path.isfile(tree))
+            self.assertFalse(optimize_branches)
+        def fake_run(r4s):
+            with open(r4s.msa) as file:
+                reference = file.read().split('>')[1].splitlines()[1].replace('-', '')
+            with open(r4s.cwd + os.sep + r4s.orig, 'w') as file:
+                for i, aa in enumerate(reference):
+                    file.write('%i %s %i [%i, %i] 1 3/3\n' % (i + 1, aa, 'ACGT'.index(aa), -1, 1))
+        directory = tempfile.mkdtemp()
+        try:
+            with patch.object(am.Rate4Site, '__init__', fake_init), patch.object(am.Rate4Site, 'run', fake_run):
+                merged = am.run_rate4site_blocks(self.filepath + os.sep + 'multiFasta.aln', 3, workdir=directory)
+            output = am.Rate4Site.rate2dict(merged, std=True)
+            self.assertEqual([output[i][0] for i in range(8)], list('AACCGGTT'))
+            scores = [output[i][1] for i in range(8)]
+            self.assertAlmostEqual(sum(scores), 0, places=3)
+            self.assertTrue(scores[0] < scores[2] < scores[4] < scores[6])
+            self.assertEqual(am.Rate4Site.get_alpha(merged), 2.0)
+            self.assertEqual(sorted(os.listdir(directory)), ['multiFasta.res', 'multiFasta.tree'])
+            with open(merged) as file:
+                contents = file.read()
+            aln = am.Alignment.read(self.filepath + os.sep + 'multiFasta.aln')
+            with patch.object(am.Rate4Site, '__init__', fake_init), patch.object(am.Rate4Site, 'run', fake_run), \
+                    patch.object(am.Alignment, 'read') as mock_read:
+                merged = am.run_rate4site_blocks(aln, 3, workdir=directory)
+            self.assertFalse(mock_read.called)
+            with open(merged) as file:
+                self.assertEqual(file.read(), contents)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_rate4site_blocks_ranking(self):
+        """Tests that the merged scores of the column blocks rank the residues like a run on the whole alignment"""
+        msa = self.filepath + os.sep + 'multiFasta.aln'
+        directory = tempfile.mkdtemp()
+        try:
+            whole = am.Rate4Site(msa, workdir=directory, cache=False)
+            whole.run()
+            merged = am.Rate4SiteResult.read(am.run_rate4site_blocks(msa, 2, workdir=directory))
+            ranks = [np.argsort(np.argsort(t['score'], kind='stable')) for t in (whole.parsed.table, merged.table)]
+            self.assertEqual(merged.table['aa'].tolist(), whole.parsed.table['aa'].tolist())
+            self.assertGreater(np.corrcoef(ranks)[0, 1], 0.8)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_aligner_commands(self):
+        """Tests that the aligners are run in clustal format with the thread count passed through"""
+        self.assertEqual(am.TCoffee.command('in.fasta', 'out.aln', threads=4),
+                         ['t_coffee', '-output', 'clustalw', '-infile', 'in.fasta', '-outfile', 'out.aln', '-n_core=4'])
+        self.assertEqual(am.Mafft.command('in.fasta', 'out.aln', threads=4)[-3:], ['--thread', '4', 'in.fasta'])
+        self.assertTrue('--clustalout' in am.Mafft.command('in.fasta', 'out.aln'))
+        self.assertTrue('--outfmt=clustal' in am.ClustalOmega.command('in.fasta', 'out.aln'))
+        self.assertFalse('--threads=4' in am.ClustalOmega.command('in.fasta', 'out.aln'))
+        self.assertTrue('-clw' in am.Muscle.command('in.fasta', 'out.aln', threads=4))
+
+    @patch('aminoCons.shutil.which')
+    def test_get_aligner_auto(self, mock_which):
+        """Tests that T-Coffee aligns small sets and the first installed fast aligner large ones"""
+        mock_which.side_effect = lambda exe: '/usr/bin/clustalo' if exe in ['clustalo', 'muscle'] else None
+        self.assertIs(am.get_aligner('auto', am.AUTO_TCOFFEE_MAX), am.TCoffee)
+        self.assertIs(am.get_aligner('auto', am.AUTO_TCOFFEE_MAX + 1), am.ClustalOmega)
+        self.assertIs(am.get_aligner('mafft', 1000), am.Mafft)
+        mock_which.side_effect = None
+        mock_which.return_value = None
+        self.assertIs(am.get_aligner('auto', 1000), am.TCoffee)
+        self.assertRaises(am.AlignerError, am.get_aligner, 'kalign')
+
+    @patch('aminoCons.subprocess.run')
+    def test_muscle_input_order(self, mock_run):
+        """Tests that the sequences reordered by muscle are put back in the order of the input"""
+        directory = tempfile.mkdtemp()
+        try:
+            outfile = directory + os.sep + 'multiFasta.aln'
+            def muscle(args, **kw):
+                with open(outfile, 'w') as file:
+                    file.write('CLUSTAL W (1.81) multiple sequence alignment\n\n'
+                               'AT1G01140.2     CCGGAATT\nAT1G01140.1     AACCGGTT\n'
+                               'AT1G01140.1_1   AACCGGTT\n')
+                return MagicMock(returncode=0)
+            mock_run.side_effect = muscle
+            infile = directory + os.sep + 'multiFasta.fasta'
+            with open(infile, 'w') as file:
+                file.write('>AT1G01140.1\nAACCGGTT\n>AT1G01140.1_1\nAACCGGTT\n>AT1G01140.2\nCCGGAATT\n')
+            aln = am.build_alignment(infile, workdir=directory, aligner='muscle')
+            self.assertEqual(am.read_msa(aln)[0], ['AT1G01140.1', 'AT1G01140.1_1', 'AT1G01140.2'])
+        finally:
+            shutil.rmtree(directory)
+
+    @patch('aminoCons.subprocess.run')
+    def test_aligner_failure(self, mock_run):
+        """Tests that an aligner exiting with an error raises an AlignerError"""
+        mock_run.return_value = MagicMock(returncode=1, stderr=b'bad input')
+        self.assertRaises(am.AlignerError, am.build_alignment, self.filepath + os.sep + 'multiFasta.fasta',
+                          workdir=tempfile.gettempdir(), aligner='clustalo')
+
     def test_r4s_close(self):
         """Tests to see that close deletes the correct files"""
         r4sobject = am.Rate4Site(self.filepath + os.sep + 'multiFasta.aln')
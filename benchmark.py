@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Offline benchmarks of the parsing and orchestration hot paths of the pipeline, run on the files of
+example_data scaled up into large synthetic inputs. OMA is replaced by omastub.StubAdapter and the
+alignment and Rate4Site programs by stand-ins that copy prepared outputs, so the benchmarks need
+neither network access nor the external programs.
+
+Every benchmark reports its best time out of several runs, its throughput and the peak memory
+allocated by Python while it runs. Times are also given relative to a fixed pure Python workload
+timed on the same machine, so that a baseline saved on one machine can be checked on another.
+The startup benchmark times importing seq2conservation in a fresh interpreter, and the check also
+fails if the import loads one of the DEFERRED_MODULES. Most of that time is the import of the biskit
+package, which every module needs for BiskitError and aminoCons for the Executor of Rate4Site, and
+which cannot be deferred: startup_biskit times it alone, and its share of the startup is printed and
+kept in the baseline, so that it is not mistaken for a cost the lazy imports could remove.
+
+    python benchmark.py --save        # stores the results as the baseline
+    python benchmark.py               # fails if a benchmark is slower or larger than the baseline
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import warnings
+from collections import namedtuple
+from unittest.mock import patch
+import numpy as np
+import alignment
+import aminoCons
+import oma
+import omastub
+import seq2conservation
+
+EXAMPLE_DATA = os.path.dirname(os.path.abspath(__file__)) + os.sep + 'example_data'
+#: The modules that importing the pipeline must leave to the stages that use them, see lazyimport
+DEFERRED_MODULES = ['requests', 'Bio', 'asyncio', 'multiprocessing']
+BASELINE = os.path.dirname(os.path.abspath(__file__)) + os.sep + 'benchmark_baseline.json'
+
+Benchmark = namedtuple('Benchmark', ['name', 'unit', 'run'])
+Benchmark.__doc__ = """
+A benchmark. run is called with the synthetic inputs and returns the number of units it processed.
+"""
+
+Result = namedtuple('Result', ['name', 'seconds', 'relative', 'throughput', 'unit', 'peak_mb'])
+
+
+def calibrate(repeat=5):
+    """
+    Times a fixed pure Python workload, as the unit of the relative times
+    Returns:
+        The best time of the workload, in seconds
+    """
+    def workload():
+        table = {}
+        for i in range(200000):
+            table[str(i)] = i * i
+        return sum(len(k) for k in table)
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        workload()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def synthetic_fasta(proteins):
+    """
+    Returns:
+        A fasta string of the given number of proteins, made of copies of the HOG in example_data
+        with unique ids
+    """
+    with open(EXAMPLE_DATA + os.sep + 'ATN1_HOGS.txt', 'r') as file:
+        blocks = oma.OrthologFinder.indv_block(file.read())
+    copies = []
+    for i in range(proteins):
+        block = blocks[i % len(blocks)]
+        copies.append('>BENCH%06i%s' % (i, block[block.index(' '):]) + os.linesep)
+    return ''.join(copies)
+
+
+def synthetic_rate4site(path, residues):
+    """
+    Writes a Rate4Site output file with the given number of residues, repeating the rows of the
+    output in example_data
+    """
+    table = aminoCons.Rate4Site.read_table(EXAMPLE_DATA + os.sep + 'multiFasta.res')
+    with open(path, 'w') as file:
+        file.write('#Rates were calculated using the expectation of the posterior rate distribution\n\n'
+                   '#POS SEQ  SCORE    QQ-INTERVAL     STD      MSA DATA\n'
+                   '#The alpha parameter 2.83688\n')
+        for i in range(residues):
+            row = table[i % len(table)]
+            file.write('%5i     %s  %.4g   [%.4g, %.4g]   %.4g    %i/%i\n' %
+                       ((i + 1,) + tuple(row)[1:]))
+    return path
+
+
+def synthetic_alignment(sequences, columns=800, seed=0):
+    """
+    Returns:
+        An alignment.Alignment of the given number of sequences, made of random substitutions and gaps
+        of a random ancestor
+    """
+    rng = np.random.RandomState(seed)
+    ancestor = rng.randint(0, 20, columns)
+    codes = np.where(rng.rand(sequences, columns) < 0.3, rng.randint(0, 21, (sequences, columns)), ancestor)
+    letters = np.frombuffer(b'ACDEFGHIKLMNPQRSTVWY-', dtype=np.uint8)[codes]
+    return alignment.Alignment(['BENCH%06i' % i for i in range(sequences)], letters)
+
+
+class Inputs:
+    """
+    The synthetic inputs of the benchmarks, written to a temporary folder
+    """
+
+    def __init__(self, scale=1):
+        self.folder = tempfile.mkdtemp(prefix='benchmark_')
+        self.fasta = synthetic_fasta(2000 * scale)
+        self.res = synthetic_rate4site(self.folder + os.sep + 'long.res', 20000 * scale)
+        with open(self.res, 'r') as file:
+            self.res_text = file.read()
+        self.hogs = synthetic_fasta(5000 * scale).encode('utf-8')
+        self.pipe_res = synthetic_rate4site(self.folder + os.sep + 'pipe.res', 1000)
+        self.tree_aln = synthetic_alignment(400 * scale)
+        self.session = oma.OMASession()
+        self.session.mount(oma.OrthologFinder.OMA_BASE_URL,
+                           omastub.StubAdapter(omastub.oma_routes('BENCH000003', 'Mammalia', self.hogs)))
+
+    def close(self):
+        self.session.close()
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+
+def bench_indv_block(inputs):
+    return len(oma.OrthologFinder.indv_block(inputs.fasta))
+
+
+def bench_remove_protein(inputs):
+    oma.OrthologFinder.remove_protein(inputs.fasta, 'BENCH000003')
+    return inputs.fasta.count('>')
+
+
+def bench_rate2dict(inputs):
+    return len(aminoCons.Rate4Site.rate2dict(inputs.res, qqint=True, std=True, gapped=True))
+
+
+def bench_read2matrix(inputs):
+    return len(aminoCons.Rate4Site.read2matrix(inputs.res, qqint=True, std=True, gapped=True))
+
+
+def bench_extract_resi(inputs):
+    return len(aminoCons.Rate4Site.extract_resi(inputs.res_text))
+
+
+def bench_build_tree(inputs):
+    aminoCons.build_tree(inputs.tree_aln, inputs.folder + os.sep + 'guide.tree')
+    return len(inputs.tree_aln)
+
+
+def bench_hog_download(inputs):
+    finder = oma.OrthologFinder('MKTRQNKDSMSMRSGRKKEAPG', session=inputs.session)
+    finder.get_HOGs(path=inputs.folder + os.sep + 'hogs.orth')
+    return finder.downloaded
+
+
+class StandInRate4Site(aminoCons.Rate4Site):
+    """
+    Replaces the Rate4Site program by a copy of a prepared output file
+    """
+
+    output = None
+
+    def __init__(self, msa, workdir=None, **kw):
+        self.options = kw
+        self.score_output = workdir + os.sep + '%s.res' % os.path.basename(msa).split('.')[0]
+        self.alpha = 0
+
+    def run(self):
+        shutil.copyfile(self.output, self.score_output)
+        self.alpha = self.get_alpha(self.score_output)
+        return self.rate2dict(self.score_output, identity=self.options.get('identity', True),
+                              score=self.options.get('score', True))
+
+    def close(self):
+        os.remove(self.score_output)
+
+
+def bench_pipe(inputs):
+    def build_alignment(orthologs, workdir=None, **kw):
+        aln = workdir + os.sep + os.path.basename(orthologs).split('.')[0] + '.aln'
+        shutil.copyfile(EXAMPLE_DATA + os.sep + 'multiFasta.aln', aln)
+        return aln
+    StandInRate4Site.output = inputs.pipe_res
+    directory = inputs.folder + os.sep + 'pipes'
+    with patch('aminoCons.build_alignment', build_alignment), patch('aminoCons.Rate4Site', StandInRate4Site):
+        for i in range(20):
+            pipe = seq2conservation.ConservationPipe('MKTRQNKDSMSMRSGRKKEAPG', name='bench%i' % i, cache=False,
+                                                     directory=directory, session=inputs.session,
+                                                     max_sequences=200, keep_table=True)
+            pipe.pipe()
+    return 20
+
+
+def import_fresh(module='seq2conservation'):
+    """
+    Imports a module in a fresh interpreter, as a short lived worker does
+    Returns:
+        The names of the DEFERRED_MODULES that the import loaded
+    """
+    code = 'import sys, %s; print(" ".join(m for m in %r if m in sys.modules))' % (module, DEFERRED_MODULES)
+    output = subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                            check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    return output.split()
+
+
+def bench_startup(inputs):
+    import_fresh()
+    return 1
+
+
+def bench_startup_biskit(inputs):
+    import_fresh('biskit.errors')
+    return 1
+
+
+def startup_share(results):
+    """
+    Returns:
+        The share of the startup time taken by importing biskit, or None if either was not measured
+    """
+    seconds = {r.name: r.seconds for r in results}
+    if 'startup' not in seconds or 'startup_biskit' not in seconds:
+        return None
+    return min(seconds['startup_biskit'] / seconds['startup'], 1.0)
+
+
+BENCHMARKS = [
+    Benchmark('indv_block', 'proteins', bench_indv_block),
+    Benchmark('remove_protein', 'proteins', bench_remove_protein),
+    Benchmark('rate2dict', 'residues', bench_rate2dict),
+    Benchmark('read2matrix', 'residues', bench_read2matrix),
+    Benchmark('extract_resi', 'residues', bench_extract_resi),
+    Benchmark('build_tree', 'sequences', bench_build_tree),
+    Benchmark('hog_download', 'bytes', bench_hog_download),
+    Benchmark('pipe', 'pipes', bench_pipe),
+    Benchmark('startup', 'imports', bench_startup),
+    Benchmark('startup_biskit', 'imports', bench_startup_biskit),
+]
+
+
+def measure(benchmark, inputs, repeat=3, unit_time=1.0):
+    """
+    Runs a benchmark repeat times for its best time, then once more under tracemalloc for its memory
+    Returns:
+        A Result
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        count = benchmark.run(inputs)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    try:
+        benchmark.run(inputs)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return Result(benchmark.name, best, best / unit_time, count / best, benchmark.unit, peak / 1024 ** 2)
+
+
+def compare(results, baseline, tolerance=1.5, memory_tolerance=1.25):
+    """
+    Compares results to a baseline
+    Args:
+        results(list): The Results of the benchmarks
+        baseline(dict): The baseline, as saved by save_baseline
+        tolerance(float): The factor by which a relative time may exceed the baseline
+        memory_tolerance(float): The factor by which the peak memory may exceed the baseline
+    Returns:
+        The list of the regressions, as messages
+    """
+    regressions = []
+    for result in results:
+        base = baseline.get('benchmarks', {}).get(result.name)
+        if base is None:
+            continue
+        if result.relative > base['relative'] * tolerance:
+            regressions.append('%s: %.2fx slower than the baseline' % (result.name, result.relative / base['relative']))
+        # Allocations too small to matter are not compared
+        if result.peak_mb > max(base['peak_mb'], 1.0) * memory_tolerance:
+            regressions.append('%s: %.1f MB peak memory, %.1f MB in the baseline' % (result.name, result.peak_mb,
+                                                                                   base['peak_mb']))
+    return regressions
+
+
+def save_baseline(results, path, unit_time, scale):
+    with open(path, 'w') as file:
+        json.dump({'unit_time': unit_time, 'scale': scale, 'python': sys.version.split()[0],
+                   'startup_biskit_share': startup_share(results),
+                   'benchmarks': {r.name: {'seconds': r.seconds, 'relative': r.relative, 'peak_mb': r.peak_mb}
+                                  for r in results}}, file, indent=1, sort_keys=True)
+        file.write('\n')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks the parsing and orchestration of the pipeline')
+    parser.add_argument('--baseline', default=BASELINE, help='The baseline file')
+    parser.add_argument('--save', action='store_true', help='Saves the results as the baseline instead of checking them')
+    parser.add_argument('--tolerance', type=float, default=1.5,
+                        help='The factor by which a benchmark may be slower than the baseline')
+    parser.add_argument('--memory-tolerance', type=float, default=1.25,
+                        help='The factor by which the peak memory of a benchmark may exceed the baseline')
+    parser.add_argument('--repeat', type=int, default=3, help='The number of timed runs of every benchmark')
+    parser.add_argument('--scale', type=int, default=1, help='Multiplies the size of the synthetic inputs')
+    parser.add_argument('--only', nargs='+', help='The names of the benchmarks to run')
+    args = parser.parse_args(argv)
+
+    # The parsers warn on every call that they depend on the format of Rate4Site's output
+    warnings.simplefilter('ignore')
+    unit_time = calibrate()
+    inputs = Inputs(args.scale)
+    try:
+        results = []
+        for benchmark in BENCHMARKS:
+            if args.only and benchmark.name not in args.only:
+                continue
+            result = measure(benchmark, inputs, repeat=args.repeat, unit_time=unit_time)
+            results.append(result)
+            print('%-15s %9.4f s %8.2f units %12.0f %s/s %8.1f MB' % (result.name, result.seconds, result.relative,
+                                                                     result.throughput, result.unit, result.peak_mb))
+    finally:
+        inputs.close()
+    share = startup_share(results)
+    if share is not None:
+        print('%.0f%% of the startup is the import of biskit, which the modules need when they are loaded' % (100 * share))
+
+    if args.save:
+        save_baseline(results, args.baseline, unit_time, args.scale)
+        print('Saved the baseline to %s' % args.baseline)
+        return 0
+    if not os.path.isfile(args.baseline):
+        print('No baseline at %s, run with --save to create one' % args.baseline)
+        return 0
+    with open(args.baseline, 'r') as file:
+        baseline = json.load(file)
+    if baseline.get('scale') != args.scale:
+        print('The baseline was saved with --scale %s, not compared' % baseline.get('scale'))
+        return 0
+    regressions = compare(results, baseline, args.tolerance, args.memory_tolerance)
+    if any(r.name == 'startup' for r in results):
+        regressions.extend('startup: importing seq2conservation loads %s' % m for m in import_fresh())
+    for regression in regressions:
+        print('REGRESSION ' + regression)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
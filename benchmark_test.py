@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Test file for the benchmark suite
+"""
+import biskit.test
+import benchmark
+import omastub
+
+
+class TestBenchmark(biskit.test.BiskitTest):
+    """
+    Test suite testing the regression checks of the benchmarks
+    """
+
+    TAGS = [biskit.test.NORMAL]
+
+    BASELINE = {'benchmarks': {'rate2dict': {'seconds': 0.03, 'relative': 0.3, 'peak_mb': 8.0},
+                               'pipe': {'seconds': 2.0, 'relative': 20.0, 'peak_mb': 0.2}}}
+
+    def result(self, name, relative, peak_mb):
+        return benchmark.Result(name, relative / 10, relative, 1000, 'residues', peak_mb)
+
+    def test_compare(self):
+        """tests that only the benchmarks slower or larger than the tolerance are regressions"""
+        results = [self.result('rate2dict', 0.4, 9.0), self.result('pipe', 35.0, 1.1), self.result('new', 1.0, 1.0)]
+        regressions = benchmark.compare(results, self.BASELINE, tolerance=1.5, memory_tolerance=1.25)
+        self.assertEqual(regressions, ['pipe: 1.75x slower than the baseline'])
+        regressions = benchmark.compare([self.result('rate2dict', 0.3, 11.0)], self.BASELINE)
+        self.assertEqual(len(regressions), 1)
+        self.assertTrue(regressions[0].startswith('rate2dict: 11.0 MB'))
+
+    def test_synthetic_inputs(self):
+        """tests that the synthetic inputs have the requested size and are read by the pipeline"""
+        inputs = benchmark.Inputs()
+        try:
+            self.assertEqual(benchmark.bench_indv_block(inputs), 2000)
+            self.assertEqual(benchmark.bench_rate2dict(inputs), 20000)
+            self.assertEqual(benchmark.bench_build_tree(inputs), 400)
+            # The HOG and the two json queries before it
+            routes = omastub.oma_routes('BENCH000003', 'Mammalia', inputs.hogs)
+            expected = len(inputs.hogs) + len(routes['/api/sequence/']) + len(routes['/api/hog/BENCH000003/'])
+            self.assertEqual(benchmark.bench_hog_download(inputs), expected)
+        finally:
+            inputs.close()
+
+    def test_startup_share(self):
+        """tests that the share of the startup taken by biskit is given only when both imports were timed"""
+        results = [self.result('startup', 4.0, 0.1), self.result('startup_biskit', 3.0, 0.1)]
+        self.assertAlmostEqual(benchmark.startup_share(results), 0.75)
+        self.assertIsNone(benchmark.startup_share(results[:1]))
+
+    def test_startup_imports(self):
+        """tests that importing the pipeline leaves requests, Biopython and asyncio to the stages using them"""
+        self.assertEqual(benchmark.import_fresh(), [])
+        self.assertEqual(benchmark.import_fresh('oma'), [])
+
+
+if __name__ == '__main__':
+    biskit.test.localTest()
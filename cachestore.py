@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Persistent key-value cache on disk, used to keep the results of expensive steps of the
+pipeline (such as database queries) between runs and processes.
+
+The cache is a single SQLite file. Entries expire after a time to live, and when the cache
+grows larger than its maximum size the least recently used entries are evicted first.
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from biskit.errors import BiskitError
+
+class CacheError(BiskitError):
+    pass
+
+def hash_key(*parts):
+    """
+    Builds a fixed length key out of any number of strings, so that long parameters such as
+    protein sequences can be used as part of a cache key
+    Args:
+        parts(str): The parameters identifying the cached value
+    Returns:
+        The hex digest of the sha256 hash of the parameters
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode('utf-8')
+        digest.update(part)
+        digest.update(b'\x1f')
+    return digest.hexdigest()
+
+def normalize_fasta(fasta):
+    """
+    Brings a fasta string to a canonical form, so that the same sequences give the same hash
+    regardless of line wrapping, surrounding whitespace or the case of the residues
+    Args:
+        fasta(str): The sequences in fasta format
+    Returns:
+        The fasta string with one header line and one sequence line per protein
+    """
+    lines = []
+    sequence = []
+    for line in fasta.splitlines():
+        line = line.strip()
+        if line.startswith('>'):
+            if sequence:
+                lines.append(''.join(sequence).upper())
+                sequence = []
+            lines.append(line)
+        elif line:
+            sequence.append(line)
+    if sequence:
+        lines.append(''.join(sequence).upper())
+    return '\n'.join(lines) + '\n'
+
+
+class DiskCache:
+    """
+    A persistent cache of byte strings. Safe to share between threads, and between processes
+    opening the same file. Keeps count of the number of hits and misses of this instance.
+    """
+
+    def __init__(self, path, ttl=30 * 24 * 3600, max_size=1024 ** 3):
+        """
+        Args:
+            path(str): The file path of the cache database. Created if it does not exist
+            ttl(float): The number of seconds an entry stays valid. None keeps entries forever
+            max_size(int): The maximum total size of the cached values, in bytes. None for no limit
+        """
+        self.path = os.path.abspath(path)
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = None
+
+    @property
+    def db(self):
+        if self._db is None:
+            directory = os.path.dirname(self.path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            self._db = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+            self._db.execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value BLOB, '
+                             'size INTEGER, created REAL, accessed REAL)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS accessed_index ON entries (accessed)')
+            self._db.commit()
+        return self._db
+
+    def __getstate__(self):
+        # The connection cannot be sent to another process, it is reopened on first use
+        state = self.__dict__.copy()
+        state['_db'] = None
+        state['_lock'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Args:
+            key(str): The key of the entry
+        Returns:
+            The cached bytes, or None if the key is not cached or has expired
+        """
+        now = time.time()
+        with self._lock:
+            row = self.db.execute('SELECT value, created FROM entries WHERE key = ?', (key,)).fetchone()
+            if row is not None and self.ttl is not None and now - row[1] > self.ttl:
+                self.db.execute('DELETE FROM entries WHERE key = ?', (key,))
+                self.db.commit()
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self.db.execute('UPDATE entries SET accessed = ? WHERE key = ?', (now, key))
+            self.db.commit()
+            self.hits += 1
+            return bytes(row[0])
+
+    def put(self, key, value):
+        """
+        Stores a value, replacing any previous value of the key, then evicts the least recently
+        used entries if the cache has grown larger than its maximum size
+        Args:
+            key(str): The key of the entry
+            value(bytes): The value to store
+        """
+        if isinstance(value, str):
+            value = value.encode('utf-8')
+        if self.max_size is not None and len(value) > self.max_size:
+            raise CacheError('Value of %i bytes does not fit in a cache of %i bytes' % (len(value), self.max_size))
+        now = time.time()
+        with self._lock:
+            self.db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)',
+                            (key, sqlite3.Binary(value), len(value), now, now))
+            self._evict()
+            self.db.commit()
+
+    def _evict(self):
+        if self.max_size is None:
+            return
+        total = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+        if total <= self.max_size:
+            return
+        rows = self.db.execute('SELECT key, size FROM entries ORDER BY accessed ASC')
+        remove = []
+        for key, size in rows:
+            if total <= self.max_size:
+                break
+            remove.append((key,))
+            total -= size
+        self.db.executemany('DELETE FROM entries WHERE key = ?', remove)
+
+    def __len__(self):
+        with self._lock:
+            return self.db.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+
+    def size(self):
+        """
+        Returns:
+            The total size of the cached values, in bytes
+        """
+        with self._lock:
+            return self.db.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+
+    def stats(self):
+        """
+        Returns:
+            A dictionary with the number of hits and misses of this instance, and the number of
+            entries and total size of the cache
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self), 'size': self.size()}
+
+    def clear(self):
+        """
+        Removes every entry of the cache
+        """
+        with self._lock:
+            self.db.execute('DELETE FROM entries')
+            self.db.commit()
+
+    def close(self):
+        """
+        Closes the database connection. The cache is reopened if it is used again.
+        """
+        if self._db is not None:
+            self._db.close()
+            self._db = None
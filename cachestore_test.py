@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Test file for the cachestore module
+"""
+import biskit.test
+import os
+import shutil
+import tempfile
+import cachestore
+from unittest.mock import patch
+
+
+class TestDiskCache(biskit.test.BiskitTest):
+    """
+    Test suite testing the behaviour of the persistent cache
+    """
+
+    TAGS = [biskit.test.NORMAL]
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = self.directory + os.sep + 'cache.sqlite'
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_persists(self):
+        """tests that values stored by one cache instance are read by another"""
+        cache = cachestore.DiskCache(self.path)
+        cache.put('key', b'value')
+        cache.close()
+        other = cachestore.DiskCache(self.path)
+        self.assertEqual(other.get('key'), b'value')
+        other.close()
+
+    def test_hits_and_misses(self):
+        """tests that the cache counts hits and misses"""
+        cache = cachestore.DiskCache(self.path)
+        cache.put('key', 'value')
+        cache.get('key')
+        cache.get('missing')
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['entries'], stats['size']), (1, 1, 1, 5))
+        cache.close()
+
+    @patch('cachestore.time.time')
+    def test_ttl(self, mock_time):
+        """tests that expired entries are dropped"""
+        mock_time.return_value = 1000.0
+        cache = cachestore.DiskCache(self.path, ttl=10)
+        cache.put('key', b'value')
+        mock_time.return_value = 1005.0
+        self.assertEqual(cache.get('key'), b'value')
+        mock_time.return_value = 1011.0
+        self.assertIsNone(cache.get('key'))
+        self.assertEqual(len(cache), 0)
+        cache.close()
+
+    @patch('cachestore.time.time')
+    def test_lru_eviction(self, mock_time):
+        """tests that the least recently used entries are evicted when the cache is full"""
+        cache = cachestore.DiskCache(self.path, max_size=10)
+        for now, key in enumerate(['a', 'b']):
+            mock_time.return_value = float(now)
+            cache.put(key, b'1234')
+        mock_time.return_value = 2.0
+        cache.get('a')
+        mock_time.return_value = 3.0
+        cache.put('c', b'1234')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), b'1234')
+        self.assertEqual(cache.get('c'), b'1234')
+        cache.close()
+
+    def test_too_large(self):
+        """tests that a value larger than the cache raises an error"""
+        cache = cachestore.DiskCache(self.path, max_size=3)
+        with self.assertRaises(cachestore.CacheError):
+            cache.put('key', b'value')
+        cache.close()
+
+    def test_hash_key(self):
+        """tests that hash_key separates its parts"""
+        self.assertNotEqual(cachestore.hash_key('ab', 'c'), cachestore.hash_key('a', 'bc'))
+        self.assertEqual(cachestore.hash_key('ab', 'c'), cachestore.hash_key('ab', 'c'))
+
+if __name__ == '__main__':
+    biskit.test.localTest()
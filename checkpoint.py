@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Checkpoints of the stages of the pipeline, so that a run that was interrupted or failed can be
+resumed from its last finished stage instead of from scratch.
+
+The checkpoints of a run are kept in a folder, with a manifest listing every finished stage, the
+key of its inputs and parameters, and the file (and data) it produced. A stage is skipped on a rerun
+only if its key is unchanged. Files and the manifest are written to a temporary file first and then
+renamed, so that a run stopped at any point never leaves a partial checkpoint behind.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from biskit.errors import BiskitError
+
+class CheckpointError(BiskitError):
+    pass
+
+MANIFEST = 'manifest.json'
+
+def file_hash(path, chunk_size=1024 * 1024):
+    """
+    Returns:
+        The hex digest of the sha256 hash of the contents of a file, read in chunks
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Checkpoints:
+    """
+    The checkpoints of the stages of one run, kept in a folder with a manifest
+    """
+
+    def __init__(self, folder):
+        """
+        Args:
+            folder(str): The folder of the checkpoints. Created on the first checkpoint
+        """
+        self.folder = os.path.abspath(folder)
+        self.manifest = self.read_manifest()
+
+    def read_manifest(self):
+        """
+        Returns:
+            The dictionary of the finished stages, empty if there is no manifest yet
+        """
+        try:
+            with open(self.folder + os.sep + MANIFEST, 'r') as file:
+                manifest = json.load(file)
+        except FileNotFoundError:
+            return {}
+        except ValueError as e:
+            raise CheckpointError('The manifest of %s is corrupt: %s' % (self.folder, e))
+        return manifest.get('stages', {})
+
+    def write_manifest(self):
+        self._write(self.folder + os.sep + MANIFEST, json.dumps({'stages': self.manifest}, indent=1).encode('utf-8'))
+
+    def _write(self, path, content):
+        os.makedirs(self.folder, exist_ok=True)
+        handle, temp = tempfile.mkstemp(dir=self.folder, prefix='.tmp_')
+        try:
+            with os.fdopen(handle, 'wb') as file:
+                file.write(content)
+            os.replace(temp, path)
+        except BaseException:
+            os.remove(temp)
+            raise
+
+    def get(self, stage, key):
+        """
+        Args:
+            stage(str): The name of the stage
+            key(str): The key of the inputs and parameters of the stage
+        Returns:
+            The manifest entry of the stage, with the path of its file and its data, or None if the
+            stage has not finished with the same key
+        """
+        entry = self.manifest.get(stage)
+        if entry is None or entry['key'] != key:
+            return None
+        if entry.get('file') is not None and not os.path.isfile(self.path(stage)):
+            return None
+        return entry
+
+    def path(self, stage):
+        """
+        Returns:
+            The path of the checkpointed file of a stage
+        """
+        return self.folder + os.sep + self.manifest[stage]['file']
+
+    def restore(self, stage, destination):
+        """
+        Copies the checkpointed file of a stage, so that later stages can change it
+        Returns:
+            The destination path
+        """
+        shutil.copyfile(self.path(stage), destination)
+        return destination
+
+    def put(self, stage, key, path=None, data=None):
+        """
+        Records a finished stage. Stages recorded after it are dropped from the manifest, as they
+        were run from different inputs
+        Args:
+            stage(str): The name of the stage
+            key(str): The key of the inputs and parameters of the stage
+            path(str): The file produced by the stage, which is copied to the checkpoint folder
+            data: Any other result of the stage that can be written as json
+        """
+        entry = {'key': key, 'file': None, 'data': data}
+        if path is not None:
+            entry['file'] = '%s_%s' % (stage, os.path.basename(path))
+            with open(path, 'rb') as file:
+                self._write(self.folder + os.sep + entry['file'], file.read())
+        stages = list(self.manifest)
+        if stage in stages:
+            for later in stages[stages.index(stage) + 1:]:
+                self.manifest.pop(later)
+        self.manifest[stage] = entry
+        self.write_manifest()
+
+    def clear(self):
+        """
+        Removes the checkpoint folder
+        """
+        shutil.rmtree(self.folder, ignore_errors=True)
+        self.manifest = {}
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Test file for the checkpoint module
+"""
+import biskit.test
+import os
+import shutil
+import tempfile
+import checkpoint
+
+
+class TestCheckpoint(biskit.test.BiskitTest):
+    """
+    Test suite testing the checkpoints of the pipeline stages
+    """
+
+    TAGS = [biskit.test.NORMAL]
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.folder = self.directory + os.sep + 'protein.checkpoint'
+        self.orth = self.directory + os.sep + 'protein.orth'
+        with open(self.orth, 'w') as file:
+            file.write('>query\nMKTRQNKDSM\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_put_get(self):
+        """tests that a stage is found by a new instance only with the same key"""
+        checkpoint.Checkpoints(self.folder).put('orthologs', 'key1', self.orth, data={'count': 1})
+        os.remove(self.orth)
+        checkpoints = checkpoint.Checkpoints(self.folder)
+        self.assertIsNone(checkpoints.get('orthologs', 'key2'))
+        self.assertIsNone(checkpoints.get('alignment', 'key1'))
+        entry = checkpoints.get('orthologs', 'key1')
+        self.assertEqual(entry['data'], {'count': 1})
+        checkpoints.restore('orthologs', self.orth)
+        with open(self.orth) as file:
+            self.assertEqual(file.read(), '>query\nMKTRQNKDSM\n')
+
+    def test_missing_file(self):
+        """tests that a stage whose file was deleted has to run again"""
+        checkpoints = checkpoint.Checkpoints(self.folder)
+        checkpoints.put('orthologs', 'key1', self.orth)
+        os.remove(checkpoints.path('orthologs'))
+        self.assertIsNone(checkpoints.get('orthologs', 'key1'))
+
+    def test_later_stages_dropped(self):
+        """tests that rerunning a stage drops the checkpoints of the stages after it"""
+        checkpoints = checkpoint.Checkpoints(self.folder)
+        checkpoints.put('orthologs', 'key1', self.orth)
+        checkpoints.put('alignment', 'key2', self.orth)
+        checkpoints.put('scores', 'key3', data={'alpha': 1.0})
+        checkpoints.put('alignment', 'key4', self.orth)
+        self.assertEqual(list(checkpoint.Checkpoints(self.folder).manifest), ['orthologs', 'alignment'])
+        self.assertEqual([f for f in os.listdir(self.folder) if f.startswith('.tmp')], [])
+
+    def test_corrupt_manifest(self):
+        """tests that a corrupt manifest raises a CheckpointError"""
+        os.makedirs(self.folder)
+        with open(self.folder + os.sep + checkpoint.MANIFEST, 'w') as file:
+            file.write('{"stages": ')
+        self.assertRaises(checkpoint.CheckpointError, checkpoint.Checkpoints, self.folder)
+
+    def test_file_hash(self):
+        """tests that files with the same contents have the same hash"""
+        copy = self.directory + os.sep + 'copy.orth'
+        shutil.copy(self.orth, copy)
+        self.assertEqual(checkpoint.file_hash(self.orth), checkpoint.file_hash(copy))
+
+
+if __name__ == '__main__':
+    biskit.test.localTest()
@@ -9,7 +9,11 @@ Test file for cons
 """
 import biskit.test
 import os
+import shutil
+import tempfile
+import cachestore
 import oma
+import omastub
 from requests import exceptions
 from unittest.mock import patch, MagicMock
 
@@ -73,7 +77,7 @@ class TestCons(biskit.test.BiskitTest):
         self.lyz.sequence = 'MKALIVLGLVLLSVTVQGKVFERCELARTLKRLGMDGYRGISLANWMCLAKWESGYNTRATNYNAGDRSTDYGIFQINSRYWCNDGKTPGAVNACHLSCSALLQDNIADAVACAKRVVRDPQGIRAWVAWRNRCQNRDVRQYVQGCGV'
         self.assertEqual(self.lyz.build_url(tail='/api/sequence/?query={0}', variation=[self.lyz.sequence]), 'https://omabrowser.org/api/sequence/?query=MKALIVLGLVLLSVTVQGKVFERCELARTLKRLGMDGYRGISLANWMCLAKWESGYNTRATNYNAGDRSTDYGIFQINSRYWCNDGKTPGAVNACHLSCSALLQDNIADAVACAKRVVRDPQGIRAWVAWRNRCQNRDVRQYVQGCGV')
 
-    @patch('oma.requests.get')
+    @patch('oma.requests.Session.get')
     def test_ologs_stragg(self, requests_mock):
         """Tests that a request with a bad status code raises an exception with get_orthologs"""
         requests_mock.requests.get.return_value = None
@@ -83,14 +87,14 @@ class TestCons(biskit.test.BiskitTest):
         err = cm.exception
         self.assertTrue('There was an issue querying the database. Status code' in str(err))
 
-    @patch('oma.requests.get')
+    @patch('oma.requests.Session.get')
     def test_ofasta_stragg(self, requests_mock):
         """Tests that a bad request raises an exception in ortholog_to_fasta"""
         requests_mock.requests.get.status_code = 400
         with self.assertRaises(exceptions.RequestException):
             self.aggregate.ortholog_to_fasta()
 
-    @patch('oma.requests.get')
+    @patch('oma.requests.Session.get')
     def test_ofasta_cdc(self, requests_mock):
         """Tests that ortholog_to_fasta correctly parses the response data"""
         requests_mock().status_code = 200
@@ -98,14 +102,14 @@ class TestCons(biskit.test.BiskitTest):
         test = self.CDC48A.ortholog_to_fasta()
         self.assertTrue('[Arabis alpina]' in test)
 
-    @patch('oma.requests.get')
+    @patch('oma.requests.Session.get')
     def test_orIDs_stragg(self, requests_mock):
         """Test that update_orthoIDs returns an exception given a bad request status"""
         requests_mock().status_code = 400
         with self.assertRaises(exceptions.RequestException):
             self.aggregate.update_orthoIDs()
 
-    @patch('oma.requests.get')
+    @patch('oma.requests.Session.get')
     def test_ret_hogs_stragg(self, requests_mock):
         """Tests that retrieve_HOG_level throws an exception when given a bad request status"""
         requests_mock().status_code = 400
@@ -152,6 +156,16 @@ MKTRQNKDSMSMRSGRKKEAPGPREELRSRGRASPGGVSTSSSDGKAEKSRQSAKKARVEEASTPKVNKQSRSEXETSAP
         self.assertEqual(tester[1],(">LOXAF14113 | G3TAL7 | HOG:0377891.2a.2a | [Loxodonta africana]\n"
                                     "MKTRQNKDSMSMRSGRKKEAPGPREELRSRGRASPGGVSTSSSDGKAEKSRQTA" ))
 
+    def test_remove_protein_adjacent(self):
+        """tests that remove_protein removes every matching protein, including adjacent ones"""
+        output = oma.OrthologFinder.remove_protein(">A1 | x\nMK\n>A1 | y\nMR\n>B2\nMS\n>A1 | z\nMT\n", 'A1')
+        self.assertEqual(output, ">B2\nMS" + os.linesep)
+
+    def test_remove_first_protein(self):
+        """tests that remove_first_protein keeps all but the first protein"""
+        output = oma.OrthologFinder.remove_first_protein(">A\nMK\nMK\n>B\nMS\n>C\nMT")
+        self.assertEqual(output, ">B\nMS" + os.linesep + ">C\nMT" + os.linesep)
+
     def test_empty_input(self):
         """Checks that the correct exception is raised when an empty sequence is entered"""
         fs = oma.OrthologFinder("")
@@ -192,7 +206,7 @@ MKTRQNKDSMSMRSGRKKEAPGPREELRSRGRASPGGVSTSSSDGKAEKSRQSAKKARVEEASTPKVNKQSRSEXETSAP
         output = oma.OrthologFinder.header_check(">Pingo Pongo | Happiness\nWOEFJEKTJEJTEK")
         self.assertEqual(output, ">Pingo Pongo | Happiness\nWOEFJEKTJEJTEK")
 
-    @patch('oma.requests.get')
+    @patch('oma.requests.Session.get')
     def test_hog_fasta(self, mock_request):
         """Tests that HOG_to_fasta correctly parses the request response"""
         self.lyz.hog_level = "Amniota"
@@ -201,7 +215,7 @@ MKTRQNKDSMSMRSGRKKEAPGPREELRSRGRASPGGVSTSSSDGKAEKSRQSAKKARVEEASTPKVNKQSRSEXETSAP
         test = self.lyz.HOG_to_fasta()
         self.assertTrue("HOG:0377891.2a.2a" in test)
 
-    @patch('oma.requests.get')
+    @patch('oma.requests.Session.get')
     def test_read_hog_roottrue(self, mock_request):
         """tests that read_HOGid retrieves the root ID when root=True"""
         thing = MagicMock(content=self.lvlresponse)
@@ -209,7 +223,7 @@ MKTRQNKDSMSMRSGRKKEAPGPREELRSRGRASPGGVSTSSSDGKAEKSRQSAKKARVEEASTPKVNKQSRSEXETSAP
         test = self.lyz.read_HOGid(thing, root=True)
         self.assertEqual(test, 'Amniota')
 
-    @patch('oma.requests.get')
+    @patch('oma.requests.Session.get')
     def test_read_hog_rootfalse(self, mock_request):
         """tests that read_HOGid retrieves a list of the ids when root=False """
         thing = MagicMock(content=self.lvlresponse)
@@ -219,5 +233,216 @@ MKTRQNKDSMSMRSGRKKEAPGPREELRSRGRASPGGVSTSSSDGKAEKSRQSAKKARVEEASTPKVNKQSRSEXETSAP
         self.assertTrue('Caniformia' in test)
         self.assertTrue('Gorilla gorilla gorilla' in test)
 
+    def test_default_session_shared(self):
+        """tests that OrthologFinders without a session share the default pooled session"""
+        other = oma.OrthologFinder("MKALIVLGLVLLSVTVQG")
+        self.assertIs(self.lyz.session, other.session)
+        self.assertIs(self.lyz.session, oma.default_session())
+
+    def test_default_session_rate_limit(self):
+        """tests that the rate limit given to a finder without a session limits the shared session"""
+        with patch.object(oma, '_default_session', None):
+            finder = oma.OrthologFinder("MKALIVLGLVLLSVTVQG", rate_limit=5)
+            self.assertEqual(finder.session.limiter.rate, 5)
+            self.assertEqual(oma.OrthologFinder("MKALIVLGLVLLSVTVQG").session.limiter.rate, 5)
+            oma.OrthologFinder("MKALIVLGLVLLSVTVQG", rate_limit=2)
+            self.assertEqual(finder.session.limiter.rate, 2)
+            own = oma.OMASession()
+            self.assertIsNone(oma.OrthologFinder("MKALIVLGLVLLSVTVQG", session=own, rate_limit=2).session.limiter)
+
+    def test_session_pool_size(self):
+        """tests that the session mounts an adapter with the requested pool size"""
+        session = oma.OMASession(pool_size=3, keep_alive=False)
+        adapter = session.session.get_adapter('https://omabrowser.org')
+        self.assertEqual(adapter._pool_maxsize, 3)
+        self.assertEqual(session.session.headers['Connection'], 'close')
+        session.close()
+
+    @patch('oma.requests.Session.get')
+    def test_request_timings(self, mock_request):
+        """tests that every request made by the finder is timed"""
+        mock_request().status_code = 200
+        mock_request().text = self.fresponse
+        self.CDC48A.id = 'ARATH09528'
+        self.CDC48A.ortholog_to_fasta()
+        url, status, seconds = self.CDC48A.timings[-1]
+        self.assertEqual(url, 'https://omabrowser.org/oma/vps/ARATH09528/fasta/')
+        self.assertEqual(status, 200)
+        self.assertTrue(seconds >= 0)
+
+    @patch('oma.requests.Session.get')
+    def test_response_cache(self, mock_request):
+        """tests that a response found in the cache is not queried again, even by another finder"""
+        directory = tempfile.mkdtemp()
+        try:
+            cache = cachestore.DiskCache(directory + os.sep + 'oma.sqlite')
+            mock_request.return_value = MagicMock(status_code=200, content=self.response)
+            first = oma.OrthologFinder('MSTPAESSDSKSKKDF', cache=cache)
+            first.sequence = 'MSTPAESSDSKSKKDF'
+            first.retrieve_OMAid()
+            second = oma.OrthologFinder('MSTPAESSDSKSKKDF', cache=cache)
+            second.sequence = 'MSTPAESSDSKSKKDF'
+            second.retrieve_OMAid()
+            self.assertEqual(mock_request.call_count, 1)
+            self.assertEqual(second.id, 'ARATH09528')
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+            mirror = oma.OrthologFinder('MSTPAESSDSKSKKDF', cache=cache, base_url='http://localhost:8000/')
+            mirror.sequence = 'MSTPAESSDSKSKKDF'
+            mirror.retrieve_OMAid()
+            self.assertEqual(mock_request.call_count, 2)
+            self.assertEqual(mock_request.call_args[0][0],
+                             'http://localhost:8000/api/sequence/?query=MSTPAESSDSKSKKDF')
+            cache.close()
+        finally:
+            shutil.rmtree(directory)
+
+    @patch('oma.time.sleep')
+    @patch('oma.requests.Session.get')
+    def test_retry_backoff(self, mock_request, mock_sleep):
+        """tests that rate limited and unavailable responses are retried until the query succeeds"""
+        mock_request.side_effect = [MagicMock(status_code=502, headers={}),
+                                    MagicMock(status_code=429, headers={'Retry-After': '7'}),
+                                    MagicMock(status_code=200, content=self.response)]
+        finder = oma.OrthologFinder('MSTPAESSDSKSKKDF', backoff=2.0)
+        finder.sequence = 'MSTPAESSDSKSKKDF'
+        finder.retrieve_OMAid()
+        self.assertEqual(finder.id, 'ARATH09528')
+        self.assertEqual(mock_request.call_count, 3)
+        delays = [c[0][0] for c in mock_sleep.call_args_list]
+        self.assertTrue(0 <= delays[0] <= 2.0)
+        self.assertEqual(delays[1], 7.0)
+
+    @patch('oma.time.sleep')
+    @patch('oma.requests.Session.get')
+    def test_retries_exhausted(self, mock_request, mock_sleep):
+        """tests that the status error is raised once the retries are exhausted"""
+        mock_request.return_value = MagicMock(status_code=504, headers={})
+        finder = oma.OrthologFinder('MSTPAESSDSKSKKDF', retries=2)
+        finder.sequence = 'MSTPAESSDSKSKKDF'
+        with self.assertRaises(TimeoutError):
+            finder.retrieve_OMAid()
+        self.assertEqual(mock_request.call_count, 3)
+
+    @patch('oma.time.sleep')
+    @patch('oma.time.monotonic')
+    def test_token_bucket(self, mock_clock, mock_sleep):
+        """tests that the token bucket lets bursts through and then waits for new tokens"""
+        mock_clock.return_value = 0.0
+        bucket = oma.TokenBucket(rate=2, burst=2)
+        bucket.acquire()
+        bucket.acquire()
+        self.assertFalse(mock_sleep.called)
+        mock_sleep.side_effect = lambda seconds: setattr(mock_clock, 'return_value', mock_clock.return_value + seconds)
+        bucket.acquire()
+        mock_sleep.assert_called_once_with(0.5)
+
+    def streamed(self, content, size=7):
+        """A mocked streamed response that yields its content in small chunks"""
+        chunks = [content[i:i + size] for i in range(0, len(content), size)]
+        return MagicMock(status_code=200, iter_content=MagicMock(return_value=iter(chunks)))
+
+    @patch('oma.requests.Session.get')
+    def test_hog_stream_to_file(self, mock_request):
+        """tests that the HOG is streamed to a file without the input protein"""
+        directory = tempfile.mkdtemp()
+        try:
+            mock_request.return_value = self.streamed(self.hresponse)
+            self.lyz.id, self.lyz.hog_level = 'LOXAF14113', 'Amniota'
+            path = self.lyz.HOG_to_fasta(path=directory + os.sep + 'lyz.orth')
+            self.assertTrue(mock_request.call_args[1]['stream'])
+            with open(path) as file:
+                output = file.read()
+            self.assertFalse('LOXAF14113' in output)
+            self.assertEqual(output.count('>'), self.hresponse.count(b'>') - 1)
+            self.assertEqual(self.lyz.downloaded, len(self.hresponse))
+            self.assertEqual(output, oma.OrthologFinder.remove_protein(self.hresponse.decode('utf-8'), 'LOXAF14113'))
+        finally:
+            shutil.rmtree(directory)
+
+    @patch('oma.requests.Session.get')
+    def test_orthologs_stream_to_file(self, mock_request):
+        """tests that streamed orthologs start with the input sequence instead of the first protein"""
+        directory = tempfile.mkdtemp()
+        try:
+            mock_request.side_effect = lambda url, **kw: (self.streamed(self.fresponse) if '/oma/vps/' in url
+                                                          else MagicMock(status_code=200, content=self.response))
+            finder = oma.OrthologFinder('>query\nMSTPAESSDSKSKKDF\n')
+            path = finder.get_orthologs(path=directory + os.sep + 'cdc.orth')
+            with open(path) as file:
+                output = file.read()
+            expected = finder.seqnwl_strip('MSTPAESSDSKSKKDF') + os.linesep + \
+                       oma.OrthologFinder.remove_first_protein(self.fresponse.decode('utf-8'))
+            self.assertEqual(output, expected)
+        finally:
+            shutil.rmtree(directory)
+
+    @patch('oma.requests.Session.get')
+    def test_stream_fills_cache(self, mock_request):
+        """tests that a streamed response is cached and written again from the cache"""
+        directory = tempfile.mkdtemp()
+        try:
+            cache = cachestore.DiskCache(directory + os.sep + 'oma.sqlite')
+            mock_request.return_value = self.streamed(self.hresponse)
+            finder = oma.OrthologFinder('MKALIVLGLVLLSVTVQG', cache=cache)
+            finder.id, finder.hog_level = 'LOXAF14113', 'Amniota'
+            first = open(finder.HOG_to_fasta(path=directory + os.sep + 'first.orth')).read()
+            second = open(finder.HOG_to_fasta(path=directory + os.sep + 'second.orth')).read()
+            self.assertEqual(mock_request.call_count, 1)
+            self.assertEqual(first, second)
+            self.assertEqual(cache.get('/oma/hogs/{0}/{1}/fasta/:' + cachestore.hash_key('LOXAF14113', 'Amniota')),
+                             self.hresponse)
+            cache.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_stub_adapter(self):
+        """tests that a session with the stub adapter mounted answers the queries offline"""
+        session = oma.OMASession()
+        stub = omastub.StubAdapter(omastub.oma_routes('LOXAF14113', 'Amniota', self.hresponse))
+        session.mount(oma.OrthologFinder.OMA_BASE_URL, stub)
+        finder = oma.OrthologFinder('MKALIVLGLVLLSVTVQG', session=session)
+        hogs = finder.get_HOGs()
+        self.assertEqual(hogs, oma.OrthologFinder.remove_protein(self.hresponse.decode('utf-8'), 'LOXAF14113'))
+        self.assertEqual(len(stub.requests), 3)
+        self.assertTrue(stub.requests[0].startswith(oma.OrthologFinder.OMA_BASE_URL + '/api/sequence/'))
+        self.assertEqual(session.get(oma.OrthologFinder.OMA_BASE_URL + '/api/xref/').status_code, 404)
+        session.close()
+
+    def fake_oma(self, url, **kw):
+        """Serves the example responses of the OMA endpoints"""
+        if '/api/sequence/' in url:
+            return MagicMock(status_code=200, content=self.response)
+        if '/api/hog/' in url:
+            return MagicMock(status_code=200, content=self.lvlresponse)
+        if '/oma/hogs/' in url:
+            return MagicMock(status_code=200, text=self.hresponse.decode('utf-8'))
+        return MagicMock(status_code=404)
+
+    @patch('oma.requests.Session.get')
+    def test_fetch_hogs_many(self, mock_request):
+        """tests that fetch_hogs_many retrieves the HOGs of every protein and reports failures"""
+        mock_request.side_effect = self.fake_oma
+        results = oma.fetch_hogs_many(['MKALIVLGLVLLSVTVQG', '', 'MSTPAESSDSKSKKDF'], concurrency=2)
+        self.assertEqual(sorted(r.index for r in results), [0, 1, 2])
+        results = {r.index: r for r in results}
+        self.assertTrue('HOG:0377891.2a.2a' in results[0].orthologs)
+        self.assertIsNone(results[0].error)
+        self.assertIsInstance(results[1].error, oma.SequenceError)
+        self.assertIsNone(results[1].orthologs)
+
+    @patch('oma.requests.Session.get')
+    def test_async_falls_back_to_orthologs(self, mock_request):
+        """tests that the async finder retrieves the orthologs when the HOG query fails"""
+        def no_hogs(url, **kw):
+            if '/api/hog/' in url:
+                return MagicMock(status_code=400)
+            if '/oma/vps/' in url:
+                return MagicMock(status_code=200, text=self.fresponse.decode('utf-8'))
+            return self.fake_oma(url)
+        mock_request.side_effect = no_hogs
+        results = oma.fetch_hogs_many(['MKALIVLGLVLLSVTVQG'])
+        self.assertTrue(results[0].orthologs.startswith('>Input Sequence'))
+        self.assertTrue('[Arabis alpina]' in results[0].orthologs)
+
 if __name__ == '__main__':
     biskit.test.localTest()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Streaming reader and writer for sequences in fasta format. Records are read one at a time
+from files, strings or any iterable of byte chunks (such as a streamed HTTP response), so
+that large sets of sequences can be filtered and written in linear time and constant memory.
+
+Records are handled as bytes. A block is the raw text of a record: its header line and its
+sequence lines, as they appear in the input, without the trailing whitespace.
+"""
+
+import os
+
+CHUNK_SIZE = 64 * 1024
+
+def iter_chunks(source, chunk_size=CHUNK_SIZE):
+    """
+    Turns the supported inputs into an iterator of byte chunks
+    Args:
+        source: A str or bytes holding fasta text, a file opened in binary or text mode, or an
+            iterable of byte chunks
+    """
+    if isinstance(source, str):
+        yield source.encode('utf-8')
+    elif isinstance(source, bytes):
+        yield source
+    elif hasattr(source, 'read'):
+        for chunk in iter(lambda: source.read(chunk_size), source.read(0)):
+            yield chunk.encode('utf-8') if isinstance(chunk, str) else chunk
+    else:
+        for chunk in source:
+            yield chunk.encode('utf-8') if isinstance(chunk, str) else chunk
+
+def iter_lines(source):
+    """
+    Yields the lines of the input as bytes, with their line endings, however the input is chunked
+    Args:
+        source: Any input accepted by iter_chunks
+    """
+    rest = b''
+    for chunk in iter_chunks(source):
+        lines = (rest + chunk).split(b'\n')
+        rest = lines.pop()
+        for line in lines:
+            yield line + b'\n'
+    if rest:
+        yield rest
+
+def iter_blocks(source):
+    """
+    Yields the records of the input one at a time, as blocks
+    Args:
+        source: Any input accepted by iter_chunks
+    Yields:
+        The header line and sequence lines of every record as bytes, starting with > and without
+        trailing whitespace. Text before the first header is skipped.
+    """
+    # The chunks are split where a line starts with >, instead of line by line. Chunks without
+    # any > cannot end a record and are only joined once the record ends. Before the first
+    # header, only a newline at the end of a chunk is kept, as the next chunk may start with >
+    pending = [b'\n']
+    started = False
+    for chunk in iter_chunks(source):
+        if not started:
+            buffer = b''.join(pending) + chunk
+            start = buffer.find(b'\n>')
+            if start < 0:
+                pending = [b'\n'] if buffer.endswith(b'\n') else []
+                continue
+            started = True
+            buffer = buffer[start + 1:]
+        elif b'>' not in chunk:
+            pending.append(chunk)
+            continue
+        else:
+            pending.append(chunk)
+            buffer = b''.join(pending)
+        pieces = buffer.split(b'\n>')
+        for i, piece in enumerate(pieces[:-1]):
+            piece = piece.rstrip()
+            yield piece if i == 0 else b'>' + piece
+        pending = [pieces[-1] if len(pieces) == 1 else b'>' + pieces[-1]]
+    if started:
+        block = b''.join(pending).rstrip()
+        if block:
+            yield block
+
+def iter_records(source):
+    """
+    Yields the records of the input one at a time, as (header, sequence) pairs
+    Args:
+        source: Any input accepted by iter_chunks
+    Yields:
+        The header without the leading > and the sequence without any whitespace, as bytes
+    """
+    for block in iter_blocks(source):
+        header, _, sequence = block.partition(b'\n')
+        yield header[1:].strip(), b''.join(sequence.split())
+
+def block_header(block):
+    """
+    Returns the header line of a block, without the leading >
+    """
+    return block.partition(b'\n')[0][1:].strip()
+
+def write_blocks(blocks, stream, linesep=os.linesep):
+    """
+    Writes blocks to a stream, each followed by a line separator
+    Args:
+        blocks(iterable): The blocks, as bytes
+        stream: A file opened in binary mode
+        linesep(str): The line separator written after each block
+    Returns:
+        The number of blocks written
+    """
+    linesep = linesep.encode('utf-8')
+    count = 0
+    for block in blocks:
+        stream.write(block)
+        stream.write(linesep)
+        count += 1
+    return count
+
+def write_records(records, stream, width=60):
+    """
+    Writes (header, sequence) records to a stream in fasta format
+    Args:
+        records(iterable): The records, as pairs of bytes
+        stream: A file opened in binary mode
+        width(int): The length of the sequence lines. None writes every sequence on a single line
+    Returns:
+        The number of records written
+    """
+    count = 0
+    for header, sequence in records:
+        stream.write(b'>' + header + b'\n')
+        step = width or len(sequence) or 1
+        for i in range(0, len(sequence), step):
+            stream.write(sequence[i:i + step] + b'\n')
+        count += 1
+    return count
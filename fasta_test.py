@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Test file for the fasta module
+"""
+import biskit.test
+import io
+import fasta
+
+
+class TestFasta(biskit.test.BiskitTest):
+    """
+    Test suite testing the streaming fasta reader and writer
+    """
+
+    TAGS = [biskit.test.NORMAL]
+
+    MULTI = (b">PROCA12070 | HOG:0377891.2a.2a | [Procavia capensis]\n"
+             b"MKTRQNKDSMSMRS\n"
+             b"GRKKEAPG\n"
+             b">LOXAF14113 | HOG:0377891.2a.2a | [Loxodonta africana]\n"
+             b"MKTRQNKDSM\n\n")
+
+    def test_blocks_any_chunking(self):
+        """tests that the same blocks are read however the input is split into chunks"""
+        expected = list(fasta.iter_blocks(self.MULTI))
+        chunks = [self.MULTI[i:i + 5] for i in range(0, len(self.MULTI), 5)]
+        self.assertEqual(list(fasta.iter_blocks(chunks)), expected)
+        self.assertEqual(list(fasta.iter_blocks(io.BytesIO(self.MULTI))), expected)
+        self.assertEqual(expected[1], b">LOXAF14113 | HOG:0377891.2a.2a | [Loxodonta africana]\nMKTRQNKDSM")
+
+    def test_blocks_split_at_header(self):
+        """tests that a record starting right after a chunk boundary, and text before the first header, are handled"""
+        text = b"notes > here\n" + self.MULTI
+        expected = list(fasta.iter_blocks(self.MULTI))
+        for size in range(1, 12):
+            chunks = [text[i:i + size] for i in range(0, len(text), size)]
+            self.assertEqual(list(fasta.iter_blocks(chunks)), expected)
+
+    def test_records(self):
+        """tests that records are split into their header and sequence without whitespace"""
+        records = list(fasta.iter_records(self.MULTI.decode('utf-8')))
+        self.assertEqual(records[0], (b"PROCA12070 | HOG:0377891.2a.2a | [Procavia capensis]",
+                                      b"MKTRQNKDSMSMRSGRKKEAPG"))
+        self.assertEqual(len(records), 2)
+
+    def test_text_stream(self):
+        """tests that files opened in text mode are read"""
+        blocks = list(fasta.iter_blocks(io.StringIO(self.MULTI.decode('utf-8'))))
+        self.assertEqual(len(blocks), 2)
+
+    def test_leading_text_skipped(self):
+        """tests that text before the first header is ignored"""
+        self.assertEqual(list(fasta.iter_blocks(b"garbage\n>A\nMK\n")), [b">A\nMK"])
+
+    def test_write_records(self):
+        """tests that write_records wraps the sequences at the given width"""
+        stream = io.BytesIO()
+        count = fasta.write_records([(b'A', b'MKTRQ'), (b'B', b'')], stream, width=2)
+        self.assertEqual(count, 2)
+        self.assertEqual(stream.getvalue(), b">A\nMK\nTR\nQ\n>B\n")
+
+    def test_write_blocks(self):
+        """tests that write_blocks separates the blocks by line separators"""
+        stream = io.BytesIO()
+        fasta.write_blocks(fasta.iter_blocks(self.MULTI), stream, linesep='\n')
+        self.assertEqual(list(fasta.iter_blocks(stream.getvalue())), list(fasta.iter_blocks(self.MULTI)))
+
+if __name__ == '__main__':
+    biskit.test.localTest()
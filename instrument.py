@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Measures the time and resources used by every stage of the pipeline, to size the machines a
+batch runs on and to find the proteins whose orthologs take unusually long to process.
+
+Every stage of a ConservationPipe is run inside Recorder.stage, which records a StageStats with
+the wall and CPU time of the stage and the CPU time and peak memory of the programs it ran, along
+with counters set by the stage itself, such as the number of bytes downloaded or of sequences.
+"""
+
+import contextlib
+import sys
+import time
+from collections import namedtuple
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, where the figures of child processes are not recorded
+    resource = None
+
+#: The bytes per unit of ru_maxrss, which is given in bytes on macOS and in kilobytes elsewhere
+MAXRSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+
+StageStats = namedtuple('StageStats', ['name', 'stage', 'wall', 'cpu', 'children_cpu', 'children_maxrss',
+                                       'downloaded', 'sequences', 'columns', 'error'],
+                        defaults=[None, None, None, None])
+StageStats.__doc__ = """
+The measurements of one stage of the pipe of a protein.
+    name: the name of the protein
+    stage: the name of the stage: orthologs, subset, alignment, and rate4site, or scoring if the alignment
+        is scored by another engine, see seq2conservation.ConservationPipe
+    wall: the time the stage took, in seconds
+    cpu: the CPU time of the thread that ran the stage, in seconds
+    children_cpu: the CPU time of the programs run by the stage, such as T-Coffee or Rate4Site, in seconds
+    children_maxrss: the peak resident memory of the largest program run so far by the process, in
+        bytes. As the operating system only keeps the largest figure, a stage whose programs used
+        less memory than those of an earlier stage shows the figure of the earlier stage
+    downloaded: the number of bytes downloaded from OMA
+    sequences: the number of sequences the stage produced
+    columns: the number of columns of the alignment
+    error: the representation of the exception that stopped the stage, if it failed
+
+The figures of child processes are those of the whole process, so when pipes run in several
+threads of one process (see seq2conservation.run_batch) they include the programs of the other
+pipes that finished during the stage.
+"""
+
+
+def _children():
+    """
+    Returns:
+        The CPU time, in seconds, and peak resident memory, in bytes, of the child processes that have finished
+    """
+    if resource is None:
+        return None, None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime, usage.ru_maxrss * MAXRSS_UNIT
+
+
+class Recorder:
+    """
+    Records the StageStats of the stages of a pipe, in the order they finish
+    """
+
+    def __init__(self, name=None, hook=None):
+        """
+        Args:
+            name(str): The name of the protein
+            hook(function): Called with the StageStats of every stage as soon as the stage finishes,
+                whether or not it succeeded
+        """
+        self.name = name
+        self.hook = hook
+        self.stages = []
+
+    @contextlib.contextmanager
+    def stage(self, stage):
+        """
+        Measures the code run inside the with block as one stage
+        Args:
+            stage(str): The name of the stage
+        Yields:
+            A dictionary in which the block can set the downloaded, sequences and columns counters
+        """
+        counters = {}
+        error = None
+        wall, cpu = time.perf_counter(), time.thread_time()
+        children_cpu, _ = _children()
+        try:
+            yield counters
+        except BaseException as e:
+            error = repr(e)
+            raise
+        finally:
+            end_cpu, maxrss = _children()
+            stats = StageStats(self.name, stage, time.perf_counter() - wall, time.thread_time() - cpu,
+                               None if end_cpu is None else end_cpu - children_cpu, maxrss,
+                               error=error, **counters)
+            self.stages.append(stats)
+            if self.hook is not None:
+                self.hook(stats)
+
+    def summary(self):
+        """
+        Returns:
+            A dictionary mapping the name of every stage to its measurements as a dictionary
+        """
+        return {stats.stage: stats._asdict() for stats in self.stages}
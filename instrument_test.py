@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Test file for the instrument module
+"""
+import biskit.test
+import subprocess
+import sys
+import instrument
+
+
+class TestInstrument(biskit.test.BiskitTest):
+    """
+    Test suite testing the measurements of the pipeline stages
+    """
+
+    TAGS = [biskit.test.NORMAL]
+
+    def test_stage(self):
+        """tests that a stage is recorded with its counters and passed to the hook"""
+        seen = []
+        recorder = instrument.Recorder('protein', hook=seen.append)
+        with recorder.stage('orthologs') as counters:
+            subprocess.run([sys.executable, '-c', 'sum(range(10 ** 6))'])
+            counters.update(downloaded=1024, sequences=12)
+        stats = recorder.stages[0]
+        self.assertEqual(seen, [stats])
+        self.assertEqual((stats.name, stats.stage, stats.downloaded, stats.sequences), ('protein', 'orthologs', 1024, 12))
+        self.assertIsNone(stats.columns)
+        self.assertIsNone(stats.error)
+        self.assertTrue(stats.wall >= stats.cpu >= 0)
+        if instrument.resource is not None:
+            self.assertTrue(stats.children_cpu > 0)
+            # In bytes: a Python interpreter takes well over a megabyte
+            self.assertTrue(stats.children_maxrss > 2 ** 20)
+
+    def test_failed_stage(self):
+        """tests that a stage that fails is recorded with its error and the error is raised"""
+        recorder = instrument.Recorder('protein')
+        with self.assertRaises(ValueError):
+            with recorder.stage('alignment'):
+                raise ValueError('no sequences')
+        self.assertEqual(recorder.stages[0].error, "ValueError('no sequences')")
+        self.assertEqual(list(recorder.summary()), ['alignment'])
+
+
+if __name__ == '__main__':
+    biskit.test.localTest()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Modules imported when they are first used rather than when the module naming them is imported, so
+that importing the pipeline does not load requests or Biopython until a stage that needs them runs.
+Short lived workers that only parse existing outputs or read cached results then start faster.
+
+    requests = lazy_import('requests')
+    requests.Session()      # requests is imported here
+"""
+
+import importlib
+import sys
+
+
+class LazyModule:
+    """
+    Stands in for a module until one of its attributes is read, when the module is imported
+    """
+
+    def __init__(self, name):
+        """
+        Args:
+            name(str): The full name of the module, such as Bio.Phylo.TreeConstruction
+        """
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        """
+        Returns:
+            The module, imported on the first call. The import lock of the module makes concurrent
+            first calls from several threads safe
+        """
+        module = self.__dict__['_module']
+        if module is None:
+            module = importlib.import_module(self._name)
+            self.__dict__['_module'] = module
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __delattr__(self, attr):
+        delattr(self._load(), attr)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        state = 'imported' if self.__dict__['_module'] is not None else 'not imported'
+        return '<lazy module %r, %s>' % (self._name, state)
+
+
+def lazy_import(name):
+    """
+    Args:
+        name(str): The full name of the module
+    Returns:
+        The module if it is already imported, otherwise a LazyModule that imports it on first use
+    """
+    module = sys.modules.get(name)
+    return module if module is not None else LazyModule(name)
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Test file for the modules imported on first use
+"""
+import biskit.test
+import sys
+import lazyimport
+from unittest.mock import patch
+
+
+class TestLazyImport(biskit.test.BiskitTest):
+    """
+    Test suite testing that lazy modules are imported when first used
+    """
+
+    TAGS = [biskit.test.NORMAL]
+
+    def test_first_use(self):
+        """tests that a lazy module is imported by reading one of its attributes"""
+        with patch.dict(sys.modules):
+            sys.modules.pop('colorsys', None)
+            colorsys = lazyimport.lazy_import('colorsys')
+            self.assertIsInstance(colorsys, lazyimport.LazyModule)
+            self.assertNotIn('colorsys', sys.modules)
+            self.assertIn('not imported', repr(colorsys))
+            self.assertEqual(colorsys.rgb_to_hsv(1.0, 0.0, 0.0), (0.0, 1.0, 1.0))
+            self.assertIn('colorsys', sys.modules)
+            self.assertIs(colorsys._load(), sys.modules['colorsys'])
+
+    def test_imported(self):
+        """tests that a module already imported is returned as it is"""
+        self.assertIs(lazyimport.lazy_import('os'), sys.modules['os'])
+
+    def test_patch(self):
+        """tests that the attributes of a lazy module can be patched"""
+        json = lazyimport.LazyModule('json')
+        with patch.object(json, 'dumps', return_value='patched'):
+            self.assertEqual(json.dumps({}), 'patched')
+            self.assertEqual(sys.modules['json'].dumps({}), 'patched')
+        self.assertEqual(json.dumps({}), '{}')
+
+
+if __name__ == '__main__':
+    biskit.test.localTest()
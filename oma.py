@@ -5,15 +5,173 @@ single letter alphabet sequence is required as input.
 """
 
 import json
-import requests
-import re
 import os
+import random
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+import fasta as fa
 from biskit.errors import BiskitError
-from requests import exceptions
+from cachestore import hash_key
+from lazyimport import lazy_import
+
+# Imported on first use, so that the modules that only parse results do not load them
+asyncio = lazy_import('asyncio')
+requests = lazy_import('requests')
+exceptions = lazy_import('requests.exceptions')
+adapters = lazy_import('requests.adapters')
 
 class SequenceError(BiskitError):
     pass
 
+class TokenBucket:
+    """
+    Client side rate limiter. Tokens are added to the bucket at a constant rate up to its
+    capacity, and every request takes one token, waiting for it if the bucket is empty. Short
+    bursts of up to `burst` requests are let through at once.
+    """
+
+    def __init__(self, rate, burst=None):
+        """
+        Args:
+            rate(float): The sustained number of requests allowed per second
+            burst(int): The capacity of the bucket. Defaults to one second worth of requests
+        """
+        self.rate = rate
+        self.capacity = burst or max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Takes a token from the bucket, sleeping until one is available
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class OMASession:
+    """
+    A connection-pooled HTTP session for querying OMA. The TCP/TLS connections to the
+    server are kept alive and reused between requests, so a single session should be
+    shared by all the OrthologFinder instances of a process.
+    """
+
+    def __init__(self, pool_size=10, keep_alive=True, timeout=(10, 120), rate_limit=None, burst=None):
+        """
+        Args:
+            pool_size(int): The maximum number of connections kept open per host. Should be at
+                least the number of threads that query OMA at the same time
+            keep_alive(boolean): If false, every connection is closed after its response
+            timeout(float or tuple): Seconds to wait for the server to connect and to respond,
+                either as a single value or as a (connect, read) tuple. None waits forever
+            rate_limit(float): The maximum number of requests per second sent through the session,
+                by all threads together. None for no limit
+            burst(int): The number of requests that may be sent at once before the rate limit applies
+        """
+        self.pool_size = pool_size
+        self.keep_alive = keep_alive
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        if not keep_alive:
+            self.session.headers['Connection'] = 'close'
+        self.set_rate_limit(rate_limit, burst)
+
+    def set_rate_limit(self, rate_limit, burst=None):
+        """
+        Changes the rate limit of the session, for all the threads using it
+        Args:
+            rate_limit(float): The maximum number of requests per second. None for no limit
+            burst(int): The number of requests that may be sent at once before the rate limit applies
+        """
+        self.rate_limit = rate_limit
+        self.burst = burst
+        self.limiter = TokenBucket(rate_limit, burst) if rate_limit else None
+
+    def __getstate__(self):
+        # The connections and the lock of the rate limiter cannot be sent to another process, the
+        # session is built again from its settings. Adapters mounted on it are not kept
+        return {'pool_size': self.pool_size, 'keep_alive': self.keep_alive, 'timeout': self.timeout,
+                'rate_limit': self.rate_limit, 'burst': self.burst}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def get(self, url, headers=None, **kw):
+        """
+        Sends a GET request through the pooled connections
+        Args:
+            url(str): The url to query
+            headers(dict): Additional headers to send with the request
+        Returns:
+            The requests.Response of the server
+        """
+        kw.setdefault('timeout', self.timeout)
+        if self.limiter is not None:
+            self.limiter.acquire()
+        return self.session.get(url, headers=headers, **kw)
+
+    def mount(self, prefix, adapter):
+        """
+        Sends the requests to urls starting with prefix through another transport adapter, such
+        as the offline omastub.StubAdapter
+        """
+        self.session.mount(prefix, adapter)
+
+    def close(self):
+        """
+        Closes all the pooled connections
+        """
+        self.session.close()
+
+class CachedResponse:
+    """
+    Stands in for the requests.Response of a query whose body was found in the response cache
+    """
+
+    def __init__(self, url, content):
+        self.url = url
+        self.status_code = 200
+        self.content = content
+        self.headers = {}
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8')
+
+    def close(self):
+        pass
+
+_default_session = None
+
+def default_session(rate_limit=None):
+    """
+    Returns the OMASession shared by all the OrthologFinder instances that were not given
+    their own session. The session is created on first use.
+    Args:
+        rate_limit(float): If given, the maximum number of requests per second of the shared session,
+            from then on and for all the threads of the process
+    """
+    global _default_session
+    if _default_session is None:
+        _default_session = OMASession(rate_limit=rate_limit)
+    elif rate_limit is not None and rate_limit != _default_session.rate_limit:
+        _default_session.set_rate_limit(rate_limit)
+    return _default_session
+
 class OrthologFinder:
     """
     Queries OMA with a protein sequence or fasta to try and retrieve the
@@ -24,9 +182,38 @@ class OrthologFinder:
 
     OMA_BASE_URL = 'https://omabrowser.org'
     HEADERS = {'Content-Type': 'application/json'}
+    RETRY_STATUS = (429, 500, 502, 503, 504)
 
-    def __init__(self, fasta):
+    def __init__(self, fasta, session=None, cache=None, retries=4, backoff=1.0, max_backoff=60.0, base_url=None,
+                 rate_limit=None):
+        """
+        Args:
+            fasta(str): The protein sequence, or a string in fasta format
+            session(OMASession): The session used to query OMA. Defaults to the session shared
+                by the whole process
+            cache(cachestore.DiskCache): A persistent cache of the OMA responses, keyed by endpoint
+                and query parameters. Successful responses found in the cache are not queried again
+            retries(int): How many times a request is repeated if the connection fails or the
+                server answers with one of the RETRY_STATUS codes (rate limited or unavailable)
+            backoff(float): The base delay between retries in seconds. The delay doubles with every
+                retry, up to max_backoff, and is randomized to spread out the retries of parallel
+                clients. A Retry-After header sent by the server takes precedence
+            max_backoff(float): The longest delay between two retries, in seconds
+            base_url(str): The server queried instead of OMA_BASE_URL, such as a local mirror
+                served by omamirror.MirrorServer, without a trailing slash
+            rate_limit(float): The maximum number of requests per second of the session shared by the
+                process, see default_session. Only used without a session; a session given is
+                limited by its own rate_limit
+        """
         self.fasta = fasta
+        self.base_url = (base_url or self.OMA_BASE_URL).rstrip('/')
+        self.session = session or default_session(rate_limit)
+        self.cache = cache
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timings = []
+        self.downloaded = 0
         self.sequence = ""
         self.id = ""
         self.ortholog_ids = []
@@ -36,6 +223,120 @@ class OrthologFinder:
         self.save_status = 0
         self.hog_level = ""
 
+    def _get(self, tail, variation, headers=None):
+        """
+        Builds the url from the tail and variation and queries it through the session, unless the
+        response is already in the cache. Records how long the request took in timings as a tuple
+        of the url, the status code and the time in seconds, and adds the size of the body to downloaded
+        """
+        url = OrthologFinder.build_url(tail=tail, variation=variation, base_url=self.base_url)
+        start = time.perf_counter()
+        key = self.cache_key(tail, variation)
+        content = self.cache.get(key) if self.cache is not None else None
+        if content is not None:
+            response = CachedResponse(url, content)
+        else:
+            response = self._get_with_retry(url, headers)
+            self.downloaded += len(response.content)
+            if self.cache is not None and response.status_code == 200:
+                self.cache.put(key, response.content)
+        self.timings.append((url, response.status_code, time.perf_counter() - start))
+        return response
+
+    def _get_with_retry(self, url, headers, **kw):
+        """
+        Queries the url, retrying with exponential backoff on connection errors and on the
+        RETRY_STATUS codes. Returns the last response once the retries are exhausted
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                response = self.session.get(url, headers=headers, **kw)
+            except (exceptions.ConnectionError, exceptions.Timeout):
+                if attempt == self.retries:
+                    raise
+                time.sleep(self.retry_delay(attempt))
+                continue
+            if response.status_code not in self.RETRY_STATUS or attempt == self.retries:
+                return response
+            response.close()
+            time.sleep(self.retry_delay(attempt, response))
+
+    def _download(self, tail, variation, path, keep, head=b''):
+        """
+        Streams the fasta response of a query to a file in chunks, without holding the whole
+        response in memory. Uses and fills the response cache like _get; with a cache, the
+        response body is collected to be stored once the download has finished
+        Args:
+            tail(str), variation(list): The query, as passed to build_url
+            path(str): The file the proteins are written to
+            keep(function): Called with the index and the block of every protein, returns whether
+                the protein is written to the file
+            head(bytes): Written to the file before the proteins
+        Returns:
+            The path of the file
+        """
+        url = OrthologFinder.build_url(tail=tail, variation=variation, base_url=self.base_url)
+        start = time.perf_counter()
+        key = self.cache_key(tail, variation)
+        content = self.cache.get(key) if self.cache is not None else None
+        body = None
+        if content is not None:
+            response = CachedResponse(url, content)
+            chunks = [content]
+        else:
+            response = self._get_with_retry(url, None, stream=True)
+            if response.status_code != 200:
+                response.close()
+                self.save_status = response.status_code
+                raise exceptions.RequestException('There was an issue querying the database. Status code {0}'.format(self.save_status))
+            chunks = self._count(response.iter_content(fa.CHUNK_SIZE))
+            if self.cache is not None:
+                body = []
+                chunks = (body.append(chunk) or chunk for chunk in chunks)
+        with open(path, 'wb') as file:
+            file.write(head)
+            blocks = fa.iter_blocks(chunks)
+            fa.write_blocks((block for i, block in enumerate(blocks) if keep(i, block)), file)
+        response.close()
+        if body is not None:
+            self.cache.put(key, b''.join(body))
+        self.timings.append((url, response.status_code, time.perf_counter() - start))
+        return path
+
+    def cache_key(self, tail, variation):
+        """
+        Returns the key of a query in the response cache. The responses of other servers than OMA
+        are kept apart, as a mirror may hold another release of the database
+        """
+        key = tail + ':' + hash_key(*variation)
+        if self.base_url != self.OMA_BASE_URL:
+            key = self.base_url + key
+        return key
+
+    def _count(self, chunks):
+        """
+        Passes the chunks of a streamed response through, adding their size to downloaded
+        """
+        for chunk in chunks:
+            self.downloaded += len(chunk)
+            yield chunk
+
+    def retry_delay(self, attempt, response=None):
+        """
+        Returns the number of seconds to wait before the next attempt: the Retry-After of the
+        response if it has one, otherwise a random delay of up to backoff * 2 ** attempt seconds
+        """
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after:
+            try:
+                return max(0.0, float(retry_after))
+            except ValueError:
+                try:
+                    return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+                except (TypeError, ValueError):
+                    pass
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
     def retrieve_OMAid(self):
         """
         Takes a protein sequence and returns the oma id of the best protein
@@ -45,8 +346,7 @@ class OrthologFinder:
         Returns:
            A string containing the ID of the best protein match for the entered sequence
         """
-        url = OrthologFinder.build_url(tail='/api/sequence/?query={0}', variation=[self.sequence])
-        response = requests.get(url, headers=self.HEADERS)
+        response = self._get(tail='/api/sequence/?query={0}', variation=[self.sequence], headers=self.HEADERS)
         if response.status_code == 200:
             self.read_resp_protID(response)
         if response.status_code == 504:
@@ -69,8 +369,7 @@ class OrthologFinder:
             of the alternative level that the HOG spans through
         Returns: The deepest level relating the HOG, or a list of all the levels
         """
-        url = OrthologFinder.build_url(tail='/api/hog/{0}/', variation=[self.id])
-        response = requests.get(url, headers=self.HEADERS)
+        response = self._get(tail='/api/hog/{0}/', variation=[self.id], headers=self.HEADERS)
         if response.status_code == 200:
             return self.read_HOGid(response, root)
         if response.status_code == 504:
@@ -103,8 +402,7 @@ class OrthologFinder:
         Returns:
             A list of strings, the canonical IDS for the orthologs of the protein
         """
-        url = OrthologFinder.build_url(tail='/api/protein/{0}/orthologs/', variation=[self.id])
-        response = requests.get(url, headers=self.HEADERS)
+        response = self._get(tail='/api/protein/{0}/orthologs/', variation=[self.id], headers=self.HEADERS)
         if response.status_code == 200:
             self.read_resp_orthoIDs(response)
         else:
@@ -119,20 +417,25 @@ class OrthologFinder:
         for i in intro:
             self.ortholog_ids.append(i['canonicalid'])
 
-    def ortholog_to_fasta(self):
+    def ortholog_to_fasta(self, path=None, head=b''):
         """
         Takes an OMA specific ID and returns a fasta string of the orthologs assciated
         with that protein
 
         Args:
             OMAid(str):  The OMA specific ID of a desired protein
+            path(str): If given, the response is streamed to this file instead, without the first
+                protein (the protein itself), and the path is returned
+            head(bytes): Written to the file before the orthologs, when streaming
         Returns:
             A single fasta string containing the orthologs of that protein, as
             dictated by OMA.Note that when the fasta file is parsed,
             the first id is the OMA ID, and the second is the canonical id.
         """
-        url = OrthologFinder.build_url(tail='/oma/vps/{0}/fasta/', variation=[self.id])
-        response = requests.get(url)
+        if path is not None:
+            return self._download(tail='/oma/vps/{0}/fasta/', variation=[self.id], path=path,
+                                  keep=lambda i, block: i > 0, head=head)
+        response = self._get(tail='/oma/vps/{0}/fasta/', variation=[self.id])
         if response.status_code == 200:
             self.orthologs = str(response.text)
             return self.orthologs
@@ -140,12 +443,18 @@ class OrthologFinder:
             self.save_status = response.status_code
             raise exceptions.RequestException('There was an issue querying the database. Status code {0}'.format(self.save_status))
 
-    def HOG_to_fasta(self):
+    def HOG_to_fasta(self, path=None):
         """
         Retrieves the fasta file containing the sequences of the proteins in the HOG of the input protein
-        """
-        url = OrthologFinder.build_url(tail='/oma/hogs/{0}/{1}/fasta/', variation=[self.id, self.hog_level])
-        response = requests.get(url)
+        Args:
+            path(str): If given, the response is streamed to this file instead, without the input protein,
+                and the path is returned
+        """
+        if path is not None:
+            omaid = self.id.encode('utf-8')
+            return self._download(tail='/oma/hogs/{0}/{1}/fasta/', variation=[self.id, self.hog_level], path=path,
+                                  keep=lambda i, block: omaid not in fa.block_header(block))
+        response = self._get(tail='/oma/hogs/{0}/{1}/fasta/', variation=[self.id, self.hog_level])
         if response.status_code == 200:
             self.HOGs = str(response.text)
             return self.HOGs
@@ -153,14 +462,21 @@ class OrthologFinder:
             self.save_status = response.status_code
             raise exceptions.RequestException('There was an issue querying the database. Status code {0}'.format(self.save_status))
 
-    def get_HOGs(self):
+    def get_HOGs(self, path=None):
         """
         Retrieves a fasta file containing the sequences of the proteins in the HOG to the input protein, based on the input
         parameters.
+        Args:
+            path(str): If given, the sequences are streamed to this file and the path is returned, instead of
+                a fasta string
         """
         if not self.fasta:
             raise SequenceError("Input sequence is empty!")
         self.sequence = OrthologFinder.get_fasta_sequence(fasta=self.fasta)
+        if path is not None:
+            self.retrieve_OMAid()
+            self.retrieve_HOG_level()
+            return self.HOG_to_fasta(path=path)
         if self.has_run_hogs:
             output = self.HOGs
             return output
@@ -172,13 +488,20 @@ class OrthologFinder:
             self.has_run_hogs = True
             return output
 
-    def get_orthologs(self):
+    def get_orthologs(self, path=None):
         """
         Retrieves a fasta file containing the sequences of the orthologous proteins, based on the input parameters
+        Args:
+            path(str): If given, the sequences are streamed to this file and the path is returned, instead of
+                a fasta string
         """
         if not self.fasta:
             raise SequenceError("Input sequence is empty!")
         self.sequence = OrthologFinder.get_fasta_sequence(fasta=self.fasta)
+        if path is not None:
+            self.retrieve_OMAid()
+            head = OrthologFinder.seqnwl_strip(self.sequence) + os.linesep
+            return self.ortholog_to_fasta(path=path, head=head.encode('utf-8'))
         if self.has_run:
             output = self.orthologs
         else:
@@ -241,14 +564,7 @@ class OrthologFinder:
             headers and the newline characters.
         """
         if st.startswith('>'):
-            fstr = re.split('>', st)
-            seq_list= []
-            for f in fstr:
-                if f:
-                    f = '>' + f
-                    f = f.rstrip()
-                    seq_list.append(f)
-            return seq_list
+            return [block.decode('utf-8') for block in fa.iter_blocks(st)]
         else: return [st]
 
     @classmethod
@@ -266,9 +582,7 @@ class OrthologFinder:
         newlist = seqhead.split(os.linesep)
         newlist = list(filter(None, newlist))
         header = newlist[0] + os.linesep + newlist[1]
-        newlist.pop(0)
-        newlist.insert(0, header)
-        newstring = ''.join(newlist)
+        newstring = header + ''.join(newlist[2:])
         return newstring
 
     @classmethod
@@ -301,12 +615,11 @@ class OrthologFinder:
             fasta(str): The proteins in fasta format
         Returns: A string containing the proteins in fasta format, without the first protein
         """
-        fasta_list = OrthologFinder.indv_block(fasta)
-        fasta_list.pop(0)
-        fasta_string = ''
-        for f in fasta_list:
-            fasta_string = fasta_string + f + os.linesep
-        return fasta_string
+        if not fasta.startswith('>'):
+            return ''
+        blocks = fa.iter_blocks(fasta)
+        next(blocks, None)
+        return ''.join(block.decode('utf-8') + os.linesep for block in blocks)
 
     @classmethod
     def remove_protein(cls, fasta, id):
@@ -318,11 +631,120 @@ class OrthologFinder:
         Returns:
              A string containing the proteins in fasta format, without the protein with the entered id
         """
-        fasta_list = OrthologFinder.indv_block(fasta)
-        for protein in fasta_list:
-            if id in protein:
-                fasta_list.remove(protein)
-        fasta_string = ''
-        for protein in fasta_list:
-            fasta_string = fasta_string + protein + os.linesep
-        return fasta_string
+        if not fasta.startswith('>'):
+            return '' if id in fasta else fasta + os.linesep
+        blocks = fa.iter_blocks(fasta)
+        return ''.join(block.decode('utf-8') + os.linesep for block in blocks
+                       if id.encode('utf-8') not in fa.block_header(block))
+
+
+OrthologResult = namedtuple('OrthologResult', ['index', 'fasta', 'orthologs', 'error'])
+OrthologResult.__doc__ = """
+The outcome of retrieving the orthologs of one protein of a batch. index is the position of the
+protein in the input, fasta the input itself, orthologs the fasta string of its orthologs and error
+the exception raised if they could not be retrieved, in which case orthologs is None.
+"""
+
+
+class AsyncOrthologFinder:
+    """
+    Retrieves the orthologs of many proteins concurrently. For every protein, the same
+    sequence --> OMA id --> HOG level --> fasta chain as OrthologFinder is run, using the
+    OrthologFinder URL builders and response parsers, with the blocking requests running in a
+    thread pool so that up to `concurrency` proteins are queried at the same time.
+    """
+
+    def __init__(self, session=None, concurrency=10, hogs=True, cache=None, retries=4, backoff=1.0, base_url=None,
+                 rate_limit=None):
+        """
+        Args:
+            session(OMASession): The session used to query OMA. Defaults to a new session with a
+                connection pool large enough for the concurrency
+            cache(cachestore.DiskCache): A persistent cache of the OMA responses
+            concurrency(int): The maximum number of proteins queried at the same time
+            hogs(boolean): If true, retrieve the HOG of each protein and fall back on its orthologs
+                if the HOG could not be retrieved. If false, retrieve the orthologs only
+            base_url(str): The server queried instead of OMA, see OrthologFinder
+            rate_limit(float): The maximum number of requests per second of the new session, for all the
+                proteins together. Only used without a session
+        """
+        self.session = session or OMASession(pool_size=concurrency, rate_limit=rate_limit)
+        self.concurrency = concurrency
+        self.hogs = hogs
+        self.cache = cache
+        self.retries = retries
+        self.backoff = backoff
+        self.base_url = base_url
+
+    async def fetch(self, fasta, executor=None):
+        """
+        Retrieves the orthologs of a single protein
+        Args:
+            fasta(str): The protein sequence, or a string in fasta format
+            executor(concurrent.futures.Executor): Runs the blocking requests. Defaults to
+                the executor of the event loop
+        Returns:
+            A fasta string of the orthologs, as returned by OrthologFinder.get_HOGs or
+            OrthologFinder.get_orthologs
+        """
+        if not fasta:
+            raise SequenceError("Input sequence is empty!")
+        loop = asyncio.get_running_loop()
+        finder = OrthologFinder(fasta, session=self.session, cache=self.cache, retries=self.retries,
+                                backoff=self.backoff, base_url=self.base_url)
+        finder.sequence = OrthologFinder.get_fasta_sequence(fasta=fasta)
+        await loop.run_in_executor(executor, finder.retrieve_OMAid)
+        if self.hogs:
+            try:
+                await loop.run_in_executor(executor, finder.retrieve_HOG_level)
+                output = await loop.run_in_executor(executor, finder.HOG_to_fasta)
+                return OrthologFinder.remove_protein(output, finder.id)
+            except exceptions.RequestException:
+                pass
+        output = await loop.run_in_executor(executor, finder.ortholog_to_fasta)
+        output = OrthologFinder.remove_first_protein(output)
+        return OrthologFinder.seqnwl_strip(finder.sequence) + os.linesep + output
+
+    async def fetch_hogs_many(self, sequences):
+        """
+        Retrieves the orthologs of many proteins concurrently
+        Args:
+            sequences(iterable): The protein sequences or fasta strings
+        Yields:
+            An OrthologResult for every protein, in the order in which they finish. A protein
+            that fails does not stop the others; its exception is stored in the result instead.
+        """
+        semaphore = asyncio.Semaphore(self.concurrency)
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+
+            async def job(index, fasta):
+                async with semaphore:
+                    try:
+                        orthologs = await self.fetch(fasta, executor)
+                    except Exception as e:
+                        return OrthologResult(index, fasta, None, e)
+                    return OrthologResult(index, fasta, orthologs, None)
+
+            tasks = [asyncio.ensure_future(job(i, f)) for i, f in enumerate(sequences)]
+            try:
+                for finished in asyncio.as_completed(tasks):
+                    yield await finished
+            finally:
+                for task in tasks:
+                    task.cancel()
+
+
+def fetch_hogs_many(sequences, concurrency=10, hogs=True, session=None, cache=None, base_url=None, rate_limit=None):
+    """
+    Blocking wrapper around AsyncOrthologFinder.fetch_hogs_many, for callers that do not run
+    an event loop
+    Returns:
+        A list of OrthologResult, in the order in which the proteins finished
+    """
+    finder = AsyncOrthologFinder(session=session, concurrency=concurrency, hogs=hogs, cache=cache, base_url=base_url,
+                                 rate_limit=rate_limit)
+
+    async def collect():
+        return [result async for result in finder.fetch_hogs_many(sequences)]
+
+    return asyncio.run(collect())
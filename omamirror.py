@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Local mirror of the part of the OMA browser that oma.OrthologFinder queries, built from the OMA
+bulk downloads (https://omabrowser.org/oma/current/), to retrieve orthologs without the latency
+of the network and to load test the pipeline without putting the load on OMA.
+
+A mirror is a folder holding the sequences of the proteins, one record after the other, and a
+SQLite index of the proteins, their orthologs and their HOGs. It is built once from:
+    sequences: the proteins in fasta format, such as oma-seqs.fa.gz. The first word of every
+        header is the OMA id, and the next one, if any, the canonical id
+    pairs: the pairs of orthologs, such as oma-pairs.txt.gz, with the OMA ids of the two proteins
+        in the first two tab separated columns
+    hogs: the HOGs, one line per HOG and taxonomic level with the tab separated HOG id, level and
+        OMA ids of the members. The levels of a protein are expected from the root of its HOG down
+
+    python omamirror.py build mirror --sequences oma-seqs.fa.gz --pairs oma-pairs.txt.gz --hogs hogs.tsv
+    python omamirror.py serve mirror --port 8000
+
+and queried by giving the url of the server to the finders:
+
+    oma.OrthologFinder(sequence, base_url='http://127.0.0.1:8000').get_HOGs()
+
+Unlike OMA, the mirror only finds a protein from its exact sequence, ignoring case and whitespace.
+"""
+
+import argparse
+import gzip
+import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+import fasta as fa
+from biskit.errors import BiskitError
+from cachestore import hash_key
+
+class MirrorError(BiskitError):
+    pass
+
+INDEX = 'index.sqlite'
+SEQUENCES = 'proteins.fa'
+
+def open_text(path):
+    """
+    Opens a bulk download file for reading, decompressing it if its name ends with .gz
+    """
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt')
+    return open(path, 'r')
+
+def sequence_key(sequence):
+    """
+    Returns:
+        The key a sequence is looked up by: the hash of its residues in upper case, without whitespace
+    """
+    if isinstance(sequence, bytes):
+        sequence = sequence.decode('utf-8')
+    return hash_key(''.join(sequence.split()).upper())
+
+
+def build_index(folder, sequences, pairs=None, hogs=None):
+    """
+    Builds a mirror from the bulk download files. An existing mirror in the folder is replaced
+    Args:
+        folder(str): The folder of the mirror. Created if it does not exist
+        sequences(str): The fasta file of the proteins, optionally gzipped
+        pairs(str): The file of the pairs of orthologs, optionally gzipped
+        hogs(str): The file of the HOGs, optionally gzipped
+    Returns:
+        The MirrorIndex of the mirror
+    """
+    os.makedirs(folder, exist_ok=True)
+    path = folder + os.sep + INDEX
+    if os.path.exists(path):
+        os.remove(path)
+    db = sqlite3.connect(path)
+    db.execute('CREATE TABLE proteins (omaid TEXT PRIMARY KEY, canonicalid TEXT, sequence TEXT, '
+               'offset INTEGER, length INTEGER)')
+    db.execute('CREATE TABLE orthologs (omaid TEXT, ortholog TEXT)')
+    db.execute('CREATE TABLE hogs (hog TEXT, level TEXT, omaid TEXT, rank INTEGER)')
+
+    # The records are copied uncompressed, so that each can be read back from its offset
+    with open_text(sequences) as source, open(folder + os.sep + SEQUENCES, 'wb') as output:
+        rows = []
+        for block in fa.iter_blocks(source):
+            header, _, sequence = block.partition(b'\n')
+            words = header[1:].replace(b'|', b' ').split()
+            if not words:
+                raise MirrorError('A protein of %s has no id' % sequences)
+            omaid = words[0].decode('utf-8')
+            canonicalid = words[1].decode('utf-8') if len(words) > 1 else omaid
+            rows.append((omaid, canonicalid, sequence_key(sequence), output.tell(), len(block)))
+            fa.write_blocks([block], output, linesep='\n')
+            if len(rows) == 10000:
+                db.executemany('INSERT OR REPLACE INTO proteins VALUES (?, ?, ?, ?, ?)', rows)
+                rows = []
+        db.executemany('INSERT OR REPLACE INTO proteins VALUES (?, ?, ?, ?, ?)', rows)
+
+    if pairs is not None:
+        with open_text(pairs) as source:
+            def ortholog_rows():
+                for line in source:
+                    if line.startswith('#') or not line.strip():
+                        continue
+                    first, second = line.split('\t')[:2]
+                    first, second = first.strip(), second.strip()
+                    yield first, second
+                    yield second, first
+            db.executemany('INSERT INTO orthologs VALUES (?, ?)', ortholog_rows())
+
+    if hogs is not None:
+        with open_text(hogs) as source:
+            def hog_rows():
+                for rank, line in enumerate(source):
+                    if line.startswith('#') or not line.strip():
+                        continue
+                    fields = line.rstrip('\n').split('\t')
+                    if len(fields) < 3:
+                        raise MirrorError('Line %i of %s does not have a HOG id, a level and members' % (rank + 1, hogs))
+                    for omaid in fields[2:]:
+                        if omaid.strip():
+                            yield fields[0], fields[1], omaid.strip(), rank
+            db.executemany('INSERT INTO hogs VALUES (?, ?, ?, ?)', hog_rows())
+
+    db.execute('CREATE INDEX sequence_index ON proteins (sequence)')
+    db.execute('CREATE INDEX ortholog_index ON orthologs (omaid)')
+    db.execute('CREATE INDEX hog_member_index ON hogs (omaid, level)')
+    db.execute('CREATE INDEX hog_index ON hogs (hog, level)')
+    db.commit()
+    db.close()
+    return MirrorIndex(folder)
+
+
+class MirrorIndex:
+    """
+    Reads a mirror built by build_index. Safe to share between threads, each of which opens its
+    own connection to the index.
+    """
+
+    def __init__(self, folder):
+        """
+        Args:
+            folder(str): The folder of the mirror
+        """
+        self.folder = os.path.abspath(folder)
+        if not os.path.isfile(self.folder + os.sep + INDEX):
+            raise MirrorError('%s is not an OMA mirror' % self.folder)
+        self._local = threading.local()
+
+    @property
+    def db(self):
+        if getattr(self._local, 'db', None) is None:
+            self._local.db = sqlite3.connect('file:%s?mode=ro' % (self.folder + os.sep + INDEX), uri=True)
+        return self._local.db
+
+    def find_sequence(self, sequence):
+        """
+        Returns:
+            The OMA id and canonical id of the protein with the sequence, or None if it is not in the mirror
+        """
+        return self.db.execute('SELECT omaid, canonicalid FROM proteins WHERE sequence = ? ORDER BY omaid LIMIT 1',
+                               (sequence_key(sequence),)).fetchone()
+
+    def __contains__(self, omaid):
+        return self.db.execute('SELECT 1 FROM proteins WHERE omaid = ?', (omaid,)).fetchone() is not None
+
+    def orthologs(self, omaid):
+        """
+        Returns:
+            The list of the (OMA id, canonical id) of the orthologs of a protein
+        """
+        return self.db.execute('SELECT proteins.omaid, proteins.canonicalid FROM orthologs JOIN proteins '
+                               'ON proteins.omaid = orthologs.ortholog WHERE orthologs.omaid = ? '
+                               'ORDER BY orthologs.rowid', (omaid,)).fetchall()
+
+    def hog_levels(self, omaid):
+        """
+        Returns:
+            The taxonomic levels of the HOGs of a protein, from the root down
+        """
+        rows = self.db.execute('SELECT level FROM hogs WHERE omaid = ? ORDER BY rank', (omaid,))
+        return [row[0] for row in rows]
+
+    def hog_members(self, omaid, level):
+        """
+        Returns:
+            The OMA ids of the members of the HOG of a protein at a taxonomic level, empty if the
+            protein has no HOG at that level
+        """
+        rows = self.db.execute('SELECT members.omaid FROM hogs JOIN hogs AS members '
+                               'ON members.hog = hogs.hog AND members.level = hogs.level '
+                               'WHERE hogs.omaid = ? AND hogs.level = ? ORDER BY members.rowid', (omaid, level))
+        return [row[0] for row in rows]
+
+    def blocks(self, omaids):
+        """
+        Yields the fasta blocks of proteins, in the order of the ids. Unknown ids are skipped
+        """
+        with open(self.folder + os.sep + SEQUENCES, 'rb') as file:
+            for omaid in omaids:
+                row = self.db.execute('SELECT offset, length FROM proteins WHERE omaid = ?', (omaid,)).fetchone()
+                if row is not None:
+                    file.seek(row[0])
+                    yield file.read(row[1])
+
+    def close(self):
+        """
+        Closes the connection of the calling thread
+        """
+        if getattr(self._local, 'db', None) is not None:
+            self._local.db.close()
+            self._local.db = None
+
+
+class MirrorHandler(BaseHTTPRequestHandler):
+    """
+    Answers the queries of OrthologFinder from the MirrorIndex of the server, in the formats of
+    the OMA browser
+    """
+
+    ROUTES = [
+        (re.compile(r'^/api/sequence/$'), 'sequence'),
+        (re.compile(r'^/api/hog/([^/]+)/$'), 'hog'),
+        (re.compile(r'^/api/protein/([^/]+)/orthologs/$'), 'orthologs'),
+        (re.compile(r'^/oma/hogs/([^/]+)/([^/]+)/fasta/$'), 'hog_fasta'),
+        (re.compile(r'^/oma/vps/([^/]+)/fasta/$'), 'vps_fasta'),
+    ]
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        for pattern, name in self.ROUTES:
+            match = pattern.match(url.path)
+            if match:
+                args = [unquote(group) for group in match.groups()]
+                getattr(self, 'get_' + name)(parse_qs(url.query), *args)
+                return
+        self.send_body(404, {'detail': 'Not found.'})
+
+    def send_body(self, status, body, content_type='application/json'):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_fasta(self, omaids):
+        index = self.server.index
+        body = b''.join(block + b'\n' for block in index.blocks(omaids))
+        self.send_body(200, body, 'text/plain')
+
+    def get_sequence(self, query):
+        sequence = query.get('query', [''])[0]
+        found = self.server.index.find_sequence(sequence) if sequence else None
+        if found is None:
+            self.send_body(404, {'detail': 'Not found.'})
+        else:
+            self.send_body(200, {'query': sequence, 'targets': [{'omaid': found[0], 'canonicalid': found[1]}]})
+
+    def get_hog(self, query, omaid):
+        levels = self.server.index.hog_levels(omaid)
+        if not levels:
+            self.send_body(404, {'detail': 'Not found.'})
+        else:
+            self.send_body(200, [{'level': levels[0], 'alternative_levels': levels}])
+
+    def get_orthologs(self, query, omaid):
+        if omaid not in self.server.index:
+            self.send_body(404, {'detail': 'Not found.'})
+        else:
+            self.send_body(200, [{'omaid': o, 'canonicalid': c} for o, c in self.server.index.orthologs(omaid)])
+
+    def get_hog_fasta(self, query, omaid, level):
+        members = self.server.index.hog_members(omaid, level)
+        if not members:
+            self.send_body(404, {'detail': 'Not found.'})
+        else:
+            self.send_fasta(members)
+
+    def get_vps_fasta(self, query, omaid):
+        if omaid not in self.server.index:
+            self.send_body(404, {'detail': 'Not found.'})
+        else:
+            # Like OMA, the protein itself comes first
+            self.send_fasta([omaid] + [o for o, _ in self.server.index.orthologs(omaid)])
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class MirrorServer(ThreadingHTTPServer):
+    """
+    An HTTP server answering the queries of OrthologFinder from a mirror, one thread per connection.
+
+        with MirrorServer('mirror') as server:
+            server.start()
+            oma.OrthologFinder(sequence, base_url=server.url).get_HOGs()
+    """
+
+    daemon_threads = True
+
+    def __init__(self, folder, host='127.0.0.1', port=0, verbose=False):
+        """
+        Args:
+            folder(str): The folder of the mirror
+            host(str): The address the server listens on
+            port(int): The port the server listens on. 0 picks a free port, see url
+            verbose(boolean): If true, every request is logged to stderr
+        """
+        self.index = MirrorIndex(folder)
+        self.verbose = verbose
+        self.thread = None
+        super().__init__((host, port), MirrorHandler)
+
+    @property
+    def url(self):
+        """
+        The base url of the server, to give to OrthologFinder
+        """
+        host, port = self.server_address[:2]
+        return 'http://%s:%i' % (host, port)
+
+    def start(self):
+        """
+        Serves the requests in a background thread
+        """
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def close(self):
+        """
+        Stops the server and releases its port
+        """
+        if self.thread is not None:
+            self.shutdown()
+            self.thread.join()
+            self.thread = None
+        self.server_close()
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Builds and serves a local mirror of the OMA browser')
+    commands = parser.add_subparsers(dest='command', required=True)
+    build = commands.add_parser('build', help='Indexes the bulk download files into a mirror folder')
+    build.add_argument('folder', help='The folder of the mirror')
+    build.add_argument('--sequences', required=True, help='The fasta file of the proteins')
+    build.add_argument('--pairs', help='The file of the pairs of orthologs')
+    build.add_argument('--hogs', help='The tab separated file of the HOGs')
+    serve = commands.add_parser('serve', help='Serves a mirror folder over HTTP')
+    serve.add_argument('folder', help='The folder of the mirror')
+    serve.add_argument('--host', default='127.0.0.1', help='The address to listen on')
+    serve.add_argument('--port', type=int, default=8000, help='The port to listen on')
+    serve.add_argument('--verbose', action='store_true', help='Logs every request')
+    args = parser.parse_args(argv)
+
+    if args.command == 'build':
+        build_index(args.folder, args.sequences, pairs=args.pairs, hogs=args.hogs)
+        return 0
+    with MirrorServer(args.folder, args.host, args.port, verbose=args.verbose) as server:
+        print('Serving the OMA mirror %s at %s' % (args.folder, server.url))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
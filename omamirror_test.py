@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Test file for the local OMA mirror
+"""
+import biskit.test
+import gzip
+import os
+import shutil
+import tempfile
+import fasta as fa
+import oma
+import omamirror
+
+
+class TestMirror(biskit.test.BiskitTest):
+    """
+    Test suite testing that OrthologFinder retrieves orthologs from a local mirror
+    """
+
+    TAGS = [biskit.test.NORMAL]
+
+    @classmethod
+    def setUpClass(cls):
+        self = cls
+        self.directory = tempfile.mkdtemp()
+        with open('example_data' + os.sep + 'ATN1_HOGS.txt', 'rb') as file:
+            self.blocks = list(fa.iter_blocks(file))[:5]
+        self.ids = [fa.block_header(block).split()[0].decode('utf-8') for block in self.blocks]
+        self.query = b''.join(self.blocks[0].partition(b'\n')[2].split()).decode('utf-8')
+        sequences = self.directory + os.sep + 'oma-seqs.fa.gz'
+        with gzip.open(sequences, 'wb') as file:
+            fa.write_blocks(self.blocks, file, linesep='\n')
+        pairs = self.directory + os.sep + 'oma-pairs.txt'
+        with open(pairs, 'w') as file:
+            file.write('# pairs\n%s\t%s\t1:1\n%s\t%s\t1:1\n' % (self.ids[0], self.ids[2], self.ids[3], self.ids[0]))
+        hogs = self.directory + os.sep + 'hogs.tsv'
+        with open(hogs, 'w') as file:
+            file.write('HOG:1\tMammalia\t%s\n' % '\t'.join(self.ids))
+            file.write('HOG:1.1a\tEutheria\t%s\n' % '\t'.join(self.ids[:3]))
+        self.folder = self.directory + os.sep + 'mirror'
+        self.index = omamirror.build_index(self.folder, sequences, pairs=pairs, hogs=hogs)
+        self.server = omamirror.MirrorServer(self.folder).start()
+        self.session = oma.OMASession()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.session.close()
+        cls.server.close()
+        cls.index.close()
+        shutil.rmtree(cls.directory)
+
+    def test_index(self):
+        """tests that the index finds proteins by sequence, orthologs and HOGs"""
+        self.assertEqual(self.index.find_sequence(self.query.lower()), (self.ids[0], 'ENSPCAG00000012030'))
+        self.assertIsNone(self.index.find_sequence('MKT'))
+        self.assertEqual([o for o, _ in self.index.orthologs(self.ids[0])], [self.ids[2], self.ids[3]])
+        self.assertEqual(self.index.hog_levels(self.ids[0]), ['Mammalia', 'Eutheria'])
+        self.assertEqual(self.index.hog_members(self.ids[4], 'Mammalia'), self.ids)
+        self.assertEqual(self.index.hog_members(self.ids[4], 'Eutheria'), [])
+        self.assertEqual(list(self.index.blocks([self.ids[1], 'unknown'])), [self.blocks[1]])
+
+    def test_get_HOGs(self):
+        """tests that the HOG of a protein is streamed from the mirror without the protein"""
+        finder = oma.OrthologFinder(self.query, session=self.session, base_url=self.server.url + '/')
+        path = finder.get_HOGs(path=self.directory + os.sep + 'hogs.orth')
+        self.assertEqual(finder.id, self.ids[0])
+        self.assertEqual(finder.hog_level, 'Mammalia')
+        self.assertTrue(all(url.startswith(self.server.url + '/') for url, _, _ in finder.timings))
+        with open(path, 'rb') as file:
+            self.assertEqual(list(fa.iter_blocks(file)), self.blocks[1:])
+
+    def test_get_orthologs(self):
+        """tests that the orthologs and their ids are read from the mirror"""
+        finder = oma.OrthologFinder(self.query, session=self.session, base_url=self.server.url)
+        orthologs = finder.get_orthologs()
+        self.assertEqual([fa.block_header(b).split()[0].decode('utf-8') for b in fa.iter_blocks(orthologs)],
+                         ['Input', self.ids[2], self.ids[3]])
+        finder.update_orthoIDs()
+        canonical = [fa.block_header(self.blocks[i]).split()[2].decode('utf-8') for i in (2, 3)]
+        self.assertEqual(finder.ortholog_ids, canonical)
+
+    def test_not_found(self):
+        """tests that unknown sequences and paths are answered with a 404"""
+        finder = oma.OrthologFinder('MKTRQNKDSM', session=self.session, base_url=self.server.url, retries=0)
+        with self.assertRaises(oma.exceptions.RequestException):
+            finder.get_HOGs()
+        self.assertEqual(finder.save_status, 404)
+        self.assertEqual(self.session.get(self.server.url + '/api/xref/').status_code, 404)
+
+
+if __name__ == '__main__':
+    biskit.test.localTest()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Offline stand-in for the OMA browser, for tests and benchmarks. A StubAdapter mounted on an
+oma.OMASession answers the queries of OrthologFinder from payloads kept in memory, without any
+network access:
+
+    session = oma.OMASession()
+    session.mount(oma.OrthologFinder.OMA_BASE_URL, StubAdapter(oma_routes('LOXAF14113', 'Amniota', hogs)))
+    oma.OrthologFinder(sequence, session=session).get_HOGs()
+"""
+
+import io
+import json
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import BaseAdapter
+
+
+def oma_routes(omaid, level, hogs, orthologs=None):
+    """
+    Builds the routes answering the queries OrthologFinder sends to OMA for a single protein
+    Args:
+        omaid(str): The OMA id returned for the sequence query
+        level(str): The taxonomic level of the HOG
+        hogs(bytes): The fasta payload of the HOG, including the protein itself
+        orthologs(bytes): The fasta payload of the orthologs. Defaults to the HOG
+    Returns:
+        A dictionary of routes for StubAdapter
+    """
+    return {
+        '/api/sequence/': json.dumps({'targets': [{'omaid': omaid}]}).encode('utf-8'),
+        '/api/hog/%s/' % omaid: json.dumps([{'level': level, 'alternative_levels': [level]}]).encode('utf-8'),
+        '/oma/hogs/%s/%s/fasta/' % (omaid, level): hogs,
+        '/oma/vps/%s/fasta/' % omaid: hogs if orthologs is None else orthologs,
+    }
+
+
+class StubAdapter(BaseAdapter):
+    """
+    A requests transport adapter that answers from a dictionary of routes instead of the network.
+    Routes are matched on the path of the url, without its query string. A route is the body of
+    the response as bytes, or a function called with the requests.PreparedRequest that returns
+    the body, or a (status code, body) tuple. Unknown paths are answered with a 404.
+    """
+
+    def __init__(self, routes):
+        """
+        Args:
+            routes(dict): The responses, by path
+        """
+        super().__init__()
+        self.routes = routes
+        self.requests = []
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        self.requests.append(request.url)
+        route = self.routes.get(urlsplit(request.url).path)
+        if callable(route):
+            route = route(request)
+        if route is None:
+            status, body = 404, b'{"detail": "Not found."}'
+        elif isinstance(route, tuple):
+            status, body = route
+        else:
+            status, body = 200, route
+        response = requests.Response()
+        response.status_code = status
+        response.url = request.url
+        response.request = request
+        response.raw = io.BytesIO(body)
+        response.headers['Content-Length'] = str(len(body))
+        return response
+
+    def close(self):
+        pass
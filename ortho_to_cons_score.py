@@ -1,10 +1,18 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 """
-Intakes the sequence or fasta string of a protein using the standard, single letter alphabet,
-gets the orthologs from an external (online) database, the OMA browser. It then generates a
-multiple sequence alignment (MSA) using T-Coffee, and calculates the conservation score of each
-amino acid at each position using Rate4Site, with respect to the entered sequence.
+Command line interface of the pipeline. Intakes the proteins of one or more multi-fasta files, or of
+list files naming fasta files, gets the orthologs of every protein from the OMA browser, aligns them
+and calculates the conservation score of each amino acid with Rate4Site (or a faster in process
+engine), running the proteins in parallel with seq2conservation.run_batch.
+
+One record is written per protein as soon as it finishes, either as a line of JSON or as a tab
+separated row, so that the output of a long run can be read while it runs. A run that was
+interrupted is resumed with --resume, which keeps the proteins already scored in the output and
+runs the others again, each from the last checkpoint of its pipe.
+
+    python ortho_to_cons_score.py proteome.fasta --jobs 8 --output scores.jsonl
+    python ortho_to_cons_score.py proteome.fasta --jobs 8 --output scores.jsonl --resume
 
 Citations
 OMA database:
@@ -21,44 +29,217 @@ Mayrose, I., Graur, D., Ben-Tal, N., and Pupko, T. 2004. Comparison of site-spec
 Bayesian methods are superior. Mol Biol Evol 21: 1781-1791.
 """
 
-import oma
-import aminoCons
 import argparse
+import json
+import math
 import os
+import sys
+import tempfile
+import cachestore
+import scoring
+import seq2conservation
+
+#: The columns of the tab separated output
+TSV_COLUMNS = ['name', 'alpha', 'error', 'sequence', 'score', 'qq_interval', 'std', 'msa_data']
+
+
+def read_inputs(paths):
+    """
+    Reads the proteins of the input files. A file whose first line starts with > is read as a multi-fasta
+    file; any other file as a list of fasta files, one path per line, relative to the list file. Empty
+    lines and lines starting with # are skipped
+    Args:
+        paths(list): The input files
+    Yields:
+        (name, fasta) pairs, see seq2conservation.iter_fasta_pairs
+    """
+    for path in paths:
+        with open(path, 'r') as file:
+            first = next((line for line in file if line.strip()), '')
+        if first.lstrip().startswith('>') or not first.strip():
+            yield from seq2conservation.iter_fasta_pairs(path)
+            continue
+        folder = os.path.dirname(os.path.abspath(path))
+        with open(path, 'r') as file:
+            listed = [line.strip() for line in file if line.strip() and not line.startswith('#')]
+        for entry in listed:
+            entry = os.path.join(folder, entry)
+            if not os.path.isfile(entry):
+                raise FileNotFoundError('%s, listed in %s, does not exist' % (entry, path))
+            yield from seq2conservation.iter_fasta_pairs(entry)
+
+
+def score_fields(args):
+    """
+    Returns:
+        The names of the information given for every residue, in the order of the score tuples of the pipe
+    """
+    flags = [(True, 'aa'), (True, 'score'), (args.qqint, 'qq_interval'), (args.std, 'std'), (args.gapped, 'msa_data')]
+    return [name for flag, name in flags if flag]
+
+
+def _plain(value):
+    """
+    Turns a value of a score tuple into plain json, nan becoming None
+    """
+    if isinstance(value, tuple):
+        return [_plain(v) for v in value]
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value
+
+
+def format_record(result, fields, fmt='jsonl'):
+    """
+    Formats the PipeResult of a protein as a line of the output
+    Args:
+        result(seq2conservation.PipeResult): The result of the protein
+        fields(list): The names of the information in the score tuples, see score_fields
+        fmt(str): jsonl or tsv
+    Returns:
+        The line, with its line ending
+    """
+    error = None if result.error is None else '%s: %s' % (type(result.error).__name__, result.error)
+    residues = [result.scores[i] for i in sorted(result.scores)] if result.scores else []
+    if fmt == 'jsonl':
+        record = {'name': result.name, 'alpha': _plain(result.alpha), 'error': error, 'fields': fields,
+                  'scores': [_plain(r) for r in residues],
+                  'wall': {s.stage: round(s.wall, 3) for s in result.stats or []}}
+        return json.dumps(record) + '\n'
+    column = {name: [r[i] for r in residues] for i, name in enumerate(fields)}
+    row = {'name': result.name, 'alpha': '' if result.alpha is None else '%g' % result.alpha,
+           'error': (error or '').replace('\t', ' ').replace('\n', ' '),
+           'sequence': ''.join(column.get('aa', [])),
+           'score': ','.join('%g' % v for v in column.get('score', [])),
+           'qq_interval': ','.join('%g:%g' % v for v in column.get('qq_interval', [])),
+           'std': ','.join('%g' % v for v in column.get('std', [])),
+           'msa_data': ','.join(column.get('msa_data', []))}
+    return '\t'.join(row[name] for name in TSV_COLUMNS) + '\n'
+
 
-OLD_DIR = os.getcwd()
+def completed(path, fmt='jsonl'):
+    """
+    Keeps only the records of the proteins that were scored in the output of an earlier run, dropping
+    those that failed and a last line cut short by an interruption, so that the run can be resumed
+    Args:
+        path(str): The output file of the earlier run
+        fmt(str): jsonl or tsv
+    Returns:
+        The set of the names of the proteins that were scored
+    """
+    if not os.path.isfile(path):
+        return set()
+    names = set()
+    kept = []
+    with open(path, 'r') as file:
+        for line in file:
+            if not line.endswith('\n'):
+                break
+            if fmt == 'jsonl':
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                name, error = record.get('name'), record.get('error')
+            else:
+                if line.startswith('#'):
+                    continue
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) != len(TSV_COLUMNS):
+                    continue
+                name, error = fields[0], fields[2]
+            if not error and name not in names:
+                names.add(name)
+                kept.append(line)
+    handle, temp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+    with os.fdopen(handle, 'w') as file:
+        if fmt == 'tsv':
+            file.write('#' + '\t'.join(TSV_COLUMNS) + '\n')
+        file.writelines(kept)
+    os.replace(temp, path)
+    return names
 
-parser = argparse.ArgumentParser()
-parser.add_argument("sequence", help="Input the sequence of the protein of interest")
-parser.add_argument("--hogs", action="store_true", help="When specified, the Hierarchical Orthologous Group (HOGs) of the sequence is returned")
-parser.add_argument("--name", default="Protein_sequence", help="The name of the protein. All files generated will be based on this name")
-parser.add_argument("--identity", action="store_true", help="The identity of the amino acid (Single letter code) at each position")
-parser.add_argument("--score", action="store_true", help="The conservation scores. lower value = higher conservation")
-parser.add_argument("--qqint", action="store_true", help="QQ-INTERVAL, the confidence interval for the rate estimates. The default interval is 25-75 percentiles")
-parser.add_argument("--std", action="store_true", help="The standard deviation of the posterior rate distribution")
-parser.add_argument("--gapped", action="store_true", help="MSA DATA, the number of aligned sequences having an amino acid (non-gapped) from the overall number of sequences at each position")
-args = parser.parse_args()
 
-with open(args.sequence, 'r') as prot_file:
-    prot_seq = prot_file.read()
+def build_parser():
+    parser = argparse.ArgumentParser(description='Calculates the conservation score of every amino acid of proteins, '
+                                                 'from their orthologs in the OMA browser')
+    parser.add_argument('inputs', nargs='+', help='Multi-fasta files of the proteins, or list files naming one fasta '
+                                                  'file per line')
+    parser.add_argument('-o', '--output', help='The output file. Defaults to the standard output')
+    parser.add_argument('--format', choices=['jsonl', 'tsv'],
+                        help='The output format: one line of JSON, or one tab separated row, per protein. Defaults to '
+                             'tsv for an output ending with .tsv, jsonl otherwise')
+    parser.add_argument('--resume', action='store_true',
+                        help='Skips the proteins already scored in the output and resumes the others from their checkpoints')
+    parser.add_argument('--jobs', type=int, help='The number of proteins processed at the same time')
+    parser.add_argument('--threads', type=int, help='The number of threads of every protein, for the aligner and Rate4Site')
+    parser.add_argument('--cpus', type=int, help='The CPUs shared by all the jobs. Defaults to the CPUs available')
+    parser.add_argument('--in-threads', action='store_true',
+                        help='Processes the proteins in threads of one process instead of worker processes')
+    parser.add_argument('--engine', default='rate4site', choices=['rate4site'] + list(scoring.METHODS),
+                        help='What scores the alignments: Rate4Site, or a faster in process method')
+    parser.add_argument('--aligner', default='auto', help='t_coffee, mafft, clustalo, muscle or auto')
+    parser.add_argument('--max-sequences', type=int, help='Aligns at most this many representative orthologs per protein')
+    parser.add_argument('--cluster-identity', type=float, default=0.9,
+                        help='The identity above which orthologs are represented by one of them')
+    parser.add_argument('--directory', help='The folder the alignments and checkpoints are kept in. Defaults to '
+                                            'Sequence_Alignments in the working directory')
+    parser.add_argument('--cache', action='store_true', help='Keeps the alignment of every protein in the directory')
+    parser.add_argument('--oma-url', help='The server the orthologs are retrieved from instead of the OMA browser')
+    parser.add_argument('--oma-cache', help='A file in which the OMA responses are cached between runs')
+    parser.add_argument('--rate-limit', type=float, help='The maximum number of requests per second sent to OMA by '
+                                                         'every worker process, or by the whole run with --in-threads')
+    parser.add_argument('--qqint', action='store_true', help='QQ-INTERVAL, the confidence interval for the rate estimates. '
+                                                             'The default interval is 25-75 percentiles')
+    parser.add_argument('--std', action='store_true', help='The standard deviation of the posterior rate distribution')
+    parser.add_argument('--gapped', action='store_true', help='MSA DATA, the number of aligned sequences having an amino '
+                        'acid (non-gapped) from the overall number of sequences at each position')
+    return parser
 
-if args.hogs:
-    seq2ortho = oma.OrthologFinder(prot_seq)
-    orthologs = seq2ortho.get_HOGs()
-else:
-    seq2ortho = oma.OrthologFinder(prot_seq)
-    orthologs = seq2ortho.get_orthologs()
 
-with open("%s.txt" %(args.name), 'w') as seq_file:
-    seq_file.write(orthologs)
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    fmt = args.format or ('tsv' if args.output and args.output.endswith('.tsv') else 'jsonl')
+    if args.resume and not args.output:
+        build_parser().error('--resume needs the --output of the run to resume')
 
-alignment = aminoCons.build_alignment(os.getcwd() + os.sep + "%s.txt"%(args.name))
+    done = completed(args.output, fmt) if args.resume else set()
+    # The names are made unique before skipping, so that they match those written by the earlier run
+    records = ((name, fasta) for name, fasta in seq2conservation.read_records(read_inputs(args.inputs))
+               if name not in done)
+    fields = score_fields(args)
+    options = dict(cache=args.cache, qqint=args.qqint, std=args.std, gapped=args.gapped, directory=args.directory,
+                   max_sequences=args.max_sequences, cluster_identity=args.cluster_identity, aligner=args.aligner,
+                   engine=args.engine, resume=args.resume, oma_url=args.oma_url, rate_limit=args.rate_limit)
+    if args.threads:
+        options['threads'] = args.threads
+    if args.oma_cache:
+        options['oma_cache'] = cachestore.DiskCache(args.oma_cache)
 
-cons_dict = aminoCons.Rate4Site(msa= (alignment + os.sep+ "%s.aln"%(args.name)), identity=args.identity,
-                                  score=args.score, qqint=args.qqint,std=args.std, gapped=args.gapped)
-cons_dict = cons_dict.run()
+    if args.output:
+        mode = 'a' if args.resume else 'w'
+        output = open(args.output, mode)
+    else:
+        output = sys.stdout
+    scored = failed = 0
+    try:
+        if fmt == 'tsv' and not (args.resume and os.path.getsize(args.output)):
+            output.write('#' + '\t'.join(TSV_COLUMNS) + '\n')
+        for result in seq2conservation.run_batch(records, jobs=args.jobs, processes=not args.in_threads,
+                                                 cpus=args.cpus, **options):
+            output.write(format_record(result, fields, fmt))
+            output.flush()
+            if result.error is None:
+                scored += 1
+            else:
+                failed += 1
+                print('%s failed: %s' % (result.name, result.error), file=sys.stderr)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    print('Scored %i proteins, %i failed, %i skipped' % (scored, failed, len(done)), file=sys.stderr)
+    return 1 if failed else 0
 
 
-with open("%s data"%(args.name), 'w') as mat_file:
-    output = str(cons_dict)
-    mat_file.write(output)
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Test file for the command line interface of the pipeline
+"""
+import biskit.test
+import io
+import json
+import os
+import shutil
+import tempfile
+import ortho_to_cons_score as cli
+import seq2conservation as sq
+from unittest.mock import patch
+
+
+class TestCLI(biskit.test.BiskitTest):
+    """
+    Test suite running the command line interface on the example proteins, with a mocked pipe
+    """
+
+    TAGS = [biskit.test.NORMAL]
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.fasta = os.getcwd() + os.sep + 'example_data' + os.sep + 'multiFasta.fasta'
+        self.output = self.directory + os.sep + 'scores.jsonl'
+        self.run = []
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def main(self, *argv):
+        """Runs the command line, with a pipe that fails for AT1G01140.2 and scores two residues otherwise"""
+        def pipe(pipe):
+            self.run.append(pipe.name)
+            if pipe.name == 'AT1G01140.2':
+                raise sq.PipelineError('no orthologs')
+            pipe.alpha = 1.5
+            return {1: ('K', -0.25, 3), 0: ('M', 0.5, 2)}
+        with patch.object(sq.ConservationPipe, 'pipe', pipe), patch('sys.stderr', io.StringIO()):
+            return cli.main(list(argv) + ['--in-threads', '--jobs', '2'])
+
+    def records(self):
+        with open(self.output, 'r') as file:
+            return {r['name']: r for r in map(json.loads, file)}
+
+    def test_jsonl(self):
+        """tests that every protein is written as a line of JSON and failures set the exit status"""
+        self.assertEqual(self.main(self.fasta, '--output', self.output, '--std'), 1)
+        records = self.records()
+        self.assertEqual(sorted(records), ['AT1G01140.1', 'AT1G01140.1_1', 'AT1G01140.2'])
+        self.assertEqual(records['AT1G01140.1']['scores'], [['M', 0.5, 2], ['K', -0.25, 3]])
+        self.assertEqual(records['AT1G01140.1']['fields'], ['aa', 'score', 'std'])
+        self.assertEqual(records['AT1G01140.1']['alpha'], 1.5)
+        self.assertIsNone(records['AT1G01140.1']['error'])
+        self.assertEqual(records['AT1G01140.2']['error'], 'PipelineError: no orthologs')
+
+    def test_resume(self):
+        """tests that a resumed run skips the scored proteins and drops failed and truncated records"""
+        self.main(self.fasta, '--output', self.output)
+        with open(self.output, 'r') as file:
+            lines = [l for l in file if '"AT1G01140.1_1"' not in l]
+        with open(self.output, 'w') as file:
+            file.writelines(lines)
+            file.write('{"name": "AT1G01140.1_1", "sco')
+        self.run = []
+        self.main(self.fasta, '--output', self.output, '--resume')
+        self.assertEqual(sorted(self.run), ['AT1G01140.1_1', 'AT1G01140.2'])
+        with open(self.output, 'r') as file:
+            names = [json.loads(l)['name'] for l in file]
+        self.assertEqual(sorted(names), ['AT1G01140.1', 'AT1G01140.1_1', 'AT1G01140.2'])
+
+    def test_tsv_list(self):
+        """tests the tab separated output of the proteins of a list file"""
+        listing = self.directory + os.sep + 'proteins.txt'
+        with open(listing, 'w') as file:
+            file.write('# proteins\n%s\n' % os.path.relpath(self.fasta, self.directory))
+        output = self.directory + os.sep + 'scores.tsv'
+        self.main(listing, '--output', output)
+        with open(output, 'r') as file:
+            rows = [line.rstrip('\n').split('\t') for line in file]
+        self.assertEqual(rows[0][0], '#name')
+        rows = {r[0]: dict(zip(cli.TSV_COLUMNS, r)) for r in rows[1:]}
+        self.assertEqual(rows['AT1G01140.1']['sequence'], 'MK')
+        self.assertEqual(rows['AT1G01140.1']['score'], '0.5,-0.25')
+        self.assertEqual(rows['AT1G01140.2']['alpha'], '')
+        self.run = []
+        self.main(listing, '--output', output, '--resume')
+        self.assertEqual(self.run, ['AT1G01140.2'])
+        with open(output, 'r') as file:
+            self.assertEqual(sum(line.startswith('#') for line in file), 1)
+
+
+if __name__ == '__main__':
+    biskit.test.localTest()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Redundancy reduction of sets of orthologs before they are aligned. The time taken by T-Coffee
+grows faster than the number of sequences, and large HOGs often contain many nearly identical
+sequences that add little information to the conservation scores.
+
+The sequences are clustered greedily by their k-mer content, in the manner of CD-HIT: every
+sequence, from the longest to the shortest, joins the representative it shares the most k-mers
+with if they share enough, or becomes the representative of a new cluster. Only the representatives are kept,
+up to a maximum number of sequences, and the reference sequence Rate4Site scores against is always
+kept first. It is the first sequence of the input, or a record given to reduce_fasta, which is added
+in front of the input when it is missing, as the HOGs of OMA do not contain the protein of interest.
+
+Citations
+CD-HIT:
+Li W, Godzik A. Cd-hit: a fast program for clustering and comparing large sets of protein or
+nucleotide sequences. Bioinformatics 2006, 22 (13): 1658-1659 (doi:10.1093/bioinformatics/btl158).
+"""
+
+import fasta as fa
+import numpy as np
+from collections import namedtuple
+from biskit.errors import BiskitError
+
+class RedundancyError(BiskitError):
+    pass
+
+
+Reduction = namedtuple('Reduction', ['kept', 'clusters', 'total'])
+Reduction.__doc__ = """
+The subset of sequences chosen by reduce_fasta. kept is the list of the ids of the sequences that
+were kept, in the order of the input. clusters maps the id of the representative of every cluster
+to the ids of its members, the representative first. total is the number of input sequences.
+"""
+
+
+#: The residues k-mers are made of. Any other letter is counted as X
+ALPHABET = b'ACDEFGHIKLMNPQRSTVWYX'
+_CODES = np.full(256, len(ALPHABET) - 1, dtype=np.int64)
+_CODES[np.frombuffer(ALPHABET, dtype=np.uint8)] = np.arange(len(ALPHABET))
+_CODES[np.frombuffer(ALPHABET.lower(), dtype=np.uint8)] = np.arange(len(ALPHABET))
+
+def kmers(sequence, k=3):
+    """
+    Args:
+        sequence(bytes): A sequence without whitespace
+        k(int): The length of the words
+    Returns:
+        The sorted array of the distinct words of length k in the sequence, each coded as an integer
+        below len(ALPHABET) ** k
+    """
+    residues = _CODES[np.frombuffer(sequence, dtype=np.uint8)]
+    count = len(residues) - k + 1
+    if count <= 0:
+        return np.zeros(0, dtype=np.int64)
+    codes = np.zeros(count, dtype=np.int64)
+    for j in range(k):
+        codes = codes * len(ALPHABET) + residues[j:j + count]
+    return np.unique(codes)
+
+
+def cluster_sequences(sequences, identity=0.9, k=3):
+    """
+    Clusters sequences greedily by their shared k-mers. A sequence with a fraction f of its k-mers
+    shared with a representative is estimated to have an identity of f ** (1 / k) to it, as every
+    residue of a word must be conserved for the word to be shared.
+
+    The words of the representatives are kept in a matrix with a row per word and a column per
+    representative, so that a sequence is compared to every representative at once.
+    Args:
+        sequences(list): The sequences, as bytes without whitespace. The first sequence is always
+            the representative of its cluster
+        identity(float): The estimated identity, between 0 and 1, above which a sequence joins a cluster
+        k(int): The length of the words compared, at most 4
+    Returns:
+        A list of clusters, each a list of indices of the sequences with the representative first.
+        The clusters are ordered by the length of their representatives, the first sequence's first.
+    """
+    if not 0 < identity <= 1:
+        raise RedundancyError('The identity must be between 0 and 1, not %r' % identity)
+    if not 1 <= k <= 4:
+        raise RedundancyError('The k-mers must be 1 to 4 residues long, not %r' % k)
+    threshold = identity ** k
+    order = sorted(range(1, len(sequences)), key=lambda i: -len(sequences[i]))
+    if sequences:
+        order.insert(0, 0)
+    clusters = []
+    # Identical sequences join the same cluster without being compared again
+    seen = {}
+    presence = np.zeros((len(ALPHABET) ** k, 16), dtype=bool)
+    for i in order:
+        if sequences[i] in seen:
+            clusters[seen[sequences[i]]].append(i)
+            continue
+        words = kmers(sequences[i], k)
+        best = None
+        if len(words) and clusters:
+            shared = presence[words, :len(clusters)].sum(axis=0)
+            best = int(np.argmax(shared))
+            if shared[best] == 0 or shared[best] < threshold * len(words):
+                best = None
+        if best is None:
+            if len(clusters) == presence.shape[1]:
+                presence = np.concatenate([presence, np.zeros_like(presence)], axis=1)
+            presence[words, len(clusters)] = True
+            best = len(clusters)
+            clusters.append([i])
+        else:
+            clusters[best].append(i)
+        seen.setdefault(sequences[i], best)
+    return clusters
+
+
+def select_clusters(clusters, max_sequences=None):
+    """
+    Chooses the clusters whose representatives are kept. When there are more clusters than
+    max_sequences, the first cluster and the largest of the others are kept, as they represent
+    the most sequences.
+    Args:
+        clusters(list): The clusters, as returned by cluster_sequences
+        max_sequences(int): The maximum number of clusters kept. None keeps them all
+    Returns:
+        The list of the kept clusters, in the order of their representatives in the input
+    """
+    if max_sequences is not None and max_sequences < 1:
+        raise RedundancyError('At least one sequence must be kept, not %r' % max_sequences)
+    chosen = clusters
+    if max_sequences is not None and len(clusters) > max_sequences:
+        rest = sorted(range(1, len(clusters)), key=lambda c: (-len(clusters[c]), c))
+        chosen = [clusters[c] for c in [0] + rest[:max_sequences - 1]]
+    return sorted(chosen, key=lambda cluster: cluster[0])
+
+
+def reduce_fasta(path, output=None, max_sequences=100, identity=0.9, k=3, reference=None):
+    """
+    Writes the representatives of the sequences of a fasta file to another file
+    Args:
+        path(str): The fasta file of the sequences. Without a reference, its first sequence is always kept
+        output(str): The file the kept sequences are written to, unchanged and in the order of the
+            input. Defaults to path, which is then replaced
+        max_sequences(int): The maximum number of sequences kept. None only removes the redundant sequences
+        identity(float): The estimated identity above which sequences are redundant, see cluster_sequences
+        k(int): The length of the words compared
+        reference(bytes): The fasta record of the reference sequence, which is always kept as the first
+            sequence. It is added in front of the input unless the first sequence of the input is the same
+    Returns:
+        A Reduction recording the chosen subset
+    """
+    with open(path, 'rb') as file:
+        blocks = list(fa.iter_blocks(file))
+    residues = lambda block: b''.join(block.partition(b'\n')[2].split()).upper()
+    if reference is not None:
+        reference = next(fa.iter_blocks(reference))
+        if not blocks or residues(blocks[0]) != residues(reference):
+            blocks.insert(0, reference)
+    sequences = [residues(block) for block in blocks]
+    ids = [(fa.block_header(block).split() or [b'%i' % i])[0].decode('utf-8') for i, block in enumerate(blocks)]
+    kept = select_clusters(cluster_sequences(sequences, identity=identity, k=k), max_sequences)
+    with open(output or path, 'wb') as file:
+        fa.write_blocks((blocks[cluster[0]] for cluster in kept), file)
+    clusters = {ids[cluster[0]]: [ids[i] for i in cluster] for cluster in kept}
+    return Reduction([ids[cluster[0]] for cluster in kept], clusters, len(blocks))
+
+
+def write_subset(reduction, path):
+    """
+    Records a reduction in a tab separated file, with a line for every kept sequence giving its
+    id and the ids of the sequences it represents
+    """
+    with open(path, 'w') as file:
+        file.write('#kept %i of %i sequences\n' % (len(reduction.kept), reduction.total))
+        for rep in reduction.kept:
+            file.write('\t'.join(reduction.clusters[rep]) + '\n')
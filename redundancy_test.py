@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Test file for the redundancy module
+"""
+import biskit.test
+import os
+import shutil
+import tempfile
+import redundancy
+
+
+class TestRedundancy(biskit.test.BiskitTest):
+    """
+    Test suite testing the k-mer clustering of orthologs
+    """
+
+    TAGS = [biskit.test.NORMAL]
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_cluster_near_identical(self):
+        """tests that nearly identical sequences are clustered and that distinct ones are not"""
+        sequences = [b'MKTRQNKDSMSMRSGRKKEAPG', b'MKTRQNKDSMSMRSGRKKEAPGA', b'MKTRQNKDSMSMRSGRKKEAPA',
+                     b'WYHCFPWELIVQGTNDRA']
+        clusters = redundancy.cluster_sequences(sequences, identity=0.9)
+        self.assertEqual(clusters, [[0, 1, 2], [3]])
+
+    def test_query_kept(self):
+        """tests that the first sequence stays a representative even when it is shorter than a similar one"""
+        sequences = [b'MKTRQNKDSMSMRSGRKKEAPG', b'MKTRQNKDSMSMRSGRKKEAPGAAA']
+        self.assertEqual(redundancy.cluster_sequences(sequences)[0], [0, 1])
+
+    def test_select_largest(self):
+        """tests that the first cluster and the largest others are kept when there are too many"""
+        clusters = [[0], [4], [1, 2, 3], [5, 6]]
+        self.assertEqual(redundancy.select_clusters(clusters, 3), [[0], [1, 2, 3], [5, 6]])
+        self.assertEqual(redundancy.select_clusters(clusters, 1), [[0]])
+        self.assertEqual(len(redundancy.select_clusters(clusters)), 4)
+        self.assertRaises(redundancy.RedundancyError, redundancy.select_clusters, clusters, 0)
+
+    def test_reduce_fasta(self):
+        """tests that only the representatives are written, unchanged and in order, and that the subset is recorded"""
+        path = self.directory + os.sep + 'orth.fasta'
+        with open(path, 'w') as file:
+            file.write('>query\nMKTRQNKDSMSMRSG\nRKKEAPG\n>copy | A\nMKTRQNKDSMSMRSGRKKEAPG\n'
+                       '>other\nWYHCFPWELIVQGTNDRA\n>shorter\nWYHCFPWELIVQGTNDR\n>third\nLLLPPPKKKEEEDDDGGG\n')
+        reduction = redundancy.reduce_fasta(path, max_sequences=2)
+        self.assertEqual(reduction.kept, ['query', 'other'])
+        self.assertEqual(reduction.clusters, {'query': ['query', 'copy'], 'other': ['other', 'shorter']})
+        self.assertEqual(reduction.total, 5)
+        with open(path) as file:
+            self.assertEqual(file.read(), '>query\nMKTRQNKDSMSMRSG\nRKKEAPG' + os.linesep +
+                             '>other\nWYHCFPWELIVQGTNDRA' + os.linesep)
+        subset = self.directory + os.sep + 'orth.subset'
+        redundancy.write_subset(reduction, subset)
+        with open(subset) as file:
+            self.assertEqual(file.read(), '#kept 2 of 5 sequences\nquery\tcopy\nother\tshorter\n')
+
+    def test_reduce_fasta_reference(self):
+        """tests that a reference missing from the sequences is added first and always kept"""
+        path = self.directory + os.sep + 'orth.fasta'
+        with open(path, 'w') as file:
+            file.write('>other\nWYHCFPWELIVQGTNDRA\n>shorter\nWYHCFPWELIVQGTNDR\n>third\nLLLPPPKKKEEEDDDGGG\n')
+        reduction = redundancy.reduce_fasta(path, max_sequences=2, reference=b'>query\nMKTRQNKDSMSMRSGRKKEAPG\n')
+        self.assertEqual(reduction.kept, ['query', 'other'])
+        self.assertEqual(reduction.total, 4)
+        with open(path) as file:
+            self.assertTrue(file.read().startswith('>query\nMKTRQNKDSMSMRSGRKKEAPG' + os.linesep + '>other'))
+        reduction = redundancy.reduce_fasta(path, reference=b'>Input Sequence\nmktrqnkdsmsmrsgrkkeapg')
+        self.assertEqual(reduction.kept, ['query', 'other'])
+
+
+if __name__ == '__main__':
+    biskit.test.localTest()
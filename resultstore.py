@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Columnar store of the conservation scores of many proteins, such as a whole proteome.
+
+A store is a folder holding one flat binary file per field of the Rate4Site residue table (see
+aminoCons.R4S_COLUMNS), with the residues of every protein one after the other, and an index
+giving the id, offset, length and alpha parameter of every protein. The ids are also kept sorted,
+with the row of each in the index, so that a protein is found by binary search on disk.
+
+Every file is memory mapped when the store is read, so opening a store costs nothing whatever its
+size, a lookup only reads the few pages it touches, and processes reading the same store share
+the pages of the operating system cache instead of each loading a copy.
+
+    with ResultWriter('scores.store') as writer:
+        for result in seq2conservation.run_batch('proteome.fasta', keep_table=True):
+            writer.add_result(result)
+
+    store = ResultStore('scores.store')
+    store['AT1G01140.1'][10:20]['score']
+    store.score('AT1G01140.1', 42)
+"""
+
+import json
+import os
+import numpy as np
+from aminoCons import R4S_COLUMNS, R4S_DTYPE, Rate4SiteResult
+from biskit.errors import BiskitError
+
+class ResultStoreError(BiskitError):
+    pass
+
+#: The version of the layout of the store, checked when a store is opened
+VERSION = 1
+META = 'meta.json'
+INDEX = 'index.npy'
+#: The sorted ids, encoded in utf-8, and the row of each in the index
+KEYS = 'keys.npy'
+ROWS = 'rows.npy'
+#: The types of the columns on disk. The amino acids are kept as single bytes
+STORE_DTYPE = np.dtype([(name, 'S1' if name == 'aa' else R4S_DTYPE[name]) for name in R4S_COLUMNS])
+
+def column_file(path, name):
+    return path + os.sep + '%s.col' % name
+
+
+class ResultWriter:
+    """
+    Appends the residue tables of proteins to a store. Proteins can be added to an existing store,
+    but a store must only be written by one writer at a time.
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path(str): The folder of the store. Created if it does not exist
+        """
+        self.path = os.path.abspath(path)
+        os.makedirs(self.path, exist_ok=True)
+        if os.path.isfile(self.path + os.sep + META):
+            store = ResultStore(self.path)
+            self.ids = store.ids.tolist()
+            self.offsets = store.index['offset'].tolist()
+            self.lengths = store.index['length'].tolist()
+            self.alphas = store.index['alpha'].tolist()
+            store.close()
+        else:
+            self.ids, self.offsets, self.lengths, self.alphas = [], [], [], []
+        self.known = set(self.ids)
+        self.size = self.offsets[-1] + self.lengths[-1] if self.ids else 0
+        # Anything past the indexed residues was written by a writer that did not finish
+        self.files = {}
+        for name in R4S_COLUMNS:
+            file = open(column_file(self.path, name), 'ab')
+            file.truncate(self.size * STORE_DTYPE[name].itemsize)
+            self.files[name] = file
+
+    def add(self, id, table, alpha=None):
+        """
+        Appends the residues of a protein
+        Args:
+            id(str): The id of the protein, unique within the store
+            table(numpy.ndarray): The residue table of the protein, as returned by Rate4Site.read_table or kept in Rate4SiteResult.table
+            alpha(float): The alpha parameter of Rate4Site
+        """
+        if id in self.known:
+            raise ResultStoreError('%s is already in the store' % id)
+        for name in R4S_COLUMNS:
+            self.files[name].write(np.ascontiguousarray(table[name], dtype=STORE_DTYPE[name]).tobytes())
+        self.ids.append(id)
+        self.known.add(id)
+        self.offsets.append(self.size)
+        self.lengths.append(len(table))
+        self.alphas.append(np.nan if alpha is None else alpha)
+        self.size += len(table)
+
+    def add_file(self, id, r4s):
+        """
+        Appends the residues of a protein from a Rate4Site output file, or a file with its layout,
+        parsed once into a Rate4SiteResult. Outputs without an alpha parameter, such as those of the
+        scoring module, are stored with an alpha of nan
+        Args:
+            id(str): The id of the protein, unique within the store
+            r4s(str): The file path to the Rate4Site output
+        """
+        parsed = Rate4SiteResult.read(r4s)
+        self.add(id, parsed.table, parsed.alpha)
+
+    def add_result(self, result):
+        """
+        Appends the residues of a PipeResult of seq2conservation.run_batch, run with keep_table
+        Returns:
+            True if the result was added, False if its pipe failed
+        """
+        if result.error is not None:
+            return False
+        if result.table is None:
+            raise ResultStoreError('The result of %s has no residue table, run the pipe with keep_table' % result.name)
+        self.add(result.name, result.table, result.alpha)
+        return True
+
+    def flush(self):
+        """
+        Writes the residues added so far and the index to disk, so that they can be read
+        """
+        for file in self.files.values():
+            file.flush()
+        width = max([len(i) for i in self.ids] + [1])
+        index = np.array(list(zip(self.ids, self.offsets, self.lengths, self.alphas)),
+                         dtype=[('id', 'U%i' % width), ('offset', np.int64), ('length', np.int64), ('alpha', np.float64)])
+        keys = np.array([i.encode('utf-8') for i in self.ids], dtype='S%i' % max([len(i.encode('utf-8')) for i in self.ids] + [1]))
+        rows = np.argsort(keys, kind='stable')
+        for name, array in [(INDEX, index), (KEYS, keys[rows]), (ROWS, rows.astype(np.int64))]:
+            temp = self.path + os.sep + '.%s.tmp' % name
+            with open(temp, 'wb') as file:
+                np.save(file, array)
+            os.replace(temp, self.path + os.sep + name)
+        with open(self.path + os.sep + META, 'w') as file:
+            json.dump({'version': VERSION, 'columns': [[name, STORE_DTYPE[name].str] for name in R4S_COLUMNS]}, file)
+
+    def close(self):
+        self.flush()
+        for file in self.files.values():
+            file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ResultStore:
+    """
+    Reads the conservation scores of a store. Indexing the store with a protein id returns the
+    residue table of the protein, as a structured array with the fields of aminoCons.R4S_DTYPE
+    that can be sliced by residue. Point and window lookups of a single column are read straight
+    from the memory mapped columns, see score and window.
+
+    A store can be sent to worker processes; the files are mapped again on first use.
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path(str): The folder of the store
+        """
+        self.path = os.path.abspath(path)
+        try:
+            with open(self.path + os.sep + META, 'r') as file:
+                meta = json.load(file)
+        except FileNotFoundError:
+            raise ResultStoreError('%s is not a result store' % self.path)
+        if meta['version'] != VERSION:
+            raise ResultStoreError('Unsupported result store version %r' % meta['version'])
+        self._maps = {}
+
+    def __getstate__(self):
+        # Memory maps cannot be pickled, they are mapped again on first use
+        state = self.__dict__.copy()
+        state['_maps'] = {}
+        return state
+
+    def _load(self, name):
+        if name not in self._maps:
+            self._maps[name] = np.load(self.path + os.sep + name, mmap_mode='r')
+        return self._maps[name]
+
+    @property
+    def index(self):
+        """
+        The memory mapped index, with the id, offset, length and alpha parameter of every protein
+        """
+        return self._load(INDEX)
+
+    @property
+    def ids(self):
+        """
+        The ids of the proteins, in the order they were added
+        """
+        return self.index['id']
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, id):
+        return self.find(id) is not None
+
+    def __iter__(self):
+        return iter(self.ids.tolist())
+
+    def find(self, id):
+        """
+        Finds a protein by binary search in the sorted ids
+        Returns:
+            The row of the protein in the index, or None if it is not in the store
+        """
+        keys = self._load(KEYS)
+        key = id.encode('utf-8')
+        i = int(np.searchsorted(keys, key))
+        if i < len(keys) and keys[i] == key:
+            return int(self._load(ROWS)[i])
+        return None
+
+    def row(self, id):
+        """
+        Returns:
+            The entry of the protein in the index
+        """
+        row = self.find(id)
+        if row is None:
+            raise KeyError('%s is not in the store' % id)
+        return self.index[row]
+
+    def column(self, name):
+        """
+        Returns:
+            The memory mapped column of every residue of the store
+        """
+        if name not in self._maps:
+            size = int(self.index['offset'][-1] + self.index['length'][-1]) if len(self.index) else 0
+            if size == 0:
+                self._maps[name] = np.zeros(0, dtype=STORE_DTYPE[name])
+            else:
+                self._maps[name] = np.memmap(column_file(self.path, name), dtype=STORE_DTYPE[name],
+                                             mode='r', shape=(size,))
+        return self._maps[name]
+
+    def bounds(self, id, start=None, stop=None):
+        """
+        Returns:
+            The range of the residues start to stop of a protein in the columns, counting residues
+            from 0 like a python slice
+        """
+        entry = self.row(id)
+        begin, end, _ = slice(start, stop).indices(int(entry['length']))
+        return int(entry['offset']) + begin, int(entry['offset']) + max(begin, end)
+
+    def get(self, id, start=None, stop=None, columns=None):
+        """
+        Reads the residues of a protein
+        Args:
+            id(str): The id of the protein
+            start, stop(int): The range of residues read, starting at 0 like a python slice. Defaults to all of them
+            columns(list): The fields read, out of aminoCons.R4S_COLUMNS. Defaults to all of them
+        Returns:
+            A structured array with one entry per residue
+        """
+        columns = columns or R4S_COLUMNS
+        begin, end = self.bounds(id, start, stop)
+        table = np.empty(end - begin, dtype=[(name, R4S_DTYPE[name]) for name in columns])
+        for name in columns:
+            table[name] = self.column(name)[begin:end]
+        return table
+
+    def __getitem__(self, id):
+        return self.get(id)
+
+    def window(self, id, start=None, stop=None, column='score'):
+        """
+        Args:
+            id(str): The id of the protein
+            start, stop(int): The range of residues, starting at 0 like a python slice
+            column(str): The field, out of aminoCons.R4S_COLUMNS
+        Returns:
+            A read only view of the column for the residues, backed by the memory mapped file
+        """
+        begin, end = self.bounds(id, start, stop)
+        return self.column(column)[begin:end]
+
+    def score(self, id, position, column='score'):
+        """
+        Args:
+            id(str): The id of the protein
+            position(int): The index of the residue in the protein, starting at 0
+            column(str): The field, out of aminoCons.R4S_COLUMNS
+        Returns:
+            The value of the column at the residue
+        """
+        entry = self.row(id)
+        if not -entry['length'] <= position < entry['length']:
+            raise IndexError('%s has %i residues, not %i' % (id, entry['length'], position + 1))
+        value = self.column(column)[int(entry['offset']) + position % int(entry['length'])]
+        return value.decode('utf-8') if column == 'aa' else value.item()
+
+    def alpha(self, id):
+        """
+        Returns:
+            The alpha parameter of the protein, or nan if it was not given
+        """
+        return float(self.row(id)['alpha'])
+
+    def close(self):
+        """
+        Releases the memory mapped files
+        """
+        self._maps = {}
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Test file for the resultstore module
+"""
+import biskit.test
+import math
+import os
+import pickle
+import shutil
+import tempfile
+import aminoCons
+import resultstore
+import scoring
+from seq2conservation import PipeResult
+
+
+class TestResultStore(biskit.test.BiskitTest):
+    """
+    Test suite testing the columnar store of conservation scores
+    """
+
+    TAGS = [biskit.test.NORMAL]
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = self.directory + os.sep + 'scores.store'
+        self.table = aminoCons.Rate4Site.read_table(os.getcwd() + os.sep + 'example_data' + os.sep + 'multiFasta.res')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_lookup_and_slice(self):
+        """tests that the residues of a protein are found by id and can be sliced"""
+        with resultstore.ResultWriter(self.path) as writer:
+            writer.add('first', self.table, 2.83688)
+            writer.add('second', self.table[2:5])
+        store = resultstore.ResultStore(self.path)
+        self.assertEqual(len(store), 2)
+        self.assertTrue('second' in store)
+        self.assertEqual(store['first'].tolist(), self.table.tolist())
+        self.assertEqual(store.get('second', 1)['aa'].tolist(), ['C', 'G'])
+        self.assertEqual(store.get('first', -2, columns=['score']).tolist(), [(-1.577,), (-1.577,)])
+        self.assertEqual(len(store.get('first', 6, 2)), 0)
+        self.assertEqual(store.alpha('first'), 2.83688)
+        self.assertTrue(math.isnan(store.alpha('second')))
+        self.assertRaises(KeyError, store.get, 'third')
+
+    def test_append(self):
+        """tests that proteins can be added to an existing store, and that ids stay unique"""
+        with resultstore.ResultWriter(self.path) as writer:
+            writer.add('first', self.table)
+        with resultstore.ResultWriter(self.path) as writer:
+            self.assertRaises(resultstore.ResultStoreError, writer.add, 'first', self.table)
+            writer.add('second', self.table[:1])
+        store = resultstore.ResultStore(self.path)
+        self.assertEqual(store.ids.tolist(), ['first', 'second'])
+        self.assertEqual(store['second'].tolist(), self.table[:1].tolist())
+        self.assertEqual(os.path.getsize(resultstore.column_file(self.path, 'score')), 9 * 8)
+
+    def test_add_result(self):
+        """tests that only the results of pipes that succeeded are added"""
+        with resultstore.ResultWriter(self.path) as writer:
+            self.assertTrue(writer.add_result(PipeResult('good', {}, 1.5, None, self.table)))
+            self.assertFalse(writer.add_result(PipeResult('bad', None, None, ValueError())))
+            self.assertRaises(resultstore.ResultStoreError, writer.add_result, PipeResult('none', {}, 1.5, None))
+        self.assertEqual(list(resultstore.ResultStore(self.path)), ['good'])
+
+    def test_point_and_window(self):
+        """tests the lookups of single residues and windows straight from the mapped columns"""
+        with resultstore.ResultWriter(self.path) as writer:
+            writer.add_file('first', os.getcwd() + os.sep + 'example_data' + os.sep + 'multiFasta.res')
+            writer.add('second', self.table[::-1])
+        store = resultstore.ResultStore(self.path)
+        self.assertEqual(store.score('first', 7), -1.577)
+        self.assertEqual(store.score('second', -1, column='aa'), 'A')
+        self.assertEqual(store.score('second', 0, column='pos'), 8)
+        self.assertRaises(IndexError, store.score, 'first', 8)
+        window = store.window('second', 2, 4, column='aa')
+        self.assertEqual(window.tolist(), [b'G', b'G'])
+        self.assertFalse(window.flags.writeable)
+        self.assertEqual(store.alpha('first'), 2.83688)
+        self.assertEqual(store.find('first'), 0)
+        self.assertIsNone(store.find('firs'))
+
+    def test_add_file_without_alpha(self):
+        """tests that an output without an alpha parameter is stored with an alpha of nan"""
+        scored = scoring.write_table(self.table, self.path + '.res')
+        try:
+            with resultstore.ResultWriter(self.path) as writer:
+                writer.add_file('scored', scored)
+            store = resultstore.ResultStore(self.path)
+            self.assertEqual(store['scored']['aa'].tolist(), self.table['aa'].tolist())
+            self.assertTrue(math.isnan(store.alpha('scored')))
+        finally:
+            os.remove(scored)
+
+    def test_pickle(self):
+        """tests that a store sent to another process maps its files again"""
+        with resultstore.ResultWriter(self.path) as writer:
+            writer.add('first', self.table)
+        store = resultstore.ResultStore(self.path)
+        store.score('first', 0)
+        copy = pickle.loads(pickle.dumps(store))
+        self.assertEqual(copy.window('first').tolist(), self.table['score'].tolist())
+
+    def test_empty(self):
+        """tests that an empty store can be read"""
+        resultstore.ResultWriter(self.path).close()
+        store = resultstore.ResultStore(self.path)
+        self.assertEqual(len(store), 0)
+        self.assertFalse('first' in store)
+
+    def test_not_a_store(self):
+        """tests that opening a folder that is not a store raises a ResultStoreError"""
+        self.assertRaises(resultstore.ResultStoreError, resultstore.ResultStore, self.directory)
+
+
+if __name__ == '__main__':
+    biskit.test.localTest()
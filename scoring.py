@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Conservation scores computed in process from the columns of an alignment, as a fast alternative
+to Rate4Site for triage runs, such as a first pass over a whole proteome whose flagged proteins
+are then scored again with Rate4Site.
+
+Every column of the alignment is turned into a distribution of amino acids and scored at once
+with numpy, by one of the METHODS:
+    entropy: one minus the Shannon entropy of the column, gaps counted as a 21st symbol
+    jsd: the Jensen-Shannon divergence of the column from the BLOSUM62 background distribution
+Sequences can be weighted so that groups of near identical sequences do not dominate the
+distributions, the scores of columns with gaps can be lowered by the weight of the gapped
+sequences, and every score can be mixed with the mean score of its neighbouring columns.
+
+The scores of the columns of the reference (first) sequence are written in the layout of a
+Rate4Site output file, negated and normalized to a mean of 0 and a standard deviation of 1 like
+the Rate4Site scores, so that lower values are more conserved and the output is read by the same
+functions, see aminoCons.Rate4Site.read_table and rate2dict. The methods do not estimate a
+confidence interval, a standard deviation or an alpha parameter; the interval and standard
+deviation are written as nan and no alpha parameter is written.
+
+Citations
+Capra JA, Singh M. Predicting functionally important residues from sequence conservation.
+Bioinformatics 2007, 23 (15): 1875-1882 (doi:10.1093/bioinformatics/btm270).
+
+Henikoff S, Henikoff JG. Position-based sequence weights. J Mol Biol 1994, 243 (4): 574-578.
+"""
+
+import os
+import numpy as np
+from aminoCons import R4S_DTYPE, Rate4Site
+from alignment import Alignment
+from biskit.errors import BiskitError
+
+class ScoringError(BiskitError):
+    pass
+
+AMINO_ACIDS = 'ACDEFGHIKLMNPQRSTVWY'
+#: The code of gaps, and of the letters that are not one of the 20 amino acids
+GAP = len(AMINO_ACIDS)
+_CODES = np.full(256, GAP, dtype=np.int64)
+_CODES[[ord(a) for a in AMINO_ACIDS]] = np.arange(len(AMINO_ACIDS))
+
+#: The background distribution of the amino acids in the BLOSUM62 alignments, from Capra and Singh
+BLOSUM62_BACKGROUND = {'A': 0.078, 'R': 0.051, 'N': 0.041, 'D': 0.052, 'C': 0.024, 'Q': 0.034, 'E': 0.059,
+                       'G': 0.083, 'H': 0.025, 'I': 0.062, 'L': 0.092, 'K': 0.056, 'M': 0.024, 'F': 0.044,
+                       'P': 0.043, 'S': 0.059, 'T': 0.055, 'W': 0.014, 'Y': 0.034, 'V': 0.072}
+BACKGROUND = np.array([BLOSUM62_BACKGROUND[a] for a in AMINO_ACIDS])
+BACKGROUND = BACKGROUND / BACKGROUND.sum()
+
+#: Added to the count of every symbol, so that the divergence is defined for absent amino acids
+PSEUDOCOUNT = 1e-6
+
+def encode(rows):
+    """
+    Args:
+        rows (numpy.ndarray): The alignment, either the uint8 matrix of an alignment.Alignment or the
+        array of characters returned by aminoCons.read_msa
+    Returns:
+        An integer array of the same shape, with the index of every amino acid in AMINO_ACIDS and GAP
+        for gaps and other letters
+    """
+    if rows.dtype != np.uint8:
+        rows = np.minimum(np.ascontiguousarray(rows, dtype='U1').view(np.uint32), 255).reshape(rows.shape)
+    return _CODES[rows]
+
+def column_counts(codes, weights=None):
+    """
+    Counts the symbols of every column, in a single pass over the alignment
+    Args:
+        codes (numpy.ndarray): The encoded alignment, with one row per sequence
+        weights (numpy.ndarray): The weight of every sequence. Defaults to 1
+    Returns:
+        An array with one row per column and one column per symbol, the gaps last
+    """
+    count, length = codes.shape
+    index = (codes + (GAP + 1) * np.arange(length)).ravel()
+    if weights is not None:
+        weights = np.repeat(weights, length)
+    return np.bincount(index, weights=weights, minlength=(GAP + 1) * length).reshape((length, GAP + 1))
+
+def sequence_weights(codes):
+    """
+    Position-based sequence weights of Henikoff and Henikoff: in every column, each sequence gets
+    1 / (r * s), r being the number of different symbols in the column and s the number of sequences
+    sharing the symbol of the sequence
+    Returns:
+        The weight of every sequence, summing to 1
+    """
+    count, length = codes.shape
+    if count == 0 or length == 0:
+        return np.full(count, 1 / max(count, 1))
+    counts = column_counts(codes)
+    types = (counts > 0).sum(axis=1)
+    shares = counts[np.arange(length), codes]
+    weights = (1 / (types * shares)).sum(axis=1)
+    return weights / weights.sum()
+
+def frequencies(counts, total):
+    """
+    Returns:
+        The frequencies of the symbols of every column, with PSEUDOCOUNT added to every count
+    """
+    return (counts + PSEUDOCOUNT) / (total + counts.shape[1] * PSEUDOCOUNT)
+
+def entropy(counts, total, sequences, background=None):
+    """
+    Returns:
+        One minus the Shannon entropy of every column, gaps included, normalized by the highest
+        entropy the column could have, so that a fully conserved column scores 1
+    """
+    freqs = counts / total
+    terms = np.where(freqs > 0, freqs * np.log(np.where(freqs > 0, freqs, 1)), 0)
+    # A column holds at most one symbol per sequence
+    highest = np.log(max(2, min(counts.shape[1], sequences)))
+    return 1 + terms.sum(axis=1) / highest
+
+def js_divergence(counts, total, sequences, background=BACKGROUND):
+    """
+    Returns:
+        The Jensen-Shannon divergence, in bits, between the distribution of the amino acids of every
+        column, gaps excluded, and the background distribution
+    """
+    freqs = frequencies(counts, total)[:, :GAP]
+    freqs = freqs / freqs.sum(axis=1)[:, None]
+    mixed = 0.5 * (freqs + background)
+    return 0.5 * ((freqs * np.log2(freqs / mixed)).sum(axis=1) + (background * np.log2(background / mixed)).sum(axis=1))
+
+METHODS = {'entropy': entropy, 'jsd': js_divergence}
+
+def window_scores(scores, window=3, weight=0.5):
+    """
+    Mixes the score of every column with the mean score of the window columns on each side of it
+    Args:
+        scores (numpy.ndarray): The score of every column
+        window (int): The number of neighbouring columns on each side. 0 leaves the scores unchanged
+        weight (float): The weight of the mean of the neighbours
+    """
+    if window <= 0 or len(scores) < 2:
+        return scores
+    kernel = np.ones(2 * window + 1)
+    kernel[window] = 0
+    sums = np.convolve(scores, kernel, mode='same')
+    counts = np.convolve(np.ones(len(scores)), kernel, mode='same')
+    return (1 - weight) * scores + weight * sums / counts
+
+def score_columns(codes, method='jsd', weighting=True, gap_weight=True, window=3, background=BACKGROUND):
+    """
+    Scores the conservation of every column of an alignment
+    Args:
+        codes (numpy.ndarray): The encoded alignment, see encode
+        method (str): The name of the method, out of METHODS
+        weighting (boolean): If true, the sequences are weighted with sequence_weights, otherwise equally
+        gap_weight (boolean): If true, the score of every column is multiplied by the fraction of the weight
+        of the sequences that have an amino acid in the column
+        window (int): The number of neighbouring columns mixed into every score, see window_scores
+        background (numpy.ndarray): The background distribution of the amino acids, in the order of AMINO_ACIDS
+    Returns:
+        The score of every column, higher values being more conserved
+    """
+    if method not in METHODS:
+        raise ScoringError('Unknown scoring method %r, expected one of %s' % (method, ', '.join(METHODS)))
+    weights = sequence_weights(codes) if weighting else np.full(len(codes), 1 / max(len(codes), 1))
+    counts = column_counts(codes, weights)
+    total = weights.sum()
+    scores = METHODS[method](counts, total, len(codes), background)
+    if gap_weight:
+        scores = scores * (1 - counts[:, GAP] / total)
+    return window_scores(scores, window)
+
+def score_alignment(msa, method='jsd', **kw):
+    """
+    Scores the residues of the reference (first) sequence of an alignment
+    Args:
+        msa (str or alignment.Alignment): The alignment, or the file path to it in clustal or fasta format
+        method (str): The name of the method, out of METHODS
+        kw: Passed on to score_columns
+    Returns:
+        The residue table of the reference sequence, a structured array with the fields of
+        aminoCons.R4S_DTYPE. The scores are negated and normalized like those of Rate4Site, lower
+        values being more conserved
+    """
+    aln = msa if isinstance(msa, Alignment) else Alignment.read(msa)
+    if not len(aln):
+        raise ScoringError('%s has no sequences' % aln.path)
+    residues = aln.query_columns()
+    conservation = score_columns(encode(aln.matrix), method=method, **kw)[residues]
+    sd = conservation.std() or 1.0
+    table = np.zeros(len(residues), dtype=R4S_DTYPE)
+    table['pos'] = np.arange(1, len(table) + 1)
+    table['aa'] = aln.chars()[0, residues]
+    table['score'] = (conservation.mean() - conservation) / sd
+    table['qq_low'] = table['qq_high'] = table['std'] = np.nan
+    table['msa_count'] = len(aln) - aln.gaps[:, residues].sum(axis=0)
+    table['msa_total'] = len(aln)
+    return table
+
+def write_table(table, path, method='jsd'):
+    """
+    Writes a residue table in the layout of a Rate4Site output file, without an alpha parameter
+    Returns:
+        The file path
+    """
+    with open(path, 'w') as file:
+        file.write('#Conservation scores of the %s method of the scoring module\n'
+                   '#Normalized to a mean of 0 and a standard deviation of 1, lower values are more conserved\n\n'
+                   '#POS SEQ  SCORE    QQ-INTERVAL     STD      MSA DATA\n' % method)
+        for r in table:
+            file.write('%5i     %s  %.6g   [%.4g, %.4g]   %.4g    %i/%i\n' % tuple(r))
+    return path
+
+def score_file(msa, outfile=None, method='jsd', **kw):
+    """
+    Scores an alignment and writes the scores in the layout of a Rate4Site output file
+    Args:
+        msa (str or alignment.Alignment): The alignment, or the file path to it
+        outfile (str): The output file. Defaults to the name of the alignment file with the extension .res,
+        in its folder
+        method (str): The name of the method, out of METHODS
+        kw: Passed on to score_columns
+    Returns:
+        The file path to the output
+    """
+    outfile = outfile or os.path.splitext(msa.path if isinstance(msa, Alignment) else msa)[0] + '.res'
+    return write_table(score_alignment(msa, method=method, **kw), outfile, method)
+
+def rate2dict(msa, method='jsd', identity=True, score=True, qqint=False, std=False, gapped=False, **kw):
+    """
+    Scores an alignment and maps the information selected by the flags onto every residue of the
+    reference sequence, in the layout of aminoCons.Rate4Site.rate2dict
+    """
+    return Rate4Site.table2dict(score_alignment(msa, method=method, **kw), identity=identity, score=score,
+                                qqint=qqint, std=std, gapped=gapped)
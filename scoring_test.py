@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Test file for the in process conservation scores
+"""
+import biskit.test
+import os
+import shutil
+import tempfile
+import numpy as np
+import aminoCons
+import scoring
+
+
+class TestScoring(biskit.test.BiskitTest):
+    """
+    Test suite testing the conservation scores computed from the columns of an alignment
+    """
+
+    TAGS = [biskit.test.NORMAL]
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.msa = self.directory + os.sep + 'family.fasta'
+        with open(self.msa, 'w') as file:
+            file.write('>ref\nMKW-LA\n>a\nMKWALG\n>b\nMKW-LC\n>c\nMKWAID\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_sequence_weights(self):
+        """tests that near identical sequences share their weight"""
+        rows = np.array([list('MKWL'), list('MKWL'), list('AGPC')])
+        weights = scoring.sequence_weights(scoring.encode(rows))
+        self.assertAlmostEqual(weights.sum(), 1)
+        self.assertAlmostEqual(weights[0], weights[1])
+        self.assertAlmostEqual(weights[2], 2 * weights[0])
+
+    def test_score_columns(self):
+        """tests that conserved columns score higher than variable or gapped ones"""
+        _, rows = aminoCons.read_msa(self.msa)
+        codes = scoring.encode(rows)
+        for method in scoring.METHODS:
+            scores = scoring.score_columns(codes, method=method, window=0)
+            self.assertEqual(len(scores), 6)
+            self.assertTrue(scores[2] > scores[4] > scores[5])
+            self.assertTrue(scores[2] > scores[3])
+        self.assertAlmostEqual(scoring.score_columns(codes, method='entropy', window=0)[0], 1)
+        self.assertRaises(scoring.ScoringError, scoring.score_columns, codes, method='blast')
+
+    def test_window_scores(self):
+        """tests that every score is mixed with the mean of its neighbours"""
+        scores = scoring.window_scores(np.array([1.0, 0.0, 0.0, 0.0]), window=1)
+        np.testing.assert_allclose(scores, [0.5, 0.25, 0.0, 0.0])
+
+    def test_score_file(self):
+        """tests that the scores of the reference residues are read like a Rate4Site output"""
+        res = scoring.score_file(self.msa, method='jsd', window=0)
+        table = aminoCons.Rate4Site.read_table(res)
+        self.assertEqual(table['aa'].tolist(), list('MKWLA'))
+        self.assertEqual(table['msa_count'].tolist(), [4, 4, 4, 4, 4])
+        self.assertEqual(int(np.argmin(table['score'])), 2)
+        self.assertAlmostEqual(table['score'].mean(), 0, places=4)
+        self.assertTrue(np.isnan(table['std']).all())
+        scores = scoring.rate2dict(self.msa, method='jsd', window=0, gapped=True)
+        self.assertEqual(scores[2][0], 'W')
+        self.assertAlmostEqual(scores[2][1], table['score'][2], places=4)
+        self.assertEqual(scores[2][2], '4/4')
+
+
+if __name__ == '__main__':
+    biskit.test.localTest()
@@ -8,9 +8,14 @@ Created on Thurs Sept 13 2018
 
 import biskit.test
 import os
+import pickle
+import shutil
+import tempfile
 import aminoCons
+import cachestore
 import seq2conservation as sq
-from unittest.mock import patch
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch, MagicMock
 
 
 class Test(biskit.test.BiskitTest):
@@ -23,6 +28,7 @@ class Test(biskit.test.BiskitTest):
     @classmethod
     def setUpClass(cls):
         cls.cwd = os.getcwd()
+        cls.Rate4Site = aminoCons.Rate4Site
 
         with open((os.getcwd()+os.sep+'example_data'+os.sep+'CDC48Aseq.txt'), 'r') as file:
             arabidopsisCDC48A = file.read()
@@ -31,14 +37,32 @@ class Test(biskit.test.BiskitTest):
         with open((os.getcwd()+os.sep+'example_data'+os.sep+'multiFasta.fasta'), 'r') as file:
             cls.ex_seq = file.read()
 
+    def serve_hogs(self, mock_hog, fasta):
+        """Makes the mocked get_HOGs write the fasta string to the file it is given"""
+        def get_HOGs(path=None):
+            with open(path, 'w') as file:
+                file.write(fasta)
+            return path
+        mock_hog.side_effect = get_HOGs
+
     @patch('seq2conservation.oma.OrthologFinder.get_HOGs')
     def test_call_orthologs(self, HOG_mock):
         """tests that call_orthologs correctly calls methods to make an output file of 'orthologs'"""
-        HOG_mock.return_value = self.ex_seq
+        self.serve_hogs(HOG_mock, self.ex_seq)
         tester = self.CDC48A.call_orthologs()
         self.assertTrue(os.path.isfile(tester))
         self.assertTrue('Protein_Sequence.orth' in tester)
 
+    @patch('seq2conservation.oma.OrthologFinder.get_HOGs')
+    def test_call_orthologs_timeout(self, HOG_mock):
+        """tests that OMA still timing out once the retries are exhausted is raised as a PipelineError"""
+        HOG_mock.side_effect = TimeoutError('https://omabrowser.org/api/hog/: 504')
+        pipe = sq.ConservationPipe(self.ex_seq, cache=False, rate_limit=4)
+        with patch('seq2conservation.oma._default_session', None), \
+                patch('seq2conservation.oma.default_session', wraps=sq.oma.default_session) as mock_session:
+            self.assertRaises(sq.PipelineError, pipe.call_orthologs)
+        mock_session.assert_called_once_with(4)
+
     @patch('seq2conservation.aminoCons.build_alignment')
     def test_call_alignment(self, mock_aln):
         """tests that call_alignment calls the correct methods and generates the correct output"""
@@ -49,6 +73,19 @@ class Test(biskit.test.BiskitTest):
         self.assertTrue('multiFasta.aln' in tester)
         aminoCons.clean_alignment(tester, cache=False)
 
+    @patch('seq2conservation.aminoCons.shutil.which')
+    @patch('seq2conservation.aminoCons.build_alignment')
+    def test_call_alignment_aligner(self, mock_aln, mock_which):
+        """tests that the automatic choice of aligner and the thread count are passed on to build_alignment"""
+        mock_which.return_value = '/usr/bin/mafft'
+        mock_aln.return_value = self.cwd+os.sep+'example_data'+os.sep+'multiFasta.aln'
+        orthologs = self.cwd+os.sep+'example_data'+os.sep+'Fak2Human.fasta'
+        sq.ConservationPipe(self.ex_seq, threads=3).call_alignment(orthologs)
+        self.assertEqual(mock_aln.call_args[1]['aligner'], 'mafft')
+        self.assertEqual(mock_aln.call_args[1]['threads'], 3)
+        sq.ConservationPipe(self.ex_seq, aligner='t_coffee').call_alignment(orthologs)
+        self.assertEqual(mock_aln.call_args[1]['aligner'], 't_coffee')
+
     @patch('seq2conservation.aminoCons.Rate4Site.get_alpha')
     def test_call_rate4site(self, mock_score):
         """tests that call_rate4site calls the correct methods and generates the correct output"""
@@ -57,12 +94,27 @@ class Test(biskit.test.BiskitTest):
         self.assertTrue(mock_score.called)
         self.assertEqual(2.83688, tester)
 
+    @patch('seq2conservation.aminoCons.run_rate4site_blocks')
+    def test_call_rate4site_blocks(self, mock_blocks):
+        """tests that the column blocks are cut from the alignment the pipe already parsed"""
+        example = self.cwd+os.sep+'example_data'+os.sep
+        directory = tempfile.mkdtemp()
+        try:
+            mock_blocks.return_value = directory + os.sep + 'multiFasta.res'
+            shutil.copy(example + 'multiFasta.res', mock_blocks.return_value)
+            pipe = sq.ConservationPipe(self.ex_seq, cache=False, r4s_blocks=2, threads=2)
+            aligned = pipe.read_alignment(example + 'multiFasta.aln')
+            self.assertEqual(pipe.call_rate4site(example + 'multiFasta.aln', workdir=directory), 2.83688)
+            self.assertIs(mock_blocks.call_args[0][0], aligned)
+        finally:
+            shutil.rmtree(directory)
+
     @patch('seq2conservation.oma.OrthologFinder.get_HOGs')
     @patch('seq2conservation.aminoCons.build_alignment')
     @patch('seq2conservation.aminoCons.Rate4Site.run')
     def test_pipe(self, mock_run, mock_aln, mock_hog):
         """tests that the pipe calls the correct methods and generates the correct output"""
-        mock_hog.return_value = self.ex_seq
+        self.serve_hogs(mock_hog, self.ex_seq)
         mock_aln.return_value = os.getcwd()+os.sep+'example_data'+os.sep + 'multiFasta.aln'
         mock_run.return_value = {0:('A', 0.6979),
                     1:('A', 0.6979),
@@ -78,6 +130,296 @@ class Test(biskit.test.BiskitTest):
         self.assertTrue(mock_hog.called)
         self.assertTrue(type(tester), dict)
 
+    @patch('seq2conservation.aminoCons.Rate4Site')
+    @patch('seq2conservation.aminoCons.build_alignment')
+    @patch('seq2conservation.oma.OrthologFinder.get_HOGs')
+    def test_pipe_threads(self, mock_hog, mock_aln, mock_r4s):
+        """tests that pipes running in threads work in separate folders without changing the working directory"""
+        def build_alignment(orthologs, workdir=None, **kw):
+            self.assertEqual(os.path.dirname(orthologs), workdir)
+            aln = workdir + os.sep + os.path.basename(orthologs).split('.')[0] + '.aln'
+            shutil.copy(self.cwd+os.sep+'example_data'+os.sep+'multiFasta.aln', aln)
+            return aln
+        self.serve_hogs(mock_hog, self.ex_seq)
+        mock_aln.side_effect = build_alignment
+        mock_r4s().run.return_value = {0: ('A', 0.6979)}
+        directory = tempfile.mkdtemp()
+        try:
+            pipes = [sq.ConservationPipe(self.ex_seq, name='protein%i' % i, directory=directory) for i in range(4)]
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                results = list(executor.map(lambda p: p.pipe(), pipes))
+            self.assertEqual(os.getcwd(), self.cwd)
+            self.assertEqual(results, [{0: ('A', 0.6979)}] * 4)
+            workdirs = set(c[1]['workdir'] for c in mock_aln.call_args_list)
+            self.assertEqual(len(workdirs), 4)
+            self.assertEqual(sorted(os.listdir(directory)), ['protein%i.aln' % i for i in range(4)])
+        finally:
+            shutil.rmtree(directory)
+
+    @patch('seq2conservation.aminoCons.Rate4Site')
+    @patch('seq2conservation.aminoCons.build_alignment')
+    @patch('seq2conservation.oma.OrthologFinder.get_HOGs')
+    def test_pipe_keep_table(self, mock_hog, mock_aln, mock_r4s):
+        """tests that the table kept by the pipe is the output parsed by Rate4Site, not parsed a second time"""
+        example = self.cwd+os.sep+'example_data'+os.sep
+        def build_alignment(orthologs, workdir=None, **kw):
+            aln = workdir + os.sep + os.path.basename(orthologs).split('.')[0] + '.aln'
+            shutil.copy(example + 'multiFasta.aln', aln)
+            return aln
+        def rate4site(msa, workdir=None, **kw):
+            r4s = MagicMock(score_output=example + 'multiFasta.res', parsed=None)
+            def run():
+                r4s.parsed = sq.aminoCons.Rate4SiteResult.read(r4s.score_output)
+                r4s.alpha = r4s.parsed.alpha
+                return r4s.parsed.to_dict()
+            r4s.run.side_effect = run
+            return r4s
+        mock_aln.side_effect = build_alignment
+        mock_r4s.side_effect = rate4site
+        mock_r4s.parse_table = self.Rate4Site.parse_table
+        mock_r4s.table2dict = self.Rate4Site.table2dict
+        result = sq.aminoCons.Rate4SiteResult
+        directory = tempfile.mkdtemp()
+        try:
+            self.serve_hogs(mock_hog, self.ex_seq)
+            with patch.object(result, 'read', wraps=result.read) as mock_read, \
+                    patch.object(result, 'parse', wraps=result.parse) as mock_parse:
+                pipes = [sq.ConservationPipe(self.ex_seq, name=name, directory=directory, keep_table=True)
+                         for name in ('first', 'second')]
+                for pipe in pipes:
+                    pipe.pipe()
+            self.assertEqual(mock_read.call_count, 2)
+            self.assertEqual(mock_parse.call_count, 2)
+            self.assertIs(pipes[0].table, pipes[0].parsed.table)
+            self.assertEqual(pipes[1].table['score'][6], -1.577)
+            self.assertIsNone(pipes[1].rate4site_output)
+        finally:
+            shutil.rmtree(directory)
+
+    @patch('seq2conservation.aminoCons.Rate4Site')
+    @patch('seq2conservation.aminoCons.build_alignment')
+    @patch('seq2conservation.oma.OrthologFinder.get_HOGs')
+    def test_pipe_store(self, mock_hog, mock_aln, mock_r4s):
+        """tests that pipes with the same orthologs share the stored alignment and scores whatever their name"""
+        example = self.cwd+os.sep+'example_data'+os.sep
+        def build_alignment(orthologs, workdir=None, **kw):
+            aln = workdir + os.sep + os.path.basename(orthologs).split('.')[0] + '.aln'
+            shutil.copy(example + 'multiFasta.aln', aln)
+            return aln
+        def rate4site(msa, workdir=None, **kw):
+            res = workdir + os.sep + 'multiFasta.res'
+            shutil.copy(example + 'multiFasta.res', res)
+            return MagicMock(score_output=res, alpha=2.83688, run=MagicMock(return_value={0: ('A', 0.6979)}))
+        mock_aln.side_effect = build_alignment
+        mock_r4s.side_effect = rate4site
+        for method in ['rate2dict', 'read_table', 'parse_table', 'table2dict', 'get_alpha', 'extract_resi', 'get_num']:
+            setattr(mock_r4s, method, getattr(self.Rate4Site, method))
+        directory = tempfile.mkdtemp()
+        try:
+            store = cachestore.DiskCache(directory + os.sep + 'store.sqlite')
+            self.serve_hogs(mock_hog, self.ex_seq)
+            first = sq.ConservationPipe(self.ex_seq, name='first', directory=directory, store=store)
+            first.pipe()
+            self.serve_hogs(mock_hog, self.ex_seq.replace('AACCGGTT', 'aaccggtt\n'))
+            second = sq.ConservationPipe(self.ex_seq, name='second', directory=directory, store=store)
+            scores = second.pipe()
+            self.assertEqual(mock_aln.call_count, 1)
+            self.assertEqual(mock_r4s.call_count, 1)
+            self.assertEqual(scores[7], ('T', -1.577))
+            self.assertEqual(second.alpha, 2.83688)
+            self.serve_hogs(mock_hog, self.ex_seq.replace('AACCGGTT', 'AACCGGTA'))
+            sq.ConservationPipe(self.ex_seq, name='first', directory=directory, store=store).pipe()
+            self.assertEqual(mock_aln.call_count, 2)
+            store.close()
+        finally:
+            shutil.rmtree(directory)
+
+    @patch('seq2conservation.aminoCons.Rate4Site')
+    @patch('seq2conservation.aminoCons.build_alignment')
+    @patch('seq2conservation.oma.OrthologFinder.get_HOGs')
+    def test_pipe_reduction(self, mock_hog, mock_aln, mock_r4s):
+        """tests that only the representative orthologs are aligned and that the subset is kept with the alignment"""
+        example = self.cwd+os.sep+'example_data'+os.sep
+        aligned = []
+        def build_alignment(orthologs, workdir=None, **kw):
+            with open(orthologs) as file:
+                aligned.append(file.read())
+            aln = workdir + os.sep + 'reduced.aln'
+            shutil.copy(example + 'multiFasta.aln', aln)
+            return aln
+        mock_aln.side_effect = build_alignment
+        mock_r4s.return_value = MagicMock(alpha=2.83688, run=MagicMock(return_value={0: ('A', 0.6979)}))
+        directory = tempfile.mkdtemp()
+        try:
+            self.serve_hogs(mock_hog, self.ex_seq)
+            seen = []
+            pipe = sq.ConservationPipe(self.ex_seq, name='reduced', directory=directory, max_sequences=2,
+                                       hook=seen.append)
+            pipe.pipe()
+            self.assertEqual(seen, pipe.stats)
+            self.assertEqual([stats.stage for stats in seen], ['orthologs', 'subset', 'alignment', 'rate4site'])
+            self.assertEqual([stats.sequences for stats in seen], [3, 2, 3, None])
+            self.assertEqual(seen[2].columns, 8)
+            self.assertEqual(aligned[0].count('>'), 2)
+            self.assertEqual(pipe.subset.total, 3)
+            self.assertEqual(pipe.subset.kept[0], 'AT1G01140.1')
+            self.assertTrue(os.path.isfile(directory + os.sep + 'reduced.subset'))
+        finally:
+            shutil.rmtree(directory)
+
+    @patch('seq2conservation.aminoCons.Rate4Site')
+    @patch('seq2conservation.aminoCons.build_alignment')
+    @patch('seq2conservation.oma.OrthologFinder.get_HOGs')
+    def test_pipe_reduction_hog(self, mock_hog, mock_aln, mock_r4s):
+        """tests that the input protein, which the HOGs do not contain, is aligned first when the orthologs are reduced"""
+        aligned = []
+        def build_alignment(orthologs, workdir=None, **kw):
+            with open(orthologs) as file:
+                aligned.append(file.read())
+            aln = workdir + os.sep + 'hog.aln'
+            shutil.copy(self.cwd+os.sep+'example_data'+os.sep+'multiFasta.aln', aln)
+            return aln
+        mock_aln.side_effect = build_alignment
+        mock_r4s.return_value = MagicMock(alpha=2.83688, run=MagicMock(return_value={0: ('A', 0.6979)}))
+        directory = tempfile.mkdtemp()
+        try:
+            self.serve_hogs(mock_hog, '>HUMAN1\nWYHCFPWELIVQGTNDRA\n>MOUSE1\nWYHCFPWELIVQGTNDR\n>YEAST1\nLLLPPPKKKEEEDDDGGG\n')
+            pipe = sq.ConservationPipe('>AT1G01140.1\nMKTRQNKDSMSMRSGRKKEAPG\n', name='hog', directory=directory,
+                                       max_sequences=2)
+            pipe.pipe()
+            self.assertEqual(pipe.subset.kept, ['Input', 'HUMAN1'])
+            self.assertTrue(aligned[0].startswith('>Input Sequence\nMKTRQNKDSMSMRSGRKKEAPG'))
+            self.assertEqual(aligned[0].count('>'), 2)
+        finally:
+            shutil.rmtree(directory)
+
+    @patch('seq2conservation.aminoCons.Rate4Site')
+    @patch('seq2conservation.aminoCons.build_alignment')
+    @patch('seq2conservation.oma.OrthologFinder.get_HOGs')
+    def test_pipe_resume(self, mock_hog, mock_aln, mock_r4s):
+        """tests that a rerun of a failed pipe resumes from the last checkpointed stage"""
+        example = self.cwd+os.sep+'example_data'+os.sep
+        def build_alignment(orthologs, workdir=None, **kw):
+            aln = workdir + os.sep + 'resumed.aln'
+            shutil.copy(example + 'multiFasta.aln', aln)
+            return aln
+        def rate4site(msa, workdir=None, **kw):
+            res = workdir + os.sep + 'resumed.res'
+            shutil.copy(example + 'multiFasta.res', res)
+            return MagicMock(score_output=res, alpha=2.83688, parsed=aminoCons.Rate4SiteResult.read(res),
+                             run=MagicMock(return_value={0: ('A', 0.6979)}))
+        mock_aln.side_effect = build_alignment
+        mock_r4s.side_effect = aminoCons.Rate4SiteError('preempted')
+        for method in ['rate2dict', 'read_table', 'parse_table', 'table2dict', 'get_alpha', 'extract_resi', 'get_num']:
+            setattr(mock_r4s, method, getattr(self.Rate4Site, method))
+        self.serve_hogs(mock_hog, self.ex_seq)
+        directory = tempfile.mkdtemp()
+        try:
+            pipe = sq.ConservationPipe(self.ex_seq, name='resumed', directory=directory, resume=True, cache=False)
+            self.assertRaises(aminoCons.Rate4SiteError, pipe.pipe)
+            self.assertTrue(os.path.isdir(directory + os.sep + 'resumed.checkpoint'))
+            mock_r4s.side_effect = rate4site
+            pipe = sq.ConservationPipe(self.ex_seq, name='resumed', directory=directory, resume=True, keep_table=True)
+            self.assertEqual(pipe.pipe(), {0: ('A', 0.6979)})
+            self.assertEqual(pipe.table['aa'].tolist(), list('AACCGGTT'))
+            self.assertEqual((mock_hog.call_count, mock_aln.call_count, mock_r4s.call_count), (1, 1, 2))
+            pipe = sq.ConservationPipe(self.ex_seq, name='resumed', directory=directory, resume=True, qqint=True)
+            scores = pipe.pipe()
+            self.assertEqual(scores[7], ('T', -1.577, (-3.889, -0.7852)))
+            self.assertEqual(pipe.alpha, 2.83688)
+            self.assertEqual((mock_hog.call_count, mock_aln.call_count, mock_r4s.call_count), (1, 1, 2))
+            pipe = sq.ConservationPipe(self.ex_seq, name='resumed', directory=directory, resume=True, qqint=True)
+            self.assertEqual(pipe.pipe(), scores)
+            self.assertTrue(os.path.isfile(directory + os.sep + 'resumed.aln'))
+        finally:
+            shutil.rmtree(directory)
+
+    @patch('seq2conservation.aminoCons.build_alignment')
+    @patch('seq2conservation.oma.OrthologFinder.get_HOGs')
+    def test_pipe_engine(self, mock_hog, mock_aln):
+        """tests that another engine scores the alignment in process, in the layout of Rate4Site"""
+        def build_alignment(orthologs, workdir=None, **kw):
+            aln = workdir + os.sep + 'triage.aln'
+            shutil.copy(self.cwd+os.sep+'example_data'+os.sep+'multiFasta.aln', aln)
+            return aln
+        mock_aln.side_effect = build_alignment
+        self.serve_hogs(mock_hog, self.ex_seq)
+        directory = tempfile.mkdtemp()
+        try:
+            pipe = sq.ConservationPipe(self.ex_seq, name='triage', directory=directory, engine='jsd', gapped=True,
+                                       keep_table=True, cache=False)
+            # Rate4Site is not installed here, the scores can only come from the engine
+            scores = pipe.pipe()
+            self.assertIsNone(pipe.alpha)
+            self.assertEqual([s[0] for s in scores.values()], list('AACCGGTT'))
+            self.assertEqual(scores[0][2], '3/3')
+            self.assertAlmostEqual(pipe.table['score'].mean(), 0, places=4)
+            self.assertEqual([s.stage for s in pipe.stats], ['orthologs', 'alignment', 'scoring'])
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+        self.assertRaises(sq.PipelineError, sq.ConservationPipe, self.ex_seq, engine='blast')
+
+    def test_read_records(self):
+        """tests that read_records splits a multi-fasta file into uniquely named proteins"""
+        records = list(sq.read_records(self.cwd+os.sep+'example_data'+os.sep+'multiFasta.fasta'))
+        self.assertEqual([name for name, seq in records], ['AT1G01140.1', 'AT1G01140.1_1', 'AT1G01140.2'])
+        self.assertTrue(records[1][1].startswith('>AT1G01140.1 (version 2)'))
+
+    def test_read_records_bare_sequence(self):
+        """tests that a sequence without a header gets a default name"""
+        records = list(sq.read_records('MKALIVLGLVLLSVTVQG'))
+        self.assertEqual(records, [('Protein_Sequence_0', 'MKALIVLGLVLLSVTVQG')])
+
+    def test_run_batch(self):
+        """tests that run_batch runs every protein and reports the failures without stopping"""
+        def pipe(self):
+            if self.name == 'AT1G01140.2':
+                raise sq.PipelineError('no orthologs')
+            self.alpha = 1.5
+            return {0: ('A', 0.5)}
+        with patch.object(sq.ConservationPipe, 'pipe', pipe):
+            results = list(sq.run_batch(self.cwd+os.sep+'example_data'+os.sep+'multiFasta.fasta', jobs=2,
+                                        processes=False))
+        results = {r.name: r for r in results}
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results['AT1G01140.1'].scores, {0: ('A', 0.5)})
+        self.assertEqual(results['AT1G01140.1'].alpha, 1.5)
+        self.assertIsInstance(results['AT1G01140.2'].error, sq.PipelineError)
+
+    def test_pickle_rate_limited_session(self):
+        """tests that a pipe with a rate limited session can be sent to a worker process"""
+        session = sq.oma.OMASession(pool_size=3, keep_alive=False, rate_limit=2, burst=4)
+        pipe = sq.ConservationPipe(self.ex_seq, cache=False, session=session)
+        copy = pickle.loads(pickle.dumps(pipe))
+        self.assertIsNot(copy.session.session, session.session)
+        self.assertEqual((copy.session.limiter.rate, copy.session.limiter.capacity), (2, 4))
+        self.assertEqual(copy.session.session.get_adapter('https://omabrowser.org')._pool_maxsize, 3)
+        self.assertEqual(copy.session.session.headers['Connection'], 'close')
+        copy.session.limiter.acquire()
+        session.close()
+        copy.session.close()
+
+    def test_cpu_budget(self):
+        """tests that the jobs and threads of a batch never add up to more than the CPUs"""
+        self.assertEqual(sq.cpu_budget(cpus=8), (8, 1))
+        self.assertEqual(sq.cpu_budget(jobs=2, cpus=8), (2, 4))
+        self.assertEqual(sq.cpu_budget(threads=4, cpus=8), (2, 4))
+        self.assertEqual(sq.cpu_budget(jobs=4, threads=4, cpus=8), (4, 2))
+        self.assertEqual(sq.cpu_budget(jobs=16, cpus=8), (16, 1))
+        self.assertEqual(sq.cpu_budget(threads=16, cpus=8), (1, 8))
+
+    def test_run_batch_threads(self):
+        """tests that run_batch gives every pipe its share of the CPU budget"""
+        threads = []
+        def pipe(self):
+            threads.append(self.threads)
+            self.alpha = 1.5
+            return {}
+        with patch.object(sq.ConservationPipe, 'pipe', pipe):
+            list(sq.run_batch(self.cwd+os.sep+'example_data'+os.sep+'multiFasta.fasta', jobs=2, cpus=6,
+                              processes=False))
+        self.assertEqual(threads, [3, 3, 3])
+
     @classmethod
     def tearDownClass(cls):
         os.remove(os.getcwd()+ os.sep + 'Protein_Sequence.orth')
@@ -4,11 +4,13 @@
 Pipeline which retrieves the conservation score of the amino acids in sequence
 given an input sequence or fasta file. Intakes the sequence or fasta string of a protein using the standard, single letter alphabet,
 gets the orthologs from an external (online) database, the OMA browser. It then generates a
-multiple sequence alignment (MSA) using T-Coffee, and calculates the conservation score of each
-amino acid at each position using Rate4Site, with respect to the entered sequence.
+multiple sequence alignment (MSA) using T-Coffee (or a faster aligner for large sets of orthologs), and calculates the conservation score of each
+amino acid at each position using Rate4Site, with respect to the entered sequence. For quick triage runs,
+the scores can be computed in process from the columns of the alignment instead, see the scoring module.
 
 The steps of the pipeline are as follows:
 Sequence --> Orthologs
+Orthologs --> Representative orthologs (optional, see the redundancy module)
 Orthologs --> Alignment
 Alignment --> Conservation scores
 
@@ -29,9 +31,22 @@ Bayesian methods are superior. Mol Biol Evol 21: 1781-1791.
 
 import oma
 import aminoCons
+import alignment as al
+import cachestore
+import checkpoint
+import contextlib
+import instrument
+import fasta as fa
 import os
+import re
+import redundancy
+import scoring
+import shutil
+import tempfile
+from collections import namedtuple
+from concurrent import futures
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from biskit.errors import BiskitError
-from requests import RequestException
 
 class PipelineError(BiskitError):
     pass
@@ -46,7 +61,9 @@ class ConservationPipe():
     """
 
     def __init__(self, sequence, name=None, cache=True, identity=True, score=True, qqint=False, std=False,
-                    gapped=False):
+                    gapped=False, session=None, oma_cache=None, directory=None, workdir=None, store=None,
+                    r4s_blocks=1, max_sequences=None, cluster_identity=0.9, aligner='auto', threads=None,
+                    resume=False, keep_table=False, hook=None, oma_url=None, engine='rate4site', rate_limit=None):
         """
         Args:
             sequence (str): The sequence of the protein of interest, or the filepath of the fasta file containing
@@ -62,7 +79,51 @@ class ConservationPipe():
                 std(boolean): The standard deviation of hte posterior rate distribution
                 gapped(boolean): MSA DATA, the number of aligned sequences having an amino acid (non-gapped) from the overall
                     number of sequences at each position
+            session(oma.OMASession): The connection-pooled session used to query OMA. Defaults to the session
+            shared by the whole process
+            oma_cache(cachestore.DiskCache): A persistent cache of the OMA responses, so that proteins that
+            were already queried are not queried again
+            directory(str): The folder cached alignments are kept in. Defaults to Sequence_Alignments in the
+            current working directory
+            workdir(str): The folder in which the temporary folder of each run is created. Defaults to directory
+            store(cachestore.DiskCache): A content addressed store of alignments and Rate4Site results, keyed by
+            the hash of the orthologs (or alignment) and of the program options. When given, runs with the same
+            orthologs share their alignment whatever their name, and the alignments cached by name in directory
+            are not used
+            r4s_blocks(int): If more than 1, the alignment is split into this many column blocks that are scored by
+            parallel Rate4Site processes against a single tree. The merged scores approximate those of a single
+            run, see aminoCons.run_rate4site_blocks
+            max_sequences(int): If given, the orthologs are clustered by k-mer identity and at most this many
+            representatives are aligned, see redundancy.reduce_fasta. The input protein is always kept, as the first
+            sequence, and is added to the HOG orthologs, which do not contain it
+            cluster_identity(float): The estimated identity above which orthologs are clustered together
+            aligner(str): The program the orthologs are aligned with: t_coffee, mafft, clustalo or muscle, or auto
+            to use T-Coffee for small sets of orthologs and a faster installed aligner for large ones, see
+            aminoCons.get_aligner
+            threads(int): The CPU budget of the pipe: the number of threads the aligner may use, and of
+            Rate4Site blocks run at the same time. Defaults to the CPUs available to the process; see
+            cpu_budget to share the CPUs between the pipes of a batch
+            resume(boolean): When true, every stage of the pipe writes a checkpoint to the folder
+            <name>.checkpoint of directory, and a rerun skips the stages whose inputs and parameters are
+            unchanged, see the checkpoint module. The checkpoints are deleted once the pipe succeeds,
+            unless cache is true
+            keep_table(boolean): When true, the full Rate4Site residue table is kept in the table field as a
+            numpy structured array, see aminoCons.Rate4Site.read_table, so that it can be added to a
+            resultstore.ResultWriter
+            hook(function): Called with the instrument.StageStats of every stage of the pipe as soon as it
+            finishes. The measurements of all the stages are kept in the stats field
+            oma_url(str): The server the orthologs are retrieved from instead of the OMA browser, such as a
+            local mirror served by omamirror.MirrorServer
+            engine(str): What scores the alignment: rate4site, or one of the in process methods of scoring.METHODS,
+            jsd or entropy, which are much faster but only rank the residues. Their scores are laid out like those
+            of Rate4Site, with nan for the confidence interval and standard deviation, and an alpha of None
+            rate_limit(float): The maximum number of requests per second sent to OMA by the session shared by the
+            process, see oma.default_session. Only used without a session. The pipes of run_batch that run in
+            threads share the limit; each worker process of run_batch has a session and a limit of its own
         """
+        if engine != 'rate4site' and engine not in scoring.METHODS:
+            raise PipelineError('Unknown scoring engine %r, expected rate4site or one of %s'
+                                % (engine, ', '.join(scoring.METHODS)))
         if name:
             self.name = name
         elif os.path.isfile(sequence):
@@ -78,78 +139,459 @@ class ConservationPipe():
         self.qqint = qqint
         self.gapped = gapped
         self.std = std
+        self.session = session
+        self.oma_cache = oma_cache
+        self.directory = directory
+        self.workdir = workdir
+        self.store = store
+        self.r4s_blocks = r4s_blocks
+        self.max_sequences = max_sequences
+        self.cluster_identity = cluster_identity
+        self.subset = None
+        self.aligner = aligner
+        self.threads = threads or aminoCons.available_cpus()
+        self.resume = resume
+        self.rate4site_output = None
+        self.keep_table = keep_table
+        self.table = None
+        self.recorder = instrument.Recorder(self.name, hook)
+        self.oma_url = oma_url
+        self.engine = engine
+        self.rate_limit = rate_limit
+        self.aligned = None
+        self.parsed = None
 
+    @property
+    def stats(self):
+        """
+        The instrument.StageStats of the stages run so far, in the order they finished
+        """
+        return self.recorder.stages
 
-    def call_orthologs(self):
+    def call_orthologs(self, workdir=None):
         """
         Retrieves the HOGS of the input sequence. This is done by querying the OMA online database.
+        Args:
+            workdir(str): The folder the orthologs are written to. Defaults to the current working directory
+        Returns:
+            The filepath to the file containing the orthologs, in fasta format
         """
-        if os.path.isfile(self.input):
-            with open(self.input, "r") as file:
+        with self.recorder.stage('orthologs') as counters:
+            workdir = workdir or os.getcwd()
+            if os.path.isfile(self.input):
+                with open(self.input, "r") as file:
+                    sequence = file.read()
+                ortholog_call = oma.OrthologFinder(sequence, session=self.session, cache=self.oma_cache,
+                                                   base_url=self.oma_url, rate_limit=self.rate_limit)
+            else:
+                ortholog_call = oma.OrthologFinder(self.input, session=self.session, cache=self.oma_cache,
+                                                   base_url=self.oma_url, rate_limit=self.rate_limit)
+            # The sequences are streamed from OMA straight into the file
+            orth = workdir + os.sep + "%s.orth"%(self.name)
+            try:
+                try:
+                    ortholog_call.get_HOGs(path=orth)
+                except oma.exceptions.RequestException:
+                    ortholog_call.get_orthologs(path=orth)
+            except TimeoutError as e:
+                # OMA still timed out once the retries were exhausted
+                raise PipelineError('The orthologs of %s could not be retrieved: %s' % (self.name, e)) from e
+            self.timings = ortholog_call.timings
+            counters.update(downloaded=ortholog_call.downloaded, sequences=aminoCons.count_sequences(orth))
+            return orth
+
+    def call_reduction(self, orthologs):
+        """
+        Replaces the orthologs by their representatives, so that large families are aligned faster.
+        The input protein is kept as the first sequence, and added if the orthologs do not contain it.
+        The chosen subset is kept in the subset field.
+        Args:
+            orthologs(str): The filepath to the file containing the orthologs, in fasta format
+        Returns:
+            The filepath to the orthologs, which now only contains the representatives
+        """
+        with self.recorder.stage('subset') as counters:
+            self.subset = redundancy.reduce_fasta(orthologs, max_sequences=self.max_sequences,
+                                                  identity=self.cluster_identity, reference=self.query_record())
+            counters['sequences'] = len(self.subset.kept)
+            return orthologs
+
+    def query_record(self):
+        """
+        Returns:
+            The fasta record of the input protein, as bytes, as written in front of the orthologs by
+            oma.OrthologFinder.get_orthologs
+        """
+        sequence = self.input
+        if os.path.isfile(sequence):
+            with open(sequence, 'r') as file:
                 sequence = file.read()
-            ortholog_call = oma.OrthologFinder(sequence)
-        else:
-            ortholog_call = oma.OrthologFinder(self.input)
-        try:
-            self.orthologs = ortholog_call.get_HOGs()
-        except RequestException:
-            self.orthologs = ortholog_call.get_orthologs()
-        with open("%s.orth" %(self.name), "w") as o_file:
-            o_file.write(self.orthologs)
-        return os.getcwd() + os.sep + "%s.orth"%(self.name)
+        sequence = oma.OrthologFinder.get_fasta_sequence(fasta=sequence)
+        return (oma.OrthologFinder.seqnwl_strip(sequence) + os.linesep).encode('utf-8')
 
-    def call_alignment(self, orthologs):
+    def call_alignment(self, orthologs, workdir=None):
         """
-        Calls T-Coffee to generate an MSA of the orthologs that have been input.
+        Calls the aligner to generate an MSA of the orthologs that have been input.
         Args:
             orthologs(str): The filepath to the file containing the orthologs of the input, in fasta format
+            workdir(str): The folder the aligner runs in. Defaults to the current working directory
         Returns:
-            The filepath to the the msa
+            The filepath to the the msa, in clustal format
+        """
+        with self.recorder.stage('alignment') as counters:
+            aligner = self.aligner
+            if aligner == 'auto':
+                aligner = aminoCons.get_aligner(aligner, aminoCons.count_sequences(orthologs)).name
+            if self.store is not None:
+                alignment = self.cached_alignment(orthologs, workdir=workdir, aligner=aligner)
+            else:
+                alignment = aminoCons.build_alignment(orthologs, workdir=workdir, aligner=aligner, threads=self.threads)
+            self.alignment = alignment
+            aligned = self.read_alignment(alignment)
+            counters.update(sequences=len(aligned), columns=aligned.shape[1])
+            return alignment
+
+    def read_alignment(self, msa):
         """
-        alignment = aminoCons.build_alignment(orthologs)
-        self.alignment = alignment
+        Returns:
+            The alignment.Alignment of the msa file, parsed once and kept in the aligned field for the
+            stages that inspect the alignment in process
+        """
+        if self.aligned is None or self.aligned.path != msa:
+            self.aligned = al.Alignment.read(msa)
+        return self.aligned
+
+    def cached_alignment(self, orthologs, workdir=None, aligner='t_coffee'):
+        """
+        Returns the alignment of the orthologs from the store, or builds it and adds it to the store
+        """
+        workdir = workdir or os.getcwd()
+        with open(orthologs, 'r') as file:
+            fasta = file.read()
+        options = sorted(aminoCons.get_aligner(aligner).options.items())
+        key = 'aln:' + cachestore.hash_key(cachestore.normalize_fasta(fasta), aligner, repr(options))
+        content = self.store.get(key)
+        if content is None:
+            alignment = aminoCons.build_alignment(orthologs, workdir=workdir, aligner=aligner, threads=self.threads)
+            with open(alignment, 'rb') as file:
+                self.store.put(key, file.read())
+        else:
+            alignment = workdir + os.sep + '%s.aln' % os.path.basename(orthologs).split('.')[0]
+            with open(alignment, 'wb') as file:
+                file.write(content)
         return alignment
 
-    def call_rate4site(self, msa):
+    def call_rate4site(self, msa, workdir=None):
         """
-        Calls Rate4Site to calculate various statistics of the amino acids in the input sequence
+        Calls Rate4Site to calculate various statistics of the amino acids in the input sequence, or scores
+        the alignment in process if another engine was chosen
         Args:
             msa(str): The filepath to the file containing the msa
+            workdir(str): The folder Rate4Site runs in. Defaults to the current working directory
         Returns:
             The alpha parameter of the data
         """
-        conservation_score = aminoCons.Rate4Site(msa, cache=self.cache, identity=self.identity,
-                                                 score=self.score, qqint=self.qqint, gapped=self.gapped, std= self.std)
-        self.scores = conservation_score.run()
-        self.alpha = conservation_score.alpha
-        conservation_score.close()
+        if self.engine != 'rate4site':
+            with self.recorder.stage('scoring'):
+                workdir = workdir or os.getcwd()
+                r4s = scoring.score_file(self.read_alignment(msa), workdir + os.sep + '%s.res' % os.path.basename(msa).split('.')[0],
+                                         method=self.engine)
+                with open(r4s, 'rb') as file:
+                    self.rate4site_output = file.read()
+                os.remove(r4s)
+                return self.read_rate4site(self.rate4site_output, msa, workdir=workdir)
+        with self.recorder.stage('rate4site'):
+            if self.store is not None:
+                with open(msa, 'rb') as file:
+                    key = 'r4s:' + cachestore.hash_key(file.read(), 'rate4site', 'blocks=%i' % self.r4s_blocks)
+                content = self.store.get(key)
+                if content is not None:
+                    self.rate4site_output = content
+                    return self.read_rate4site(content, msa, workdir=workdir)
+            if self.r4s_blocks > 1:
+                # The blocks are cut from the alignment parsed for the other stages
+                merged = aminoCons.run_rate4site_blocks(self.read_alignment(msa), self.r4s_blocks,
+                                                        workdir=workdir, jobs=min(self.r4s_blocks, self.threads))
+                with open(merged, 'rb') as file:
+                    content = file.read()
+                if self.store is not None:
+                    self.store.put(key, content)
+                self.rate4site_output = content
+                return self.read_rate4site(content, msa, workdir=workdir)
+            conservation_score = aminoCons.Rate4Site(msa, cache=self.cache, identity=self.identity,
+                                                     score=self.score, qqint=self.qqint, gapped=self.gapped, std= self.std,
+                                                     workdir=workdir)
+            self.scores = conservation_score.run()
+            self.alpha = conservation_score.alpha
+            # The output parsed by Rate4Site is kept, the file is only read back for the store and checkpoints
+            self.parsed = conservation_score.parsed
+            if self.store is not None or self.resume:
+                with open(conservation_score.score_output, 'rb') as file:
+                    self.rate4site_output = file.read()
+            if self.store is not None:
+                self.store.put(key, self.rate4site_output)
+            conservation_score.close()
+            return self.alpha
+
+    def read_rate4site(self, content, msa, workdir=None):
+        """
+        Reads the scores and alpha parameter from the contents of a Rate4Site output file, parsed once into
+        the aminoCons.Rate4SiteResult kept in the parsed field. The alpha parameter is None for the in
+        process engines
+        """
+        self.parsed = aminoCons.Rate4SiteResult.parse(content)
+        self.scores = self.parsed.to_dict(identity=self.identity, score=self.score, qqint=self.qqint,
+                                          std=self.std, gapped=self.gapped)
+        self.alpha = self.parsed.alpha
         return self.alpha
 
     def pipe(self):
         """
-        Queries the OMA database, T-coffee and Rate4Site in sequence to get the
+        Queries the OMA database, T-coffee and Rate4Site in sequence to get the conservation scores of the input.
+        Every stage runs in a temporary folder of its own inside the output directory, and the process
+        working directory is never changed, so several pipes can run in threads of the same process.
         Returns:
             A dictionary containing the various statistical scores mapped to each amino acid, depending
             on which inputs were selected.
         """
-        old_dir = os.getcwd()
-        directory = old_dir + os.sep + 'Sequence_Alignments'
-        if not os.path.isdir(directory):
-            os.makedirs(directory)
-        os.chdir(directory)
+        directory = self.directory or os.getcwd() + os.sep + 'Sequence_Alignments'
+        os.makedirs(directory, exist_ok=True)
+        workdir = tempfile.mkdtemp(prefix='%s_'%(self.name), dir=self.workdir or directory)
+        try:
+            msa = directory+os.sep+'%s.aln'%(self.name)
+            if self.resume:
+                checkpoints = checkpoint.Checkpoints(directory+os.sep+'%s.checkpoint'%(self.name))
+                aln = self.resume_stages(checkpoints, workdir)
+                if self.cache:
+                    shutil.copyfile(aln, msa)
+                    if self.subset is not None:
+                        redundancy.write_subset(self.subset, directory+os.sep+'%s.subset'%(self.name))
+                else:
+                    checkpoints.clear()
+            elif self.store is None and os.path.isfile(msa):
+                aln = msa
+                r4s = self.call_rate4site(aln, workdir=workdir)
+                if not self.cache:
+                    os.remove(msa)
+            else:
+                orth = self.call_orthologs(workdir=workdir)
+                if self.max_sequences is not None:
+                    orth = self.call_reduction(orth)
+                aln = self.call_alignment(orth, workdir=workdir)
+                r4s = self.call_rate4site(aln, workdir=workdir)
+                if self.cache and os.path.dirname(aln) == workdir:
+                    os.replace(aln, msa)
+                if self.cache and self.subset is not None:
+                    redundancy.write_subset(self.subset, directory+os.sep+'%s.subset'%(self.name))
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        if self.keep_table:
+            self.table = (self.parsed or aminoCons.Rate4SiteResult.parse(self.rate4site_output)).table
+        if not self.cache:
+            try:
+                os.rmdir(directory)
+            except OSError:
+                # Not empty, or in use by another pipe
+                pass
+        return self.scores
 
-        msa = directory+os.sep+'%s.aln'%(self.name)
-        if os.path.isfile(msa):
-            aln = msa
-            r4s = self.call_rate4site(aln)
+    def resume_stages(self, checkpoints, workdir):
+        """
+        Runs the stages of the pipe that have no checkpoint with the same inputs and parameters, and
+        restores the others from their checkpoints
+        Args:
+            checkpoints(checkpoint.Checkpoints): The checkpoints of the pipe
+            workdir(str): The folder the stages run in
+        Returns:
+            The filepath to the alignment
+        """
+        if os.path.isfile(self.input):
+            with open(self.input, 'rb') as file:
+                key = cachestore.hash_key(file.read(), self.oma_url or '')
         else:
-            orth = self.call_orthologs()
-            aln = self.call_alignment(orth)
-            r4s = self.call_rate4site(aln)
-            os.remove(os.getcwd() + os.sep + "%s.orth"%(self.name))
-
-        aminoCons.clean_alignment(aln, self.cache)
-        os.chdir(old_dir)
-        if not self.cache and not os.listdir(directory):
-            os.rmdir(directory)
-        return self.scores
+            key = cachestore.hash_key(self.input, self.oma_url or '')
+        orth = workdir + os.sep + '%s.orth' % self.name
+        if checkpoints.get('orthologs', key):
+            checkpoints.restore('orthologs', orth)
+        else:
+            orth = self.call_orthologs(workdir=workdir)
+            checkpoints.put('orthologs', key, orth)
+
+        if self.max_sequences is not None:
+            key = cachestore.hash_key(checkpoint.file_hash(orth), repr(self.max_sequences), repr(self.cluster_identity))
+            entry = checkpoints.get('subset', key)
+            if entry:
+                checkpoints.restore('subset', orth)
+                self.subset = redundancy.Reduction(**entry['data'])
+            else:
+                orth = self.call_reduction(orth)
+                checkpoints.put('subset', key, orth, data=self.subset._asdict())
+
+        aligner = self.aligner
+        if aligner == 'auto':
+            aligner = aminoCons.get_aligner(aligner, aminoCons.count_sequences(orth)).name
+        options = sorted(aminoCons.get_aligner(aligner).options.items())
+        key = cachestore.hash_key(checkpoint.file_hash(orth), aligner, repr(options))
+        if checkpoints.get('alignment', key):
+            aln = checkpoints.restore('alignment', workdir + os.sep + '%s.aln' % self.name)
+        else:
+            aln = self.call_alignment(orth, workdir=workdir)
+            checkpoints.put('alignment', key, aln)
+
+        key = cachestore.hash_key(checkpoint.file_hash(aln), self.engine, 'blocks=%i' % self.r4s_blocks)
+        if checkpoints.get('rate4site', key):
+            with open(checkpoints.path('rate4site'), 'rb') as file:
+                self.rate4site_output = file.read()
+            self.parsed = parsed = None
+        else:
+            self.call_rate4site(aln, workdir=workdir)
+            r4s = workdir + os.sep + '%s.res' % self.name
+            with open(r4s, 'wb') as file:
+                file.write(self.rate4site_output)
+            checkpoints.put('rate4site', key, r4s)
+            parsed = self.scores
+
+        flags = (self.identity, self.score, self.qqint, self.std, self.gapped)
+        key = cachestore.hash_key(cachestore.hash_key(self.rate4site_output), repr(flags))
+        entry = checkpoints.get('scores', key)
+        if entry:
+            self.alpha = entry['data']['alpha']
+            self.scores = {i: _tuples(values) for i, values in entry['data']['scores']}
+        else:
+            if parsed is None:
+                self.read_rate4site(self.rate4site_output, aln, workdir=workdir)
+            checkpoints.put('scores', key, data={'alpha': self.alpha, 'scores': list(self.scores.items())})
+        return aln
+
+
+def _tuples(value):
+    """
+    Turns the lists of a value read from json back into tuples
+    """
+    if isinstance(value, list):
+        return tuple(_tuples(v) for v in value)
+    return value
+
+
+PipeResult = namedtuple('PipeResult', ['name', 'scores', 'alpha', 'error', 'table', 'stats'], defaults=[None, None])
+PipeResult.__doc__ = """
+The outcome of the pipeline for one protein of a batch. scores is the dictionary returned by
+ConservationPipe.pipe and alpha the alpha parameter of Rate4Site, None for the other engines. table is the residue table of
+the protein if the pipe was run with keep_table. If the pipeline failed, they are None and error
+holds the exception that was raised. stats is the list of the instrument.StageStats of the stages
+that were run, including the one that failed.
+"""
+
+
+def iter_fasta_pairs(fasta):
+    """
+    Yields the (name, fasta) pairs of the proteins of a multi-fasta file or string, reading a file
+    one protein at a time. The names are the first word of the headers.
+    """
+    is_file = os.path.isfile(fasta)
+    if not is_file and not fasta.lstrip().startswith('>'):
+        yield 'Protein_Sequence_0', fasta.strip()
+        return
+    with (open(fasta, 'rb') if is_file else contextlib.nullcontext(fasta)) as source:
+        for i, block in enumerate(fa.iter_blocks(source)):
+            words = fa.block_header(block).decode('utf-8').split()
+            yield (words[0] if words else 'Protein_Sequence_%i' % i), block.decode('utf-8')
+
+
+def read_records(fasta):
+    """
+    Splits a multi-fasta input into its proteins. Files are read one protein at a time, so that
+    inputs of any size can be processed
+    Args:
+        fasta(str or iterable): The path to a multi-fasta file, a string in fasta format, or an
+            iterable of (name, sequence) pairs
+    Yields:
+        (name, fasta) pairs. The names are taken from the first word of the fasta headers, made
+        safe to use as file names and unique within the batch.
+    """
+    pairs = iter_fasta_pairs(fasta) if isinstance(fasta, str) else fasta
+    seen = set()
+    for name, sequence in pairs:
+        name = re.sub(r'[^\w.-]', '_', name)
+        unique = name
+        i = 1
+        while unique in seen:
+            unique = '%s_%i' % (name, i)
+            i += 1
+        seen.add(unique)
+        yield unique, sequence
+
+
+def _run_pipe(name, sequence, options):
+    """
+    Runs the pipeline of one protein in a worker process of run_batch
+    """
+    pipe = None
+    try:
+        pipe = ConservationPipe(sequence, name=name, **options)
+        scores = pipe.pipe()
+    except Exception as e:
+        return PipeResult(name, None, None, e, stats=pipe.stats if pipe is not None else None)
+    return PipeResult(name, scores, pipe.alpha, None, pipe.table, pipe.stats)
+
+
+def cpu_budget(jobs=None, threads=None, cpus=None):
+    """
+    Shares CPUs between the pipes of a batch, so that the jobs running at the same time never use
+    more threads than there are CPUs
+    Args:
+        jobs(int): The number of pipes run at the same time. Defaults to the number of CPUs divided
+            by threads
+        threads(int): The number of threads of each pipe. Defaults to the number of CPUs divided by jobs,
+            and is lowered if jobs * threads is more than the number of CPUs
+        cpus(int): The number of CPUs. Defaults to the CPUs available to the process
+    Returns:
+        The number of jobs and of threads per job
+    """
+    cpus = cpus or aminoCons.available_cpus()
+    if jobs is None:
+        jobs = max(1, cpus // (threads or 1))
+    threads = max(1, min(threads or cpus, cpus // jobs))
+    return jobs, threads
+
+
+def run_batch(fasta, jobs=None, processes=True, cpus=None, **options):
+    """
+    Runs the pipeline on every protein of a multi-fasta input in a pool of worker processes
+    Args:
+        fasta(str or iterable): The proteins, as accepted by read_records
+        jobs(int): The number of proteins processed at the same time. Defaults to the number of CPUs
+            divided by the threads option
+        processes(boolean): If true, the proteins are processed in worker processes. If false, they are
+            processed in threads of the current process, which share its session and caches
+        cpus(int): The CPU budget of the whole batch, shared between the jobs by cpu_budget. Defaults to
+            the CPUs available to the process
+        options: Keyword arguments passed on to ConservationPipe, except sequence and name. With worker
+            processes they must be picklable, and each worker uses its own session
+    Yields:
+        A PipeResult for every protein, in the order in which they finish. A protein that fails does
+        not stop the batch; the exception is stored in its result instead.
+    """
+    jobs, options['threads'] = cpu_budget(jobs, options.get('threads'), cpus)
+    records = read_records(fasta)
+    pool = futures.ProcessPoolExecutor if processes else ThreadPoolExecutor
+    with pool(max_workers=jobs) as executor:
+        pending = {}
+        while True:
+            # Only a couple of proteins per worker are queued at once, so that large inputs are
+            # not all submitted up front
+            while len(pending) < 2 * jobs:
+                record = next(records, None)
+                if record is None:
+                    break
+                name, sequence = record
+                pending[executor.submit(_run_pipe, name, sequence, options)] = name
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = pending.pop(future)
+                try:
+                    yield future.result()
+                except Exception as e:
+                    yield PipeResult(name, None, None, e)